@@ -0,0 +1,452 @@
+"""
+Offline benchmark harness for the transcode pipeline.
+
+Synthetic sources are generated with ffmpeg's lavfi sources and run through
+transcode_video / transcode_audio_for_video against LocalObjectStore, a filesystem
+stand-in for the MinIO client. Celery runs eagerly and Redis is replaced by
+process-local locks, dropped events and a local-memory cache, so no storage server,
+broker or Redis is needed. Each run reports per-stage wall and CPU time, bytes moved
+through storage and the realtime factor, and can be compared with a stored baseline.
+With quality, each case also scores its renditions against the source (PSNR/SSIM), so
+encoding settings can be compared on size and quality together.
+Run it with `python manage.py benchmark_transcode`.
+"""
+import functools
+import hashlib
+import itertools
+import os
+import resource
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from unittest import mock
+
+from celery import current_app
+from django.conf import settings
+from django.test.utils import override_settings
+from minio.datatypes import Object
+from minio.error import S3Error
+
+from . import events, locks, pertitle, tasks, utils
+from .models import AudioTrack, Video
+from .scratch import scratch_space
+
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+SOURCE_LANGUAGES = ['eng', 'fra', 'deu', 'spa', 'hin', 'tam']
+
+# Source encodings: 'h264' sources qualify for the stream-copy path, 'mpeg4' ones are always re-encoded.
+SOURCE_CODECS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'veryfast', '-b:v', '600k', '-maxrate', '700k', '-bufsize', '1400k', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '96k'],
+    'mpeg4': ['-c:v', 'mpeg4', '-q:v', '3', '-c:a', 'aac', '-b:a', '192k'],
+}
+
+# Pipeline functions timed as stages, by the name they are looked up under in video.tasks.
+STAGES = {
+    'get_media_probe': 'probe',
+    'analyze_complexity': 'analysis',
+    'download_file_from_minio': 'download',
+    'encode_to_hls': 'encode',
+    '_transcode_audio_to_hls': 'encode',
+    'measure_rendition_bandwidths': 'measure',
+    'write_master_playlist': 'playlist',
+    '_upload_transcoded_audio': 'upload',
+}
+
+
+def _cpu_seconds():
+    """User + system CPU of this process and of the ffmpeg children it has waited for."""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+class _LocalObjectResponse:
+    """The part of urllib3's response that the download helpers use, over a byte range of a file."""
+
+    def __init__(self, path, offset, length, on_read):
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        self._remaining = length
+        self._on_read = on_read
+
+    def stream(self, amt):
+        while self._remaining:
+            data = self._file.read(min(amt, self._remaining))
+            if not data:
+                break
+            self._remaining -= len(data)
+            self._on_read(len(data))
+            yield data
+
+    def read(self):
+        return b''.join(self.stream(1024 * 1024))
+
+    def close(self):
+        self._file.close()
+
+    def release_conn(self):
+        pass
+
+
+class LocalObjectStore:
+    """
+    Filesystem stand-in for the MinIO client, covering the calls the transcode
+    pipeline makes. Objects live under root/<bucket>/<name>, presigned URLs are
+    plain local paths, and bytes read and written are counted.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._objects = {}
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.objects_written = 0
+        self.put_seconds = 0.0
+
+    def counters(self):
+        return {
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'objects_written': self.objects_written,
+            'put_seconds': round(self.put_seconds, 3),
+        }
+
+    def _path(self, bucket_name, object_name):
+        return os.path.join(self.root, bucket_name, object_name)
+
+    def _count_read(self, nbytes):
+        with self._lock:
+            self.bytes_read += nbytes
+
+    def _not_found(self, bucket_name, object_name):
+        return S3Error('NoSuchKey', 'The specified key does not exist.', object_name, None, None, None,
+                       bucket_name, object_name)
+
+    def add_file(self, bucket_name, object_name, local_path):
+        """Seed the store with a file without counting it as pipeline traffic."""
+        path = self._path(bucket_name, object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, path)
+        self._objects[(bucket_name, object_name)] = {'etag': _file_md5(path), 'metadata': {}}
+
+    def stat_object(self, bucket_name, object_name, **kwargs):
+        entry = self._objects.get((bucket_name, object_name))
+        if entry is None:
+            raise self._not_found(bucket_name, object_name)
+        return Object(
+            bucket_name, object_name,
+            etag=entry['etag'],
+            size=os.path.getsize(self._path(bucket_name, object_name)),
+            metadata=entry['metadata'],
+        )
+
+    def get_object(self, bucket_name, object_name, offset=0, length=0, request_headers=None, **kwargs):
+        stat = self.stat_object(bucket_name, object_name)
+        if_match = (request_headers or {}).get('If-Match')
+        if if_match and if_match.strip('"') != stat.etag:
+            raise S3Error('PreconditionFailed', 'At least one of the pre-conditions you specified did not hold',
+                          object_name, None, None, None, bucket_name, object_name)
+        length = length or stat.size - offset
+        return _LocalObjectResponse(self._path(bucket_name, object_name), offset, length, self._count_read)
+
+    def fput_object(self, bucket_name, object_name, file_path, content_type=None, metadata=None, **kwargs):
+        started = time.perf_counter()
+        path = self._path(bucket_name, object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(file_path, path)
+        entry = {
+            'etag': _file_md5(path),
+            'metadata': {f'x-amz-meta-{key}': value for key, value in (metadata or {}).items()},
+        }
+        with self._lock:
+            self._objects[(bucket_name, object_name)] = entry
+            self.bytes_written += os.path.getsize(path)
+            self.objects_written += 1
+            self.put_seconds += time.perf_counter() - started
+
+    def remove_object(self, bucket_name, object_name, **kwargs):
+        with self._lock:
+            self._objects.pop((bucket_name, object_name), None)
+        try:
+            os.remove(self._path(bucket_name, object_name))
+        except FileNotFoundError:
+            pass
+
+    def presigned_get_object(self, bucket_name, object_name, **kwargs):
+        self.stat_object(bucket_name, object_name)
+        return os.path.abspath(self._path(bucket_name, object_name))
+
+
+class _LocalLock:
+    """A process-local stand-in for a redis Lock: a context manager that never expires."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+    def reacquire(self):
+        return True
+
+
+class _LocalRedis:
+    """Stands in for Redis: progress events are dropped and video locks are process-local."""
+
+    def __init__(self):
+        self._locks = {}
+
+    def publish(self, channel, message):
+        return 0
+
+    def lock(self, name, **kwargs):
+        return self._locks.setdefault(name, _LocalLock())
+
+
+class StageTimer:
+    """Accumulates wall and CPU seconds per named stage."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def measure(self, name):
+        wall, cpu = time.perf_counter(), _cpu_seconds()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stage['wall'] += time.perf_counter() - wall
+            stage['cpu'] += _cpu_seconds() - cpu
+            stage['calls'] += 1
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def report(self):
+        return {
+            name: {'wall': round(stage['wall'], 3), 'cpu': round(stage['cpu'], 3), 'calls': stage['calls']}
+            for name, stage in self.stages.items()
+        }
+
+
+def ffmpeg_version():
+    result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, check=True)
+    return result.stdout.splitlines()[0]
+
+
+def build_cases(durations, resolutions, audio_stream_counts, codecs, output_formats=('ts',)):
+    """Every combination of the given source parameters and output formats, as case dicts."""
+    cases = []
+    for codec, (width, height), duration, audio_streams, output_format in itertools.product(
+            codecs, resolutions, durations, audio_stream_counts, output_formats):
+        name = f'{codec}_{width}x{height}_{duration:g}s_{audio_streams}a'
+        # MPEG-TS cases keep their original names, so older baselines still match.
+        if output_format != 'ts':
+            name += f'_{output_format}'
+        cases.append({
+            'name': name,
+            'codec': codec,
+            'width': width,
+            'height': height,
+            'duration': duration,
+            'audio_streams': audio_streams,
+            'output_format': output_format,
+        })
+    return cases
+
+
+def generate_source(path, case):
+    """Render a testsrc2 video with one sine tone per audio stream, each tagged with a language."""
+    duration = case['duration']
+    command = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f"testsrc2=size={case['width']}x{case['height']}:rate=30:duration={duration}",
+    ]
+    for idx in range(case['audio_streams']):
+        command += ['-f', 'lavfi', '-i', f'sine=frequency={220 * (idx + 2)}:sample_rate=48000:duration={duration}']
+    command += ['-map', '0:v']
+    for idx in range(case['audio_streams']):
+        language = SOURCE_LANGUAGES[idx % len(SOURCE_LANGUAGES)]
+        command += ['-map', f'{idx + 1}:a', f'-metadata:s:a:{idx}', f'language={language}']
+    command += SOURCE_CODECS[case['codec']] + [path]
+    subprocess.run(command, check=True)
+    return path
+
+
+def generate_audio_source(path, duration):
+    command = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'sine=frequency=330:sample_rate=48000:duration={duration}',
+        '-c:a', 'aac', '-b:a', '192k', path,
+    ]
+    subprocess.run(command, check=True)
+    return path
+
+
+@contextmanager
+def offline_pipeline(store, timer):
+    """
+    Point the pipeline at store, time the STAGES functions with timer and run Celery
+    tasks (including chunked-transcode chords) eagerly.
+    """
+    eager = current_app.conf.task_always_eager
+    current_app.conf.task_always_eager = True
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch.object(utils, 'client', store))
+            for attr, stage in STAGES.items():
+                stack.enter_context(mock.patch.object(tasks, attr, timer.wrap(stage, getattr(tasks, attr))))
+            yield
+    finally:
+        current_app.conf.task_always_eager = eager
+
+
+def _run_task(task, obj_id, store, duration):
+    """Run one task and summarise its stages, storage traffic and realtime factor."""
+    timer = StageTimer()
+    store.reset_counters()
+    with offline_pipeline(store, timer):
+        with timer.measure('total'):
+            task(obj_id)
+    stages = timer.report()
+    total = stages.pop('total')
+    report = {
+        'wall': total['wall'],
+        'cpu': total['cpu'],
+        'realtime_factor': round(duration / total['wall'], 2) if total['wall'] else None,
+        'stages': stages,
+        'storage': store.counters(),
+    }
+    if 'encode' in stages and stages['encode']['wall']:
+        report['encode_realtime_factor'] = round(duration / stages['encode']['wall'], 2)
+    return report
+
+
+def run_case(case, workdir, store, audio_track=True, quality=False):
+    """
+    Benchmark transcode_video on the case's source, then (with audio_track)
+    transcode_audio_for_video on a user-uploaded track for the same video. With
+    quality, the video's renditions are scored against the source.
+    """
+    sources = os.path.join(workdir, 'sources')
+    os.makedirs(sources, exist_ok=True)
+    source_path = os.path.join(sources, f"{case['name']}.mp4")
+    if not os.path.exists(source_path):
+        generate_source(source_path, case)
+    video_key = f"videos/{case['name']}.mp4"
+    store.add_file('videos', video_key, source_path)
+    video = Video.objects.create(
+        title=case['name'], video_file=video_key, transcoding_uuid=utils.create_uuid(),
+        output_format=case.get('output_format', 'ts'),
+    )
+
+    report = {'source': dict(case, size=os.path.getsize(source_path))}
+    report['video'] = _run_task(tasks.transcode_video, video.id, store, case['duration'])
+    video.refresh_from_db()
+    report['video']['status'] = video.status
+    report['video']['encode_decisions'] = video.encode_decisions
+    if quality and video.status == 'completed':
+        with mock.patch.object(utils, 'client', store), scratch_space(f'video-{video.id}-quality') as workspace:
+            report['video']['renditions'] = pertitle.quality_report(video, workspace)
+
+    if audio_track and video.status == 'completed':
+        audio_path = os.path.join(sources, f"{case['name']}_audio.m4a")
+        if not os.path.exists(audio_path):
+            generate_audio_source(audio_path, case['duration'])
+        audio_key = f"audio_tracks/{case['name']}.m4a"
+        store.add_file('videos', audio_key, audio_path)
+        track = AudioTrack.objects.create(video=video, language='ita', audio_file=audio_key, is_user_uploaded=True)
+        report['audio_track'] = _run_task(tasks.transcode_audio_for_video, track.id, store, case['duration'])
+        track.refresh_from_db()
+        report['audio_track']['status'] = track.status
+    return report
+
+
+def run_benchmark(cases, workdir, audio_track=True, quality=False):
+    """
+    Run every case inside workdir. Each case gets a fresh scratch space under
+    workdir/scratch, so no case reuses sources cached by another or an earlier run.
+    """
+    store = LocalObjectStore(os.path.join(workdir, 'storage'))
+    results = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'ffmpeg': ffmpeg_version(),
+        'settings': {
+            'segment_duration': settings.HLS_SEGMENT_DURATION,
+            'audio_bitrate': settings.HLS_AUDIO_BITRATE,
+            'ladder': [rung['name'] for rung in settings.HLS_RENDITION_LADDER],
+            'stream_copy': settings.HLS_STREAM_COPY,
+            'stream_copy_ladder': settings.HLS_STREAM_COPY_LADDER,
+            'per_title': settings.PER_TITLE_ENCODING,
+            'chunked_min_duration': settings.TRANSCODE_CHUNKED_MIN_DURATION,
+        },
+        'cases': {},
+    }
+    scratch_dir = os.path.join(workdir, 'scratch')
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    # Saving the benchmark's own videos and tracks publishes events too.
+    local_redis = _LocalRedis()
+    with mock.patch.object(events, '_redis', local_redis), mock.patch.object(locks, '_redis', local_redis), \
+            override_settings(CACHES=LOCAL_CACHES):
+        for case in cases:
+            with override_settings(TRANSCODE_SCRATCH_DIR=os.path.join(scratch_dir, case['name'])):
+                results['cases'][case['name']] = run_case(case, workdir, store, audio_track, quality)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.15, min_delta=0.05):
+    """
+    List the regressions of results against baseline: any task or stage of a case
+    present in both whose wall time grew by more than tolerance (and min_delta
+    seconds, to ignore noise on tiny stages), or whose status is no longer completed.
+    """
+    regressions = []
+    for name, case in results['cases'].items():
+        base_case = baseline.get('cases', {}).get(name)
+        if not base_case:
+            continue
+        for task_name in ('video', 'audio_track'):
+            current, base = case.get(task_name), base_case.get(task_name)
+            if not current or not base:
+                continue
+            if current.get('status') != base.get('status'):
+                regressions.append(f"{name} {task_name}: status {base.get('status')} -> {current.get('status')}")
+            timings = [('total', current['wall'], base['wall'])]
+            timings += [
+                (stage, current['stages'][stage]['wall'], base['stages'][stage]['wall'])
+                for stage in current['stages'] if stage in base['stages']
+            ]
+            for stage, wall, base_wall in timings:
+                if wall > base_wall * (1 + tolerance) and wall - base_wall > min_delta:
+                    regressions.append(
+                        f"{name} {task_name} {stage}: {base_wall:.3f}s -> {wall:.3f}s "
+                        f"(+{(wall / base_wall - 1) * 100:.0f}%)"
+                    )
+    return regressions
@@ -0,0 +1,69 @@
+"""
+The video catalogue: newest-first keyset pagination over (uploaded_at, id), so every
+page costs one index range scan however deep it is, and rendered pages cached until
+the catalogue changes.
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .models import Video
+
+logger = logging.getLogger(__name__)
+
+CATALOGUE_VERSION_KEY = 'video:catalogue:version'
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(video):
+    """Opaque cursor for the page after video: its upload time in microseconds and its id."""
+    return f'{(video.uploaded_at - EPOCH) // timedelta(microseconds=1)}-{video.id}'
+
+
+def decode_cursor(cursor):
+    """(uploaded_at, id) of an encode_cursor() value; raises ValueError if it is malformed."""
+    micros, video_id = (int(part) for part in cursor.split('-'))
+    return EPOCH + timedelta(microseconds=micros), video_id
+
+
+def catalogue_page(cursor=None, page_size=None):
+    """
+    One page of the catalogue, newest first, starting after cursor. Each video carries
+    its number of completed audio tracks. Returns (videos, cursor of the next page or None).
+    """
+    page_size = page_size or settings.VIDEO_CATALOGUE_PAGE_SIZE
+    videos = Video.objects.annotate(
+        audio_track_count=Count('audio_tracks', filter=Q(audio_tracks__status='completed'))
+    ).order_by('-uploaded_at', '-id')
+    if cursor:
+        uploaded_at, video_id = decode_cursor(cursor)
+        videos = videos.filter(Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=video_id))
+    # One extra row tells whether there is a next page without a COUNT(*).
+    videos = list(videos[:page_size + 1])
+    next_cursor = encode_cursor(videos[page_size - 1]) if len(videos) > page_size else None
+    return videos[:page_size], next_cursor
+
+
+def catalogue_version():
+    return cache.get_or_set(CATALOGUE_VERSION_KEY, 1, timeout=None)
+
+
+def catalogue_cache_key(cursor):
+    return f'video:catalogue:{catalogue_version()}:{cursor or "first"}'
+
+
+def invalidate_catalogue():
+    """
+    Retire every cached catalogue page by moving to a new version; the old ones expire.
+    Like events, this is best effort: a cache outage must not fail the save that triggered it.
+    """
+    try:
+        cache.incr(CATALOGUE_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOGUE_VERSION_KEY, 1, timeout=None)
+    except redis.RedisError as e:
+        logger.warning("Could not invalidate the video catalogue: %s", e)
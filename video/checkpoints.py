@@ -0,0 +1,207 @@
+"""
+Checkpoints that make a transcode resumable. Every task of a video's transcode runs as
+a TranscodePart: the task claims its part before it starts, beats the part's heartbeat
+while it works and stores its result once done. The tasks are acks_late, so a worker
+that dies leaves its message to be delivered again; the redelivered task, like any
+duplicate, finds the parts that completed and skips them. A chunked transcode thus
+resumes from the chunks it still lacks, and its finalize part is sent by whichever
+part completes last.
+
+A worker that dies mid-task stops beating. reap_stale_parts(), run every
+TRANSCODE_REAPER_INTERVAL by the reap_stale_transcodes beat task, sends its part again
+once the heartbeat is TRANSCODE_HEARTBEAT_TIMEOUT old, up to TRANSCODE_MAX_ATTEMPTS starts.
+A part whose task raised is sent again the same way, TRANSCODE_RETRY_BACKOFF seconds
+after it failed (doubling with every attempt); out_of_attempts() tells the task whether
+this failure was its last.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from celery import current_app
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from .models import TranscodePart
+
+logger = logging.getLogger(__name__)
+
+VIDEO_PART = 'video'
+AUDIO_PART = 'audio'
+FINALIZE_PART = 'finalize'
+
+
+def chunk_part(chunk_index):
+    return f'chunk-{chunk_index}'
+
+
+def _stale_before():
+    return timezone.now() - timedelta(seconds=settings.TRANSCODE_HEARTBEAT_TIMEOUT)
+
+
+def _is_live(part):
+    """Whether a worker is running the part, going by its heartbeat."""
+    return part.status == 'running' and part.heartbeat_at >= _stale_before()
+
+
+def _send(part):
+    # Through the registered task rather than send_task, so eager mode runs it in place.
+    current_app.tasks[part.task].apply_async(part.args, **part.options)
+
+
+def queue_parts(video_id, parts, options=None):
+    """
+    Record parts of the video's transcode, (name, task, args) each, then send each task
+    with its args and the apply_async() options, skipping the parts that have completed
+    or that a worker is running. Every part is recorded before any is sent, so none can
+    find the others missing when it completes. A part sent twice still only runs once:
+    the second delivery can't claim it.
+    """
+    options = options or {}
+    to_send = []
+    for name, task, args in parts:
+        part, created = TranscodePart.objects.get_or_create(
+            video_id=video_id, name=name, defaults={'task': task.name, 'args': args, 'options': options},
+        )
+        if not created:
+            if part.status == 'completed' or _is_live(part):
+                continue
+            TranscodePart.objects.filter(pk=part.pk).exclude(status='completed').update(
+                task=task.name, args=args, options=options, status='queued'
+            )
+        to_send.append((task, args))
+    for task, args in to_send:
+        task.apply_async(args, **options)
+
+
+def expect_part(video_id, name, task, args, options=None):
+    """Record a part that queue_finalize() sends once every other part of the transcode has completed."""
+    part, _ = TranscodePart.objects.get_or_create(
+        video_id=video_id, name=name,
+        defaults={'task': task.name, 'args': args, 'options': options or {}, 'status': 'waiting'},
+    )
+    return part
+
+
+def claim_part(task, video_id, name):
+    """
+    Start the part name of the video's transcode in task, the running (bound) task.
+    Returns the part, or None when there is nothing to do: it has completed, waits for
+    other parts or another worker is running it. A part that was never queued, e.g.
+    when the task is called directly, is recorded with the task's own arguments.
+    """
+    part, _ = TranscodePart.objects.get_or_create(
+        video_id=video_id, name=name, defaults={'task': task.name, 'args': list(task.request.args or ())},
+    )
+    now = timezone.now()
+    # One conditional UPDATE, so of two deliveries racing for the part only one wins.
+    claimed = TranscodePart.objects.filter(pk=part.pk).exclude(status__in=('completed', 'waiting')).exclude(
+        status='running', heartbeat_at__gte=_stale_before()
+    ).update(status='running', attempts=F('attempts') + 1, heartbeat_at=now)
+    if not claimed:
+        logger.info("Skipping %s: nothing to resume", part)
+        return None
+    part.refresh_from_db()
+    return part
+
+
+@contextmanager
+def running(part):
+    """
+    Beat the claimed part's heartbeat every TRANSCODE_HEARTBEAT_INTERVAL seconds from a
+    thread while the block runs, and mark the part failed if the block raises:
+    reap_stale_parts() retries it unless it is out_of_attempts().
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.TRANSCODE_HEARTBEAT_INTERVAL):
+                # Filtered on the attempt: once the reaper has handed the part on, it isn't ours to keep alive.
+                TranscodePart.objects.filter(pk=part.pk, attempts=part.attempts).update(heartbeat_at=timezone.now())
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f'heartbeat-{part.pk}', daemon=True)
+    thread.start()
+    try:
+        yield part
+    except Exception:
+        # The heartbeat then dates the failure, which the retry backs off from.
+        TranscodePart.objects.filter(pk=part.pk, attempts=part.attempts).update(
+            status='failed', heartbeat_at=timezone.now()
+        )
+        raise
+    finally:
+        stop.set()
+        thread.join()
+
+
+def out_of_attempts(part):
+    """Whether the claimed part has been started TRANSCODE_MAX_ATTEMPTS times, so a failure is final."""
+    return part.attempts >= settings.TRANSCODE_MAX_ATTEMPTS
+
+
+def _retry_due(part):
+    backoff = settings.TRANSCODE_RETRY_BACKOFF * 2 ** max(part.attempts - 1, 0)
+    return part.heartbeat_at is None or part.heartbeat_at < timezone.now() - timedelta(seconds=backoff)
+
+
+def complete_part(part, result=None):
+    TranscodePart.objects.filter(pk=part.pk).update(status='completed', result=result, heartbeat_at=timezone.now())
+
+
+def part_results(video_id):
+    """Results of the completed chunk and audio parts of the video's transcode."""
+    return list(
+        TranscodePart.objects.filter(video_id=video_id, status='completed')
+        .exclude(name__in=(VIDEO_PART, FINALIZE_PART))
+        .values_list('result', flat=True)
+    )
+
+
+def queue_finalize(video_id):
+    """
+    Send the video's finalize part once every chunk and audio part has completed. Each of
+    them calls it when done, so the last to complete sends it; a redelivered one sends
+    it again if that send was lost, and the duplicate is never claimed twice.
+    """
+    parts = TranscodePart.objects.filter(video_id=video_id)
+    if parts.exclude(name__in=(VIDEO_PART, FINALIZE_PART)).exclude(status='completed').exists():
+        return
+    if parts.filter(name=FINALIZE_PART, status__in=('waiting', 'queued')).update(status='queued'):
+        _send(parts.get(name=FINALIZE_PART))
+
+
+def reap_stale_parts():
+    """
+    Send again every running part whose heartbeat is TRANSCODE_HEARTBEAT_TIMEOUT old,
+    i.e. whose worker died, or mark it failed once it has been started
+    TRANSCODE_MAX_ATTEMPTS times. Failed parts with attempts left are sent again once
+    their backoff has passed. Returns the parts requeued and the parts failed.
+    """
+    requeued, failed = [], []
+    retryable = TranscodePart.objects.filter(status='failed', attempts__lt=settings.TRANSCODE_MAX_ATTEMPTS)
+    for part in filter(_retry_due, retryable):
+        # Unless another reaper, or a redelivery claiming it, got there first.
+        if not TranscodePart.objects.filter(pk=part.pk, status='failed', attempts=part.attempts).update(status='queued'):
+            continue
+        logger.warning("Retrying %s: attempt %d failed", part, part.attempts)
+        _send(part)
+        requeued.append(part)
+    for part in TranscodePart.objects.filter(status='running', heartbeat_at__lt=_stale_before()):
+        status = 'failed' if part.attempts >= settings.TRANSCODE_MAX_ATTEMPTS else 'queued'
+        # Unless its worker beat in the meantime, or another reaper got there first.
+        if not TranscodePart.objects.filter(pk=part.pk, status='running', heartbeat_at=part.heartbeat_at).update(status=status):
+            continue
+        if status == 'queued':
+            logger.warning("Requeuing %s: no heartbeat since %s", part, part.heartbeat_at)
+            _send(part)
+            requeued.append(part)
+        else:
+            logger.error("Giving up on %s after %d attempts", part, part.attempts)
+            failed.append(part)
+    return requeued, failed
@@ -0,0 +1,225 @@
+import uuid
+import logging
+from celery import shared_task
+from django.db import transaction
+from django.db.models import F
+from minio.commonconfig import CopySource
+from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
+from . import utils
+from .locks import video_lock
+from .models import Video, AudioTrack, Rendition, TranscodeResult
+
+logger = logging.getLogger(__name__)
+
+SOURCE_BUCKET = 'videos'
+TRANSCODED_BUCKET = 'videos'
+TRANSCODED_PREFIX = 'transcoded_videos'
+
+
+def find_transcode_result(content_hash, profile_hash):
+    if not content_hash or not profile_hash:
+        return None
+    return TranscodeResult.objects.filter(content_hash=content_hash, profile_hash=profile_hash).first()
+
+
+def register_transcode_result(video):
+    """
+    Record a completed transcode so later uploads of the same content can reuse it.
+    If another video with the same content finished first, this one keeps its own tree.
+    """
+    if not video.content_hash or not video.encoding_profile_hash:
+        return None
+    result, created = TranscodeResult.objects.get_or_create(
+        content_hash=video.content_hash,
+        profile_hash=video.encoding_profile_hash,
+        defaults={
+            'transcoding_uuid': video.transcoding_uuid,
+            'master_playlist': video.master_playlist,
+            'transcoded_video': video.transcoded_video,
+        }
+    )
+    if not created:
+        return None
+    video.transcode_result = result
+    video.save(update_fields=['transcode_result'])
+    return result
+
+
+@transaction.atomic
+def reuse_transcode_result(video, result):
+    """
+    Point a video that hasn't been transcoded at an existing HLS tree instead. The
+    source object, renditions and audio tracks of a video already using the tree are
+    reused, so neither storage nor the encoders see the duplicate. Returns None, with
+    the video untouched, when the result has gone stale: unregistered meanwhile, or no
+    video plays from it any more. A stale result is deleted, and so is its tree once no
+    video is left in it.
+    """
+    if not TranscodeResult.objects.filter(id=result.id).update(ref_count=F('ref_count') + 1):
+        return None
+    source = Video.objects.filter(transcode_result=result).order_by('id').first()
+    if source is None:
+        logger.warning("Dropping stale transcode result %s: no video plays from it", result)
+        tree_uuid = str(result.transcoding_uuid)
+        TranscodeResult.objects.filter(id=result.id).delete()
+        if not Video.objects.filter(transcoding_uuid=tree_uuid).exists():
+            transaction.on_commit(lambda: delete_transcoded_tree.delay(tree_uuid))
+        return None
+    video.video_file = source.video_file.name
+    video.transcode_result = result
+    video.master_playlist = result.master_playlist
+    video.transcoded_video = result.transcoded_video
+    video.poster = source.poster
+    video.thumbnails = source.thumbnails
+    video.status = 'completed'
+    video.progress = 100
+    video.save()
+    Rendition.objects.bulk_create([
+        Rendition(
+            video=video,
+            name=rendition.name,
+            width=rendition.width,
+            height=rendition.height,
+            bandwidth=rendition.bandwidth,
+            average_bandwidth=rendition.average_bandwidth,
+            codecs=rendition.codecs,
+            playlist=rendition.playlist,
+            iframe_only=rendition.iframe_only,
+        )
+        for rendition in source.renditions.all()
+    ])
+    AudioTrack.objects.bulk_create([
+        AudioTrack(
+            video=video,
+            language=track.language,
+            audio_file=track.audio_file.name or None,
+            is_default=track.is_default,
+            transcoded_playlist=track.transcoded_playlist,
+            is_user_uploaded=track.is_user_uploaded,
+            status='completed',
+            progress=100,
+        )
+        for track in source.audio_tracks.filter(status='completed')
+    ])
+    return video
+
+
+def reuse_stored_transcode(video, content_hash):
+    """
+    For a video whose source reached storage without passing through the web process,
+    i.e. a direct upload: hash it with content_hash(), called only if the video has no
+    hash yet, and when the content was transcoded before with the same profile, play
+    the video from that tree and delete its now duplicate source. Returns whether the
+    video was completed this way.
+    """
+    if video.content_hash is None:
+        video.content_hash = content_hash()
+        video.save(update_fields=['content_hash'])
+    result = find_transcode_result(video.content_hash, video.encoding_profile_hash)
+    if result is None:
+        return False
+    duplicate_key = video.video_file.name
+    if reuse_transcode_result(video, result) is None:
+        return False
+    if duplicate_key != video.video_file.name:
+        try:
+            utils.client.remove_object(SOURCE_BUCKET, duplicate_key)
+        except S3Error as e:
+            logger.warning("Could not delete duplicate source %s: %s", duplicate_key, e)
+    logger.info("Video %s duplicates transcode %s; reusing its tree", video.id, result)
+    return True
+
+
+def _tree_objects(tree_uuid):
+    return utils.client.list_objects(TRANSCODED_BUCKET, prefix=f'{TRANSCODED_PREFIX}/{tree_uuid}/', recursive=True)
+
+
+def _rewrite_prefix(key, old_uuid, new_uuid):
+    if key and key.startswith(f'{old_uuid}/'):
+        return f'{new_uuid}/{key[len(old_uuid) + 1:]}'
+    return key
+
+
+def detach_transcode_result(video):
+    """
+    Copy-on-write before a video changes its HLS tree (e.g. gains an audio track):
+    if the tree is shared, copy it server-side into a folder of the video's own and
+    drop the reference. A video that is the tree's only user keeps writing in place,
+    but the tree is unregistered first: once changed it no longer is the transcode of
+    its content, and later uploads of that content must not be handed it.
+
+    Two tasks adding tracks to one video at once detach it one after the other, under
+    the video's 'detach' lock; the second finds the video already detached.
+    """
+    with video_lock(video.id, 'detach') as lock:
+        video.refresh_from_db()
+        if video.transcode_result_id is None:
+            return video
+        with transaction.atomic():
+            # Locked, so an upload can't start reusing the tree while it is unregistered.
+            result = TranscodeResult.objects.select_for_update().filter(id=video.transcode_result_id).first()
+            if result is None or result.ref_count <= 1:
+                if result is not None:
+                    result.delete()
+                video.transcode_result = None
+                return video
+        old_uuid = str(result.transcoding_uuid)
+        new_uuid = str(video.transcoding_uuid)
+        if new_uuid == old_uuid:
+            new_uuid = str(uuid.uuid4())
+        for obj in _tree_objects(old_uuid):
+            relative_name = obj.object_name[len(f'{TRANSCODED_PREFIX}/{old_uuid}/'):]
+            utils.client.copy_object(
+                TRANSCODED_BUCKET,
+                f'{TRANSCODED_PREFIX}/{new_uuid}/{relative_name}',
+                CopySource(TRANSCODED_BUCKET, obj.object_name)
+            )
+            # A large tree takes longer to copy than VIDEO_LOCK_TIMEOUT.
+            lock.reacquire()
+        with transaction.atomic():
+            # Only the video's own reference is dropped, and only once.
+            if not Video.objects.select_for_update().filter(id=video.id, transcode_result_id=result.id).exists():
+                logger.warning("Video %s was detached from %s meanwhile; discarding the copy", video.id, result)
+                video.refresh_from_db()
+                if str(video.transcoding_uuid) != new_uuid:
+                    transaction.on_commit(lambda: delete_transcoded_tree.delay(new_uuid))
+                return video
+            for rendition in video.renditions.all():
+                rendition.playlist = _rewrite_prefix(rendition.playlist, old_uuid, new_uuid)
+                rendition.save(update_fields=['playlist'])
+            for track in video.audio_tracks.exclude(transcoded_playlist__isnull=True):
+                track.transcoded_playlist = _rewrite_prefix(track.transcoded_playlist, old_uuid, new_uuid)
+                track.save(update_fields=['transcoded_playlist'])
+            video.transcoding_uuid = new_uuid
+            video.master_playlist = _rewrite_prefix(video.master_playlist, old_uuid, new_uuid)
+            video.transcoded_video = _rewrite_prefix(video.transcoded_video, old_uuid, new_uuid)
+            video.poster = _rewrite_prefix(video.poster, old_uuid, new_uuid)
+            video.thumbnails = _rewrite_prefix(video.thumbnails, old_uuid, new_uuid)
+            video.transcode_result = None
+            video.save(update_fields=[
+                'transcoding_uuid', 'master_playlist', 'transcoded_video', 'poster', 'thumbnails', 'transcode_result'
+            ])
+            TranscodeResult.objects.filter(id=result.id).update(ref_count=F('ref_count') - 1)
+    return video
+
+
+def release_transcode_result(result_id):
+    """Drop one reference to a shared tree, deleting the tree once nothing plays from it."""
+    with transaction.atomic():
+        TranscodeResult.objects.filter(id=result_id).update(ref_count=F('ref_count') - 1)
+        result = TranscodeResult.objects.select_for_update().filter(id=result_id, ref_count__lte=0).first()
+        if result is None:
+            return
+        tree_uuid = str(result.transcoding_uuid)
+        result.delete()
+        transaction.on_commit(lambda: delete_transcoded_tree.delay(tree_uuid))
+
+
+@shared_task
+def delete_transcoded_tree(tree_uuid):
+    errors = utils.client.remove_objects(
+        TRANSCODED_BUCKET, (DeleteObject(obj.object_name) for obj in _tree_objects(tree_uuid))
+    )
+    for error in errors:
+        logger.warning("Could not delete %s: %s", error.name, error.message)
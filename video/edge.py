@@ -0,0 +1,483 @@
+"""
+The playback edge: serves the transcoded HLS tree (transcoded_videos/ in the videos
+bucket) to players through a two-tier cache, so a popular title costs MinIO about one
+fetch per object instead of one per viewer.
+
+* Playlists and hot segments are kept in memory, in a per-process LRU bounded by
+  EDGE_MEMORY_CACHE_SIZE. A segment is hot once it is requested again after landing
+  on disk.
+* Segments are kept on disk under EDGE_CACHE_DIR, in an LRU bounded by
+  EDGE_DISK_CACHE_SIZE and shared by the web processes on a host. A miss on an object
+  larger than EDGE_DISK_FILL_SIZE (a single_file rendition, say) is passed through from
+  storage while a background thread fills the cache, so the first viewer doesn't wait
+  for the whole object. Objects larger than EDGE_DISK_MAX_OBJECT_SIZE are always passed
+  through, range by range.
+* Playlists change (live windows, added audio tracks), so a cached one is revalidated
+  against storage's ETag once it is EDGE_PLAYLIST_MAX_AGE seconds old. Segments are
+  revalidated after EDGE_SEGMENT_MAX_AGE. Revalidating an unchanged object only costs a
+  stat.
+* Concurrent misses for one object share a single origin fetch: within a process
+  through one future, across processes through a lock file per object.
+
+Responses carry the object's ETag, answer If-None-Match with 304 Not Modified and a
+single byte range with 206 Partial Content. When EDGE_ACCEL_REDIRECT_PREFIX is set,
+segments on disk are handed to nginx with X-Accel-Redirect, so nginx sends the file
+itself with sendfile() and the ASGI worker never copies it.
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags
+from minio.error import S3Error
+
+from . import metrics, utils
+from .uploader import PLAYLIST_EXTENSION, content_type_for
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = 'videos'
+PREFIX = 'transcoded_videos'
+OBJECTS_DIR = 'objects'
+LOCKS_DIR = 'locks'
+LOCK_FILE = '.lock'
+STREAM_CHUNK_SIZE = 512 * 1024
+NOT_FOUND_CODES = ('NoSuchKey', 'NoSuchObject', 'ResourceNotFound')
+
+
+class ObjectNotFound(Exception):
+    """The requested object is not in storage."""
+
+
+class RangeNotSatisfiable(Exception):
+    """A Range header asks for bytes past the end of the object."""
+
+
+class CachedObject:
+    """
+    One object as the edge serves it: its ETag and size, plus its content in memory
+    (body), on disk (path), or neither when it is passed through from storage.
+    """
+
+    def __init__(self, name, etag, size, fetched_at, body=None, path=None):
+        self.name = name
+        self.etag = etag
+        self.size = size
+        self.fetched_at = fetched_at
+        self.body = body
+        self.path = path
+
+    @property
+    def is_playlist(self):
+        return is_playlist(self.name)
+
+    def is_fresh(self):
+        max_age = settings.EDGE_PLAYLIST_MAX_AGE if self.is_playlist else settings.EDGE_SEGMENT_MAX_AGE
+        return time.time() - self.fetched_at < max_age
+
+    def refreshed(self):
+        return CachedObject(self.name, self.etag, self.size, time.time(), self.body, self.path)
+
+
+def is_playlist(object_name):
+    return object_name.endswith(PLAYLIST_EXTENSION)
+
+
+def object_name_for(key):
+    """The storage name of a playback key (a path under the transcoded tree), or None if it escapes it."""
+    normalized = posixpath.normpath(key)
+    if not key or normalized != key or normalized.startswith(('/', '..')):
+        return None
+    return f'{PREFIX}/{normalized}'
+
+
+def _not_found(e):
+    return isinstance(e, S3Error) and e.code in NOT_FOUND_CODES
+
+
+def _stat(object_name):
+    try:
+        return utils.client.stat_object(BUCKET_NAME, object_name)
+    except S3Error as e:
+        if _not_found(e):
+            raise ObjectNotFound(object_name)
+        raise
+
+
+def _open_object(object_name, etag, offset=0, length=0):
+    # If-Match fails the read if the object was replaced after it was stat'ed.
+    return utils.client.get_object(
+        BUCKET_NAME, object_name, offset=offset, length=length, request_headers={'If-Match': f'"{etag}"'}
+    )
+
+
+def _read_object(object_name, etag, write):
+    response = _open_object(object_name, etag)
+    try:
+        for data in response.stream(STREAM_CHUNK_SIZE):
+            write(data)
+            metrics.EDGE_ORIGIN_BYTES.inc(len(data))
+    finally:
+        response.close()
+        response.release_conn()
+
+
+@contextmanager
+def _locked(path, blocking=True):
+    """Hold an exclusive lock on the file at path; yields False if it is taken and not blocking."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DiskCache:
+    """
+    Segments on local disk, shared by every web process on the host: objects/<hash>
+    holds an object's bytes and objects/<hash>.json its name, ETag, size and fetch time.
+    Least recently served files are evicted first, by modification time.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, OBJECTS_DIR)
+        self._filling = set()
+        self._filling_lock = threading.Lock()
+
+    def _lock_path(self, digest):
+        # Lock files are striped by hash so there is a bounded number of them.
+        return os.path.join(self.root, LOCKS_DIR, digest[:3])
+
+    def _paths(self, object_name):
+        digest = hashlib.sha256(object_name.encode()).hexdigest()
+        path = os.path.join(self.objects_dir, digest)
+        return path, f'{path}.json', self._lock_path(digest)
+
+    def _read_meta(self, meta_path, path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if os.path.getsize(path) != meta['size']:
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        return meta
+
+    def _write_meta(self, meta_path, meta):
+        partial = os.path.join(self.objects_dir, f'.{os.path.basename(meta_path)}.{uuid.uuid4().hex[:8]}')
+        with open(partial, 'w') as f:
+            json.dump(meta, f)
+        os.replace(partial, meta_path)
+
+    def load(self, object_name):
+        """
+        The cached segment, revalidated or fetched as needed, and where it came from:
+        'disk', 'revalidated', 'origin' or 'passthrough', for objects too large to cache
+        or being filled in the background. Other processes missing on the same object
+        wait for this one's fetch.
+        """
+        path, meta_path, lock_path = self._paths(object_name)
+        with _locked(lock_path):
+            meta = self._read_meta(meta_path, path)
+            if meta and time.time() - meta['fetched_at'] < settings.EDGE_SEGMENT_MAX_AGE:
+                result = 'disk'
+            else:
+                stat = _stat(object_name)
+                if meta and meta['etag'] == stat.etag:
+                    result = 'revalidated'
+                    meta['fetched_at'] = time.time()
+                    self._write_meta(meta_path, meta)
+                elif stat.size > settings.EDGE_DISK_MAX_OBJECT_SIZE:
+                    return CachedObject(object_name, stat.etag, stat.size, time.time()), 'passthrough'
+                elif stat.size > settings.EDGE_DISK_FILL_SIZE:
+                    self._fill_in_background(object_name, stat)
+                    return CachedObject(object_name, stat.etag, stat.size, time.time()), 'passthrough'
+                else:
+                    result = 'origin'
+                    meta = self._fetch(object_name, stat, path, meta_path)
+            # The cache is LRU by modification time.
+            os.utime(path)
+            cached = CachedObject(object_name, meta['etag'], meta['size'], meta['fetched_at'], path=path)
+            if result != 'origin' and cached.size <= settings.EDGE_MEMORY_MAX_OBJECT_SIZE:
+                with open(path, 'rb') as f:
+                    cached.body = f.read()
+        return cached, result
+
+    def _fetch(self, object_name, stat, path, meta_path):
+        meta = self._install(object_name, stat, self._download(object_name, stat, path), path, meta_path)
+        self._evict()
+        return meta
+
+    def _download(self, object_name, stat, path):
+        """Fetch the object into a partial file next to path, and return the partial's path."""
+        os.makedirs(self.objects_dir, exist_ok=True)
+        partial = os.path.join(self.objects_dir, f'.{os.path.basename(path)}.{uuid.uuid4().hex[:8]}')
+        try:
+            with open(partial, 'wb') as f:
+                _read_object(object_name, stat.etag, f.write)
+            if os.path.getsize(partial) != stat.size:
+                raise IOError(f"Size mismatch fetching {object_name}: expected {stat.size} bytes")
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return partial
+
+    def _install(self, object_name, stat, partial, path, meta_path):
+        os.replace(partial, path)
+        meta = {'name': object_name, 'etag': stat.etag, 'size': stat.size, 'fetched_at': time.time()}
+        self._write_meta(meta_path, meta)
+        return meta
+
+    def _fill_in_background(self, object_name, stat):
+        with self._filling_lock:
+            if object_name in self._filling:
+                return
+            self._filling.add(object_name)
+        threading.Thread(target=self._fill, args=(object_name, stat), name='edge-fill', daemon=True).start()
+
+    def _fill(self, object_name, stat):
+        """
+        Fetch a large object into the cache. The object's lock is only held to install
+        it, so requests meanwhile pass through instead of waiting; a lock file of the
+        object's own keeps other processes from filling it too.
+        """
+        path, meta_path, lock_path = self._paths(object_name)
+        fill_lock_path = os.path.join(self.root, LOCKS_DIR, f'{os.path.basename(path)}.fill')
+        try:
+            with _locked(fill_lock_path, blocking=False) as locked:
+                if not locked:
+                    return
+                try:
+                    meta = self._read_meta(meta_path, path)
+                    if meta and meta['etag'] == stat.etag:
+                        return
+                    partial = self._download(object_name, stat, path)
+                    with _locked(lock_path):
+                        self._install(object_name, stat, partial, path, meta_path)
+                finally:
+                    # Unlinked while held: a process that opened it already finds the object cached.
+                    os.remove(fill_lock_path)
+            self._evict()
+        except Exception:
+            logger.exception("Could not fill the edge cache with %s", object_name)
+        finally:
+            with self._filling_lock:
+                self._filling.discard(object_name)
+
+    def _evict(self):
+        with _locked(os.path.join(self.root, LOCK_FILE)):
+            entries = []
+            for entry in os.scandir(self.objects_dir):
+                if entry.name.startswith('.') or entry.name.endswith('.json'):
+                    continue
+                try:
+                    entries.append((entry.path, entry.stat()))
+                except FileNotFoundError:
+                    continue
+            size = sum(st.st_size for _, st in entries)
+            for path, st in sorted(entries, key=lambda e: e[1].st_mtime):
+                if size <= settings.EDGE_DISK_CACHE_SIZE:
+                    break
+                # Skip objects being loaded; waiting could deadlock with their loader's own eviction.
+                with _locked(self._lock_path(os.path.basename(path)), blocking=False) as locked:
+                    if not locked:
+                        continue
+                    # A response already streaming the file keeps reading it after the unlink.
+                    for stale in (path, f'{path}.json'):
+                        try:
+                            os.remove(stale)
+                        except FileNotFoundError:
+                            pass
+                size -= st.st_size
+
+
+class EdgeCache:
+    """
+    The memory tier in front of a DiskCache, plus the coalescing of concurrent misses.
+    Only touched from the event loop; storage and disk work runs in threads.
+    """
+
+    def __init__(self):
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._inflight = {}
+        self._disk = None
+
+    @property
+    def disk(self):
+        if self._disk is None:
+            self._disk = DiskCache(settings.EDGE_CACHE_DIR)
+        return self._disk
+
+    def _remember(self, cached):
+        previous = self._memory.pop(cached.name, None)
+        if previous is not None:
+            self._memory_size -= len(previous.body)
+        self._memory[cached.name] = cached
+        self._memory_size += len(cached.body)
+        while self._memory_size > settings.EDGE_MEMORY_CACHE_SIZE and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted.body)
+
+    def _forget(self, object_name, future):
+        if self._inflight.get(object_name) is future:
+            del self._inflight[object_name]
+
+    def _load(self, object_name, stale):
+        """Fetch or revalidate one object (blocking); returns (CachedObject, result)."""
+        if not is_playlist(object_name):
+            return self.disk.load(object_name)
+        stat = _stat(object_name)
+        if stale is not None and stale.etag == stat.etag:
+            return stale.refreshed(), 'revalidated'
+        chunks = []
+        _read_object(object_name, stat.etag, chunks.append)
+        return CachedObject(object_name, stat.etag, stat.size, time.time(), body=b''.join(chunks)), 'origin'
+
+    async def get(self, object_name):
+        """The object, from memory when fresh, else through one shared fetch. Raises ObjectNotFound."""
+        cached = self._memory.get(object_name)
+        if cached is not None and cached.is_fresh():
+            self._memory.move_to_end(object_name)
+            metrics.EDGE_CACHE_REQUESTS.labels('memory').inc()
+            return cached
+        loop = asyncio.get_running_loop()
+        future = self._inflight.get(object_name)
+        # A sync server runs each async view in a loop of its own, which can't share futures.
+        if future is not None and future.get_loop() is loop:
+            result = 'coalesced'
+            cached, _ = await asyncio.shield(future)
+        else:
+            future = asyncio.ensure_future(
+                sync_to_async(self._load, thread_sensitive=False)(object_name, cached)
+            )
+            self._inflight[object_name] = future
+            future.add_done_callback(lambda f: self._forget(object_name, f))
+            # Shielded: a viewer who disconnects must not cancel the fetch others are waiting on.
+            cached, result = await asyncio.shield(future)
+            if cached.body is not None:
+                self._remember(cached)
+        metrics.EDGE_CACHE_REQUESTS.labels(result).inc()
+        return cached
+
+
+edge_cache = EdgeCache()
+
+
+def byte_range(header, size):
+    """
+    The inclusive (start, end) byte range a Range header asks of a size-byte object, or
+    None to send the whole object: no header, several ranges, or a malformed one, all of
+    which a server may answer with the full content. Raises RangeNotSatisfiable.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    try:
+        if not sep:
+            return None
+        if not first:
+            # A suffix range: the last N bytes.
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+async def _file_chunks(path, start, length):
+    read_chunk = sync_to_async(lambda f, n: f.read(n), thread_sensitive=False)
+    f = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+    try:
+        f.seek(start)
+        while length > 0:
+            data = await read_chunk(f, min(STREAM_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+async def _origin_chunks(cached, start, length):
+    response = await sync_to_async(_open_object, thread_sensitive=False)(cached.name, cached.etag, start, length)
+    chunks = response.stream(STREAM_CHUNK_SIZE)
+    next_chunk = sync_to_async(next, thread_sensitive=False)
+    try:
+        while (data := await next_chunk(chunks, None)) is not None:
+            metrics.EDGE_ORIGIN_BYTES.inc(len(data))
+            yield data
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def edge_response(request, cached):
+    """The response to a GET or HEAD of cached, honouring If-None-Match, If-Range and Range."""
+    etag = f'"{cached.etag}"'
+    max_age = settings.EDGE_PLAYLIST_MAX_AGE if cached.is_playlist else settings.EDGE_SEGMENT_MAX_AGE
+    headers = {'ETag': etag, 'Cache-Control': f'public, max-age={max_age}', 'Accept-Ranges': 'bytes'}
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+        return HttpResponseNotModified(headers=headers)
+
+    content_type = content_type_for(cached.name)
+    if_range = request.headers.get('If-Range')
+    # If-Range: only send a part of the object the client already has the rest of.
+    range_header = request.headers.get('Range') if not if_range or if_range == etag else None
+    try:
+        requested = byte_range(range_header, cached.size)
+    except RangeNotSatisfiable:
+        return HttpResponse(status=416, headers=dict(headers, **{'Content-Range': f'bytes */{cached.size}'}))
+
+    if cached.body is None and cached.path and settings.EDGE_ACCEL_REDIRECT_PREFIX:
+        # nginx serves the file, Range requests included.
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response['X-Accel-Redirect'] = f'{settings.EDGE_ACCEL_REDIRECT_PREFIX.rstrip("/")}/{OBJECTS_DIR}/{os.path.basename(cached.path)}'
+        return response
+
+    start, end = requested or (0, cached.size - 1)
+    length = end - start + 1
+    if cached.body is not None:
+        response = HttpResponse(cached.body[start:end + 1], content_type=content_type, headers=headers)
+    elif cached.path:
+        response = StreamingHttpResponse(_file_chunks(cached.path, start, length), content_type=content_type, headers=headers)
+    else:
+        response = StreamingHttpResponse(_origin_chunks(cached, start, length), content_type=content_type, headers=headers)
+    if requested:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{cached.size}'
+    response['Content-Length'] = str(length)
+    return response
@@ -0,0 +1,84 @@
+import json
+import logging
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_redis = None
+
+
+def video_channel(video_id):
+    return f'video:{video_id}:events'
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.VIDEO_EVENTS_REDIS_URL)
+    return _redis
+
+
+def publish_video_event(video_id, event):
+    """
+    Publish a status/progress event for a video (or one of its audio tracks) to the
+    subscribers of its channel. Events are best effort: a Redis outage must not fail a
+    transcode, so errors are only logged.
+    """
+    try:
+        _get_redis().publish(video_channel(video_id), json.dumps(event))
+    except redis.RedisError as e:
+        logger.warning("Could not publish event for video %s: %s", video_id, e)
+
+
+def video_event(video):
+    return {
+        'type': 'video',
+        'id': video.id,
+        'status': video.status,
+        'progress': video.progress,
+        'eta_seconds': video.eta_seconds,
+    }
+
+
+def audio_track_event(audio_track):
+    return {
+        'type': 'audiotrack',
+        'id': audio_track.id,
+        'language': audio_track.language,
+        'status': audio_track.status,
+        'progress': audio_track.progress,
+        'eta_seconds': audio_track.eta_seconds,
+    }
+
+
+def format_sse(event):
+    return f'data: {json.dumps(event)}\n\n'
+
+
+async def stream_video_events(video_id, snapshot):
+    """
+    Server-sent events for a video: the current snapshot of the video and its audio
+    tracks, then every event published to its channel. Idles on one Redis subscription
+    and sends a comment line every VIDEO_EVENTS_KEEPALIVE seconds so proxies keep the
+    connection open.
+    """
+    for event in snapshot:
+        yield format_sse(event)
+    connection = aioredis.from_url(settings.VIDEO_EVENTS_REDIS_URL)
+    pubsub = connection.pubsub()
+    try:
+        await pubsub.subscribe(video_channel(video_id))
+        while True:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=settings.VIDEO_EVENTS_KEEPALIVE
+            )
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            data = message['data']
+            yield f"data: {data.decode() if isinstance(data, bytes) else data}\n\n"
+    finally:
+        await pubsub.aclose()
+        await connection.aclose()
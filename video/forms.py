@@ -1,12 +1,17 @@
+import os
+import stat
+from urllib.parse import parse_qs, urlsplit
+
 from django import forms
-from .models import Video
+from django.conf import settings
+from .models import LiveStream, Video
 from .utils import create_uuid
 
 
 class VideoUploadForm(forms.ModelForm):
     class Meta:
         model = Video
-        fields = ['title', 'video_file']
+        fields = ['title', 'video_file', 'output_format']
 
     def save(self, commit=True):
         # Create a UUID before saving
@@ -39,4 +44,93 @@ class AudioUploadForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['audio_file'].required = True
\ No newline at end of file
+        self.fields['audio_file'].required = True
+
+
+class UploadSessionForm(forms.Form):
+    """Validates the JSON body that starts a direct multipart upload."""
+    kind = forms.ChoiceField(choices=[('video', 'Video'), ('audio', 'Audio track')])
+    filename = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=1)
+    content_type = forms.CharField(max_length=255, required=False)
+    title = forms.CharField(max_length=255, required=False)
+    output_format = forms.ChoiceField(choices=Video.OUTPUT_FORMATS, required=False)
+    video = forms.ModelChoiceField(queryset=Video.objects.filter(status='completed'), required=False)
+    language = forms.ChoiceField(
+        choices=[(code, get_language_display_name(code)) for code in COMMON_LANGUAGE_CODES],
+        required=False
+    )
+
+    def clean_size(self):
+        size = self.cleaned_data['size']
+        if size > settings.DIRECT_UPLOAD_MAX_SIZE:
+            raise forms.ValidationError(f"Files are limited to {settings.DIRECT_UPLOAD_MAX_SIZE} bytes.")
+        return size
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('kind') == 'video' and not cleaned_data.get('title'):
+            self.add_error('title', "A video needs a title.")
+        if cleaned_data.get('kind') == 'audio':
+            if not cleaned_data.get('video') and 'video' not in self.errors:
+                self.add_error('video', "An audio track needs a transcoded video.")
+            if not cleaned_data.get('language') and 'language' not in self.errors:
+                self.add_error('language', "An audio track needs a language.")
+        return cleaned_data
+
+
+LIVE_INPUT_SCHEMES = ('srt', 'rtmp', 'rtmps')
+
+
+class LiveStreamForm(forms.ModelForm):
+    """Creates a live stream together with the Video it is published as."""
+    title = forms.CharField(max_length=255)
+    # Byte-range output needs the whole rendition written before it can be addressed.
+    output_format = forms.ChoiceField(
+        choices=[(value, label) for value, label in Video.OUTPUT_FORMATS if value != 'single_file'],
+        initial='ts'
+    )
+    language = forms.ChoiceField(
+        choices=[(code, get_language_display_name(code)) for code in COMMON_LANGUAGE_CODES],
+        initial='en'
+    )
+
+    class Meta:
+        model = LiveStream
+        fields = ['input_url', 'source_width', 'source_height', 'language', 'low_latency']
+
+    def clean_input_url(self):
+        input_url = self.cleaned_data['input_url']
+        if input_url.startswith('/'):
+            return self._clean_pipe(input_url)
+        url = urlsplit(input_url)
+        if url.scheme not in LIVE_INPUT_SCHEMES:
+            raise forms.ValidationError("Expected an srt:// or rtmp:// URL, or the absolute path of a named pipe.")
+        if url.scheme == 'srt' and parse_qs(url.query).get('mode') != ['listener']:
+            raise forms.ValidationError("SRT ingest URLs must set mode=listener.")
+        if url.hostname not in settings.LIVE_INGEST_BIND_HOSTS:
+            raise forms.ValidationError(
+                f"Ingest URLs must listen on one of {', '.join(settings.LIVE_INGEST_BIND_HOSTS)}."
+            )
+        return input_url
+
+    def _clean_pipe(self, path):
+        pipe_dir = os.path.realpath(settings.LIVE_INGEST_PIPE_DIR)
+        real_path = os.path.realpath(path)
+        if os.path.commonpath([pipe_dir, real_path]) != pipe_dir:
+            raise forms.ValidationError(f"Named pipes must be under {settings.LIVE_INGEST_PIPE_DIR}.")
+        try:
+            is_fifo = stat.S_ISFIFO(os.stat(real_path).st_mode)
+        except OSError:
+            is_fifo = False
+        if not is_fifo:
+            raise forms.ValidationError(f"{path} is not a named pipe.")
+        return path
+
+    def save(self, commit=True):
+        self.instance.video = Video.objects.create(
+            title=self.cleaned_data['title'],
+            transcoding_uuid=create_uuid(),
+            output_format=self.cleaned_data['output_format'],
+        )
+        return super().save(commit=commit)
@@ -0,0 +1,170 @@
+"""
+Bulk import of a back catalogue, run with `manage.py import_videos`.
+
+Sources never pass through Django. Video objects already under a prefix of the videos
+bucket are registered where they are, and the files of a local directory are uploaded
+straight to storage under IMPORT_KEY_PREFIX. Videos are created with bulk_create a
+batch at a time, and a source that already has a video is skipped, so an interrupted
+import can simply be run again.
+
+Each batch's transcodes are then queued at the lowest priority, at most
+IMPORT_ENQUEUE_RATE a second. The import pauses while the transcode queues hold more
+than IMPORT_MAX_QUEUED messages, so uploads keep flowing however big the import is.
+"""
+import itertools
+import logging
+import os
+import posixpath
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import current_app
+from django.conf import settings
+
+from . import metrics, utils
+from .catalogue import invalidate_catalogue
+from .models import Video
+from .scheduling import MAX_PRIORITY
+from .tasks import schedule_transcode
+from .uploader import upload_file_if_changed
+
+logger = logging.getLogger(__name__)
+
+IMPORT_KEY_PREFIX = 'videos/imports'
+# Where the pipeline writes its own output; never imported, whatever the prefix.
+EXCLUDED_PREFIXES = ('transcoded_videos/', 'audio_tracks/')
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi', '.mpg', '.mpeg', '.mxf')
+TITLE_MAX_LENGTH = Video._meta.get_field('title').max_length
+
+
+def _title(path):
+    return os.path.splitext(os.path.basename(path))[0][:TITLE_MAX_LENGTH] or 'Untitled'
+
+
+def storage_sources(prefix, extensions=VIDEO_EXTENSIONS):
+    """(object key, title, None) for every video object under prefix in the videos bucket."""
+    for obj in utils.client.list_objects('videos', prefix=prefix, recursive=True):
+        key = obj.object_name
+        if key.startswith(EXCLUDED_PREFIXES) or not key.lower().endswith(extensions):
+            continue
+        yield key, _title(key), None
+
+
+def directory_sources(directory, extensions=VIDEO_EXTENSIONS):
+    """
+    (object key, title, local path) for every video file under directory, in a stable
+    order. Keys are IMPORT_KEY_PREFIX/<directory name>/<path within it>, so importing the
+    same directory again finds the videos created the first time.
+    """
+    directory = os.path.abspath(directory)
+    root_name = os.path.basename(directory.rstrip(os.sep))
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if not name.lower().endswith(extensions):
+                continue
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, directory).replace(os.sep, '/')
+            yield posixpath.join(IMPORT_KEY_PREFIX, root_name, relative), _title(name), path
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _upload(sources):
+    """Upload the local files of sources; returns the sources now in storage and the number that failed."""
+    def upload(source):
+        key, _, path = source
+        try:
+            upload_file_if_changed('videos', key, path)
+        except Exception as e:
+            logger.warning("Could not upload %s to %s: %s", path, key, e)
+            return None
+        return source
+
+    with ThreadPoolExecutor(max_workers=settings.MINIO_UPLOAD_CONCURRENCY) as executor:
+        uploaded = [source for source in executor.map(upload, sources) if source]
+    return uploaded, len(sources) - len(uploaded)
+
+
+def wait_for_queue_room(max_queued):
+    """Block while the short and long queues together hold more than max_queued messages."""
+    queues = [settings.TRANSCODE_SHORT_QUEUE, settings.TRANSCODE_LONG_QUEUE]
+    while True:
+        queued = sum(metrics.queue_depths(queues).values())
+        if queued <= max_queued:
+            return
+        logger.info("%d transcodes queued, waiting for room below %d", queued, max_queued)
+        time.sleep(settings.IMPORT_QUEUE_POLL_INTERVAL)
+
+
+def enqueue_transcodes(video_ids, rate):
+    """
+    Queue schedule_transcode for each video at the lowest priority, at most rate a second,
+    publishing over one broker connection. The videos are bulk jobs, so every part of
+    their transcodes is queued at the lowest priority too.
+    """
+    started = time.monotonic()
+    with current_app.producer_or_acquire() as producer:
+        for sent, video_id in enumerate(video_ids):
+            delay = started + sent / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            schedule_transcode.apply_async((video_id,), {'bulk': True}, priority=MAX_PRIORITY, producer=producer)
+
+
+def import_videos(sources, output_format, batch_size=None, rate=None, max_queued=None, requeue_pending=False,
+                  dry_run=False, on_batch=None):
+    """
+    Create a pending video for every source without one and queue its transcode, batch by
+    batch. sources yields (object key, title, local path or None); local files are uploaded
+    first. With requeue_pending, videos an earlier import created but never got to queue
+    (still pending, never probed) are queued again. on_batch(totals) is called after each
+    batch. Returns the totals: sources found, skipped, failed, created and queued.
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    rate = rate or settings.IMPORT_ENQUEUE_RATE
+    max_queued = settings.IMPORT_MAX_QUEUED if max_queued is None else max_queued
+    profile_hash = utils.encoding_profile_hash(output_format)
+    totals = {'found': 0, 'skipped': 0, 'failed': 0, 'created': 0, 'queued': 0}
+    for batch in _batches(sources, batch_size):
+        totals['found'] += len(batch)
+        existing = Video.objects.filter(video_file__in=[key for key, _, _ in batch])
+        imported = set(existing.values_list('video_file', flat=True))
+        new = [source for source in batch if source[0] not in imported]
+        totals['skipped'] += len(batch) - len(new)
+        requeue = list(existing.filter(status='pending', probe__isnull=True).values_list('id', flat=True)) \
+            if requeue_pending else []
+        if dry_run:
+            totals['created'] += len(new)
+            totals['queued'] += len(new) + len(requeue)
+            if on_batch:
+                on_batch(totals)
+            continue
+        local = [source for source in new if source[2]]
+        if local:
+            uploaded, failed = _upload(local)
+            totals['failed'] += failed
+            new = [source for source in new if not source[2]] + uploaded
+        videos = Video.objects.bulk_create([
+            Video(
+                title=title, video_file=key, transcoding_uuid=utils.create_uuid(),
+                output_format=output_format, encoding_profile_hash=profile_hash,
+            )
+            for key, title, _ in new
+        ])
+        totals['created'] += len(videos)
+        if videos:
+            # bulk_create sends no post_save, which is what normally refreshes the catalogue.
+            invalidate_catalogue()
+        video_ids = [video.id for video in videos] + requeue
+        if video_ids:
+            wait_for_queue_room(max_queued)
+            enqueue_transcodes(video_ids, rate)
+            totals['queued'] += len(video_ids)
+        if on_batch:
+            on_batch(totals)
+    return totals
@@ -0,0 +1,25 @@
+import redis
+from django.conf import settings
+
+_redis = None
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.VIDEO_LOCK_REDIS_URL)
+    return _redis
+
+
+def video_lock(video_id, name):
+    """
+    A lock on one resource of a video, shared by every worker process. Use it as a
+    context manager; it raises redis.exceptions.LockError if it cannot be acquired
+    within VIDEO_LOCK_BLOCKING_TIMEOUT seconds, and expires after VIDEO_LOCK_TIMEOUT
+    seconds if its holder dies.
+    """
+    return _get_redis().lock(
+        f'video:{video_id}:{name}:lock',
+        timeout=settings.VIDEO_LOCK_TIMEOUT,
+        blocking_timeout=settings.VIDEO_LOCK_BLOCKING_TIMEOUT,
+    )
@@ -0,0 +1,80 @@
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import get_runner, override_settings
+
+from video.benchmark import SOURCE_CODECS, build_cases, compare_to_baseline, run_benchmark
+from video.models import Video
+
+
+def _resolution(value):
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise CommandError(f"Invalid resolution {value!r}, expected WIDTHxHEIGHT")
+    return width, height
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark transcode_video and transcode_audio_for_video on synthetic sources, offline, "
+        "against a local storage stand-in and a throwaway test database. Prints per-stage "
+        "timings as JSON and optionally fails on regressions against a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, action='append', help="Source duration in seconds (repeatable, default 10 and 60)")
+        parser.add_argument('--resolution', type=_resolution, action='append', help="Source WIDTHxHEIGHT (repeatable, default 1280x720 and 1920x1080)")
+        parser.add_argument('--audio-streams', type=int, action='append', help="Audio streams in the source (repeatable, default 1)")
+        parser.add_argument('--codec', choices=sorted(SOURCE_CODECS), action='append', help="Source codec (repeatable, default mpeg4)")
+        parser.add_argument('--format', choices=[value for value, _ in Video.OUTPUT_FORMATS], action='append', help="HLS output format (repeatable, default ts)")
+        parser.add_argument('--no-audio-track', action='store_true', help="Skip the user-uploaded audio track benchmark")
+        parser.add_argument('--quality', action='store_true', help="Score every rendition against its source (PSNR/SSIM)")
+        parser.add_argument('--no-per-title', action='store_true', help="Encode at the ladder's fixed bitrates, as a reference for per-title runs")
+        parser.add_argument('--output', help="Write the results JSON to this file instead of stdout")
+        parser.add_argument('--baseline', help="Results JSON of an earlier run to compare against")
+        parser.add_argument('--tolerance', type=float, default=0.15, help="Allowed wall-time growth over the baseline (default 0.15)")
+        parser.add_argument('--workdir', help="Keep sources and output in this directory instead of a temporary one")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        cases = build_cases(
+            options['duration'] or [10, 60],
+            options['resolution'] or [(1280, 720), (1920, 1080)],
+            options['audio_streams'] or [1],
+            options['codec'] or ['mpeg4'],
+            options['format'] or ['ts'],
+        )
+        workdir = options['workdir'] or tempfile.mkdtemp(prefix='transcode-benchmark-')
+
+        # Jobs are recorded in a test database so the benchmark never touches real data.
+        runner = get_runner(settings)(verbosity=0)
+        old_config = runner.setup_databases()
+        try:
+            with override_settings(PER_TITLE_ENCODING=settings.PER_TITLE_ENCODING and not options['no_per_title']):
+                results = run_benchmark(
+                    cases, workdir, audio_track=not options['no_audio_track'], quality=options['quality']
+                )
+        finally:
+            runner.teardown_databases(old_config)
+            if not options['workdir']:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            regressions = compare_to_baseline(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError("Regressions against baseline:\n" + '\n'.join(regressions))
+            self.stderr.write(self.style.SUCCESS("No regressions against baseline."))
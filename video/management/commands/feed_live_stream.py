@@ -0,0 +1,55 @@
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def _resolution(value):
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise CommandError(f"Invalid resolution {value!r}, expected WIDTHxHEIGHT")
+    return width, height
+
+
+def _output_format(url):
+    """The container an encoder sends over url's protocol."""
+    if url.startswith(('rtmp://', 'rtmps://')):
+        return 'flv'
+    return 'mpegts'
+
+
+class Command(BaseCommand):
+    help = (
+        "Act as a live encoder: send a synthetic testsrc2/sine stream in real time to a live "
+        "stream's ingest URL, e.g. srt://127.0.0.1:9998 or the path of its named pipe, so the "
+        "live pipeline can be tried end to end on one machine."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help="Ingest URL to connect to (the caller side of the stream's input_url)")
+        parser.add_argument('--duration', type=float, help="Stop after this many seconds (default: until interrupted)")
+        parser.add_argument('--resolution', type=_resolution, default=(1280, 720), help="WIDTHxHEIGHT (default 1280x720)")
+        parser.add_argument('--fps', type=int, default=30)
+        parser.add_argument('--container', help="Container to send (default flv for RTMP, mpegts otherwise)")
+
+    def handle(self, *args, **options):
+        width, height = options['resolution']
+        fps = options['fps']
+        command = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'warning', '-y', '-re',
+            '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}',
+            '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        ]
+        if options['duration']:
+            command += ['-t', str(options['duration'])]
+        command += [
+            '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'zerolatency', '-g', str(fps * 2),
+            '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-f', options['container'] or _output_format(options['url']), options['url'],
+        ]
+        self.stderr.write(f"Streaming {width}x{height}@{fps} to {options['url']}, Ctrl-C to stop")
+        try:
+            subprocess.run(command, check=True)
+        except subprocess.CalledProcessError as e:
+            raise CommandError(f"ffmpeg exited with status {e.returncode}")
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,63 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from video.imports import VIDEO_EXTENSIONS, directory_sources, import_videos, storage_sources
+from video.models import Video, default_output_format
+
+
+class Command(BaseCommand):
+    help = (
+        "Import a back catalogue: create a video for every video file in a local directory "
+        "(uploaded straight to storage) or every video object under a prefix of the videos "
+        "bucket (used in place), skipping sources imported before, and queue their transcodes "
+        "in rate-limited batches."
+    )
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--directory', help="Local directory to import, searched recursively")
+        source.add_argument('--prefix', help="Key prefix in the videos bucket to import in place, e.g. archive/2019/")
+        parser.add_argument('--format', choices=[value for value, _ in Video.OUTPUT_FORMATS], help="HLS output format (default HLS_OUTPUT_FORMAT)")
+        parser.add_argument('--extension', action='append', help=f"File extension to import (repeatable, default {' '.join(VIDEO_EXTENSIONS)})")
+        parser.add_argument('--batch-size', type=int, default=settings.IMPORT_BATCH_SIZE, help="Videos created per batch")
+        parser.add_argument('--rate', type=float, default=settings.IMPORT_ENQUEUE_RATE, help="Transcodes queued per second")
+        parser.add_argument('--max-queued', type=int, default=settings.IMPORT_MAX_QUEUED, help="Pause while the transcode queues hold more messages than this")
+        parser.add_argument(
+            '--requeue-pending', action='store_true',
+            help="Also queue videos an interrupted import created but never queued (pending and never probed). "
+                 "Only use it once that import's transcodes have left the queues."
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Count what would be imported without creating or queueing anything")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['rate'] <= 0:
+            raise CommandError("--batch-size and --rate must be positive")
+        extensions = tuple(
+            f".{extension.lower().lstrip('.')}" for extension in options['extension']
+        ) if options['extension'] else VIDEO_EXTENSIONS
+        if options['directory']:
+            if not os.path.isdir(options['directory']):
+                raise CommandError(f"{options['directory']} is not a directory")
+            sources = directory_sources(options['directory'], extensions)
+        else:
+            sources = storage_sources(options['prefix'], extensions)
+
+        def report(totals):
+            self.stderr.write(
+                "{found} found, {skipped} already imported, {failed} failed, {created} created, {queued} queued".format(**totals)
+            )
+
+        totals = import_videos(
+            sources, options['format'] or default_output_format(),
+            batch_size=options['batch_size'], rate=options['rate'], max_queued=options['max_queued'],
+            requeue_pending=options['requeue_pending'], dry_run=options['dry_run'], on_batch=report,
+        )
+        verb = "would be" if options['dry_run'] else "were"
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['created']} videos {verb} created and {totals['queued']} transcodes {verb} queued "
+            f"({totals['skipped']} already imported, {totals['failed']} failed)"
+        ))
+        if totals['failed']:
+            raise CommandError(f"{totals['failed']} files could not be uploaded; run the import again to retry them")
@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from video.models import Video
+from video.pertitle import quality_report
+from video.scratch import scratch_space
+from video.tasks import get_media_probe
+
+
+class Command(BaseCommand):
+    help = (
+        "Score every rendition of transcoded videos against their sources with ffmpeg's psnr "
+        "and ssim filters and print bandwidth and quality per rendition as JSON, e.g. to compare "
+        "titles encoded with and without PER_TITLE_ENCODING."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('video_ids', nargs='+', type=int, help="IDs of completed videos")
+        parser.add_argument('--output', help="Write the report JSON to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        results = {}
+        for video_id in options['video_ids']:
+            try:
+                video = Video.objects.get(id=video_id)
+            except Video.DoesNotExist:
+                raise CommandError(f"Video {video_id} does not exist")
+            if video.status != 'completed':
+                raise CommandError(f"Video {video_id} is {video.status}, not completed")
+            get_media_probe(video)
+            self.stderr.write(f"Scoring {video.title} ({video_id})")
+            with scratch_space(f'video-{video_id}-quality') as workspace:
+                results[video_id] = {
+                    'title': video.title,
+                    'per_title': (video.encode_decisions or {}).get('per_title'),
+                    'renditions': quality_report(video, workspace),
+                }
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,220 @@
+"""
+Prometheus metrics for the transcode workers and the video views.
+
+Stage timings are recorded per Celery task: the task signals in signals.py start a
+StageRecorder before each task and finish it afterwards, and the pipeline wraps each
+step in stage(). Set PROMETHEUS_MULTIPROC_DIR (to the same directory) for the web
+server and the Celery worker so /metrics aggregates every process on the host.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+STAGE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+STAGE_SECONDS = Histogram(
+    'video_transcode_stage_seconds', 'Wall time of one transcode stage',
+    ['task', 'stage'], buckets=STAGE_BUCKETS,
+)
+STAGE_BYTES = Counter(
+    'video_transcode_stage_bytes', 'Bytes moved by transcode stages', ['task', 'stage'],
+)
+TASK_SECONDS = Histogram(
+    'video_task_seconds', 'Wall time of a Celery task', ['task', 'state'], buckets=STAGE_BUCKETS,
+)
+TASKS_IN_FLIGHT = Gauge(
+    'video_tasks_in_flight', 'Celery tasks currently running', ['task'], multiprocess_mode='livesum',
+)
+TASK_FAILURES = Counter(
+    'video_task_failures', 'Failed Celery tasks by exception type', ['task', 'reason'],
+)
+SOURCE_CACHE_REQUESTS = Counter(
+    'video_source_cache_requests', 'Source fetches served from the worker-local cache or downloaded', ['result'],
+)
+EDGE_CACHE_REQUESTS = Counter(
+    'video_edge_cache_requests', 'Playback requests by the cache tier that answered them', ['result'],
+)
+EDGE_ORIGIN_BYTES = Counter(
+    'video_edge_origin_bytes', 'Bytes the playback edge fetched from storage',
+)
+REQUEST_SECONDS = Histogram(
+    'video_http_request_seconds', 'Latency of the video views until the response starts',
+    ['view', 'method', 'status'], buckets=REQUEST_BUCKETS,
+)
+
+_local = threading.local()
+
+
+def task_label(task_name):
+    return task_name.rsplit('.', 1)[-1]
+
+
+class StageRecorder:
+    """The stages run by one task, plus the job record they are saved on when it finishes."""
+
+    def __init__(self, task_name):
+        self.task = task_label(task_name)
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.job = None
+
+    def add(self, name, seconds, nbytes=0):
+        entry = self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+        entry['seconds'] = round(entry['seconds'] + seconds, 3)
+        entry['bytes'] += nbytes
+        entry['calls'] += 1
+
+
+def _recorders():
+    # A stack, since eagerly applied tasks run inside the task that called them.
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+def current_recorder():
+    recorders = _recorders()
+    return recorders[-1] if recorders else None
+
+
+def start_task(task_name):
+    recorder = StageRecorder(task_name)
+    _recorders().append(recorder)
+    TASKS_IN_FLIGHT.labels(recorder.task).inc()
+    return recorder
+
+
+def finish_task(task_name, state):
+    """Observe the task's duration and save its stage breakdown on the bound job record."""
+    recorders = _recorders()
+    if not recorders:
+        return
+    recorder = recorders.pop()
+    TASKS_IN_FLIGHT.labels(recorder.task).dec()
+    TASK_SECONDS.labels(recorder.task, state or 'UNKNOWN').observe(time.perf_counter() - recorder.started)
+    if recorder.job and recorder.stages:
+        model, pk = recorder.job
+        save_stage_timings(model, pk, recorder.task, recorder.stages)
+
+
+def record_failure(task_name, exception):
+    TASK_FAILURES.labels(task_label(task_name), type(exception).__name__).inc()
+
+
+def bind_job(model, pk):
+    """Save the running task's stage breakdown on model pk's stage_timings when it finishes."""
+    recorder = current_recorder()
+    if recorder is not None:
+        recorder.job = (model, pk)
+
+
+def stage_timings():
+    """The stages recorded so far by the running task, for returning to a chord callback."""
+    recorder = current_recorder()
+    return dict(recorder.stages) if recorder else {}
+
+
+def save_stage_timings(model, pk, task, stages):
+    """Merge one task's stages into the job's stage_timings, keyed by task name."""
+    obj = model.objects.only('stage_timings').get(pk=pk)
+    timings = dict(obj.stage_timings or {}, **{task: stages})
+    model.objects.filter(pk=pk).update(stage_timings=timings)
+
+
+def merge_stage_timings(results):
+    """Sum the stage_timings() returned by several tasks into one breakdown."""
+    merged = {}
+    for stages in results:
+        for name, entry in stages.items():
+            total = merged.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+            total['seconds'] = round(total['seconds'] + entry['seconds'], 3)
+            total['bytes'] += entry['bytes']
+            total['calls'] += entry['calls']
+    return merged
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the body as stage name of the running task. The body may set 'bytes' on the
+    yielded dict to count the bytes the stage moved.
+    """
+    recorder = current_recorder()
+    task = recorder.task if recorder else 'none'
+    info = {'bytes': 0}
+    started = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.labels(task, name).observe(seconds)
+        if info['bytes']:
+            STAGE_BYTES.labels(task, name).inc(info['bytes'])
+        if recorder is not None:
+            recorder.add(name, seconds, info['bytes'])
+
+
+def observe_request(request, response, started):
+    match = request.resolver_match
+    if match is None or 'video' not in match.namespaces:
+        return
+    REQUEST_SECONDS.labels(match.view_name, request.method, response.status_code).observe(
+        time.perf_counter() - started
+    )
+
+
+def _queue_keys(queue):
+    """The Redis lists holding a queue: the queue itself for priority 0, then one per priority step."""
+    options = settings.CELERY_BROKER_TRANSPORT_OPTIONS
+    return [queue] + [f"{queue}{options['sep']}{step}" for step in options['priority_steps'] if step]
+
+
+def queue_depths(queues):
+    """Messages waiting in each of the Celery queues in the Redis broker, by queue name."""
+    client = redis.Redis.from_url(settings.CELERY_BROKER_URL, socket_timeout=1)
+    depths = {}
+    for queue in queues:
+        with client.pipeline() as pipe:
+            for key in _queue_keys(queue):
+                pipe.llen(key)
+            depths[queue] = sum(pipe.execute())
+    return depths
+
+
+class QueueDepthCollector:
+    """Reports the length of each Celery queue in the Redis broker at scrape time."""
+
+    def describe(self):
+        # Keeps registration from querying Redis.
+        return []
+
+    def collect(self):
+        depth = GaugeMetricFamily('video_celery_queue_depth', 'Messages waiting in a Celery queue', labels=['queue'])
+        try:
+            depths = queue_depths(settings.METRICS_CELERY_QUEUES)
+        except redis.RedisError:
+            return
+        for queue, messages in depths.items():
+            depth.add_metric([queue], messages)
+        yield depth
+
+
+def metrics_registry():
+    """The registry to scrape: every process's metrics in multiprocess mode, else this process's."""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(QueueDepthCollector())
+    return registry
+
+
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    REGISTRY.register(QueueDepthCollector())
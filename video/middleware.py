@@ -0,0 +1,22 @@
+import time
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+from .metrics import observe_request
+
+
+@sync_and_async_middleware
+def request_metrics_middleware(get_response):
+    """Record the latency of requests to the video views, up to the start of the response."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.perf_counter()
+            response = await get_response(request)
+            observe_request(request, response, started)
+            return response
+    else:
+        def middleware(request):
+            started = time.perf_counter()
+            response = get_response(request)
+            observe_request(request, response, started)
+            return response
+    return middleware
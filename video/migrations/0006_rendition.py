@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0005_audiotrack_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Ladder rung name, e.g. 720p', max_length=50)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('bandwidth', models.PositiveIntegerField(help_text='Measured peak segment bitrate in bits/s')),
+                ('average_bandwidth', models.PositiveIntegerField(help_text='Measured average bitrate in bits/s')),
+                ('codecs', models.CharField(blank=True, help_text='RFC 6381 codec string, e.g. avc1.640028', max_length=100)),
+                ('playlist', models.CharField(help_text="Path or MinIO key for this rendition's HLS playlist (video_XX_playlist.m3u8)", max_length=500)),
+                ('video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='video.video')),
+            ],
+            options={
+                'ordering': ['-height'],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+def backfill_legacy_renditions(apps, schema_editor):
+    """
+    Videos encoded before the bitrate ladder have a single 2 Mbit/s video_playlist.m3u8.
+    Give them a Rendition row so master playlists rebuilt from the DB keep pointing at it.
+    """
+    Video = apps.get_model('video', 'Video')
+    Rendition = apps.get_model('video', 'Rendition')
+    legacy_videos = Video.objects.filter(transcoded_video__endswith='/video_playlist.m3u8', renditions__isnull=True)
+    Rendition.objects.bulk_create([
+        Rendition(
+            video=video,
+            name='source',
+            width=0,
+            height=0,
+            bandwidth=2000000,
+            average_bandwidth=2000000,
+            codecs='',
+            playlist=video.transcoded_video,
+        )
+        for video in legacy_videos
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0006_rendition'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_legacy_renditions, migrations.RunPython.noop),
+    ]
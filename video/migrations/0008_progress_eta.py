@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0007_backfill_legacy_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotrack',
+            name='eta_seconds',
+            field=models.PositiveIntegerField(blank=True, help_text='Estimated seconds until the current stage finishes', null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='eta_seconds',
+            field=models.PositiveIntegerField(blank=True, help_text='Estimated seconds until the current stage finishes', null=True),
+        ),
+    ]
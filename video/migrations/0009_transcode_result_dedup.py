@@ -0,0 +1,45 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0008_progress_eta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the uploaded source file', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='encoding_profile_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the encoding settings used for this video', max_length=64, null=True),
+        ),
+        migrations.CreateModel(
+            name='TranscodeResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(help_text='SHA-256 of the source file', max_length=64)),
+                ('profile_hash', models.CharField(help_text='SHA-256 of the encoding settings', max_length=64)),
+                ('transcoding_uuid', models.UUIDField(help_text='Folder under transcoded_videos/ holding the HLS tree')),
+                ('master_playlist', models.CharField(max_length=500)),
+                ('transcoded_video', models.CharField(max_length=500)),
+                ('ref_count', models.PositiveIntegerField(default=1, help_text='Number of videos playing from this tree')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('content_hash', 'profile_hash'), name='unique_transcode_result')],
+            },
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='transcode_result',
+            field=models.ForeignKey(blank=True, help_text='Shared HLS tree this video plays from', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='videos', to='video.transcoderesult'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0009_transcode_result_dedup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaProbe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('duration', models.FloatField(help_text='Source duration in seconds')),
+                ('container', models.CharField(help_text='ffprobe format_name, e.g. mov,mp4,m4a,3gp,3g2,mj2', max_length=100)),
+                ('bit_rate', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('size', models.PositiveBigIntegerField(blank=True, help_text='Source size in bytes', null=True)),
+                ('streams', models.JSONField(default=list, help_text='Per-stream index, codec, profile/level, bitrate, resolution, fps, channels and language')),
+                ('keyframes', models.JSONField(blank=True, help_text='Keyframe times (seconds) of the first video stream; filled the first time chunking needs them', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('video', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='probe', to='video.video')),
+            ],
+        ),
+    ]
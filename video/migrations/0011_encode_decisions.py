@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0010_mediaprobe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='encode_decisions',
+            field=models.JSONField(blank=True, help_text="Whether each source stream was remuxed ('copy') or re-encoded ('encode'), and why", null=True),
+        ),
+    ]
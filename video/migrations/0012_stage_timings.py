@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0011_encode_decisions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotrack',
+            name='stage_timings',
+            field=models.JSONField(blank=True, help_text='Seconds and bytes of each transcode stage, keyed by task', null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='stage_timings',
+            field=models.JSONField(blank=True, help_text='Seconds and bytes of each transcode stage, keyed by task', null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:35
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0013_video_catalogue_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('video', 'Video'), ('audio', 'Audio track')], max_length=10)),
+                ('title', models.CharField(blank=True, help_text='Title of the video to create', max_length=255)),
+                ('language', models.CharField(blank=True, help_text='Language of the audio track to create', max_length=100)),
+                ('object_key', models.CharField(help_text='Key the file is assembled under in the videos bucket', max_length=500)),
+                ('upload_id', models.CharField(help_text='Multipart upload id issued by the storage server', max_length=1024)),
+                ('filename', models.CharField(max_length=255)),
+                ('content_type', models.CharField(blank=True, max_length=255)),
+                ('size', models.BigIntegerField(help_text='Total file size in bytes')),
+                ('part_size', models.BigIntegerField(help_text='Size of every part but the last, in bytes')),
+                ('status', models.CharField(choices=[('active', 'Active'), ('completed', 'Completed'), ('aborted', 'Aborted')], default='active', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('video', models.ForeignKey(blank=True, help_text='Video an audio track is being uploaded for', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='video.video')),
+            ],
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+import video.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0014_upload_session'),
+    ]
+
+    operations = [
+        # Everything transcoded so far is MPEG-TS; only new uploads follow HLS_OUTPUT_FORMAT.
+        migrations.AddField(
+            model_name='video',
+            name='output_format',
+            field=models.CharField(
+                choices=[
+                    ('ts', 'MPEG-TS segments'),
+                    ('fmp4', 'fMP4 (CMAF) segments'),
+                    ('single_file', 'One fMP4 file per rendition, addressed by byte range'),
+                ],
+                default='ts',
+                help_text='How the HLS renditions are segmented and stored',
+                max_length=20,
+            ),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='output_format',
+            field=models.CharField(
+                choices=[
+                    ('ts', 'MPEG-TS segments'),
+                    ('fmp4', 'fMP4 (CMAF) segments'),
+                    ('single_file', 'One fMP4 file per rendition, addressed by byte range'),
+                ],
+                default=video.models.default_output_format,
+                help_text='How the HLS renditions are segmented and stored',
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='output_format',
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ('ts', 'MPEG-TS segments'),
+                    ('fmp4', 'fMP4 (CMAF) segments'),
+                    ('single_file', 'One fMP4 file per rendition, addressed by byte range'),
+                ],
+                help_text='Output format of the video to create',
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0015_video_output_format'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='video',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('completed', 'Completed'), ('failed', 'Failed'), ('live', 'Live'), ('ended', 'Ended')], default='pending', help_text='Status of the video transcoding process', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='LiveStream',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('input_url', models.CharField(help_text='Where ffmpeg listens for the encoder: srt://0.0.0.0:9998?mode=listener, rtmp://0.0.0.0:1935/live/<key> or the path of a named pipe', max_length=500)),
+                ('source_width', models.PositiveIntegerField(default=1280, help_text='Width the encoder sends; rungs above it are skipped')),
+                ('source_height', models.PositiveIntegerField(default=720, help_text='Height the encoder sends')),
+                ('language', models.CharField(default='en', help_text='Language of the incoming audio', max_length=100)),
+                ('low_latency', models.BooleanField(default=False, help_text='Publish short segments to cut glass-to-glass latency')),
+                ('stop_requested', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(blank=True, help_text='When the first segments were published', null=True)),
+                ('ended_at', models.DateTimeField(blank=True, null=True)),
+                ('video', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='live_stream', to='video.video')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0016_live_stream'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rendition',
+            name='iframe_only',
+            field=models.BooleanField(default=False, help_text='A trickplay rendition of I-frames only, listed in the master as EXT-X-I-FRAME-STREAM-INF'),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='poster',
+            field=models.CharField(blank=True, help_text='MinIO key (under transcoded_videos/) of the poster frame', max_length=500, null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='thumbnails',
+            field=models.CharField(blank=True, help_text='MinIO key (under transcoded_videos/) of the WebVTT index of the thumbnail sprite sheets', max_length=500, null=True),
+        ),
+    ]
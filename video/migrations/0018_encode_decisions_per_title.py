@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0017_trickplay'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='video',
+            name='encode_decisions',
+            field=models.JSONField(blank=True, help_text="Whether each source stream was remuxed ('copy') or re-encoded ('encode') and why, plus the per-title bitrate analysis", null=True),
+        ),
+    ]
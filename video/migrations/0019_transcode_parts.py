@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video', '0018_encode_decisions_per_title'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscodePart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='video, chunk-<n>, audio or finalize', max_length=50)),
+                ('task', models.CharField(help_text='Name of the Celery task that runs the part', max_length=200)),
+                ('args', models.JSONField(default=list, help_text='Positional arguments the task is sent with')),
+                ('options', models.JSONField(blank=True, default=dict, help_text='apply_async() options the task is sent with, e.g. its priority')),
+                ('status', models.CharField(choices=[('waiting', 'Waiting for the other parts'), ('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0, help_text='Times a worker has started the part')),
+                ('heartbeat_at', models.DateTimeField(blank=True, help_text='Last sign of life from the worker running the part', null=True)),
+                ('result', models.JSONField(blank=True, help_text="What the completed part produced, e.g. a chunk's segments", null=True)),
+                ('video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transcode_parts', to='video.video')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'heartbeat_at'], name='transcode_part_heartbeat_idx')],
+                'constraints': [models.UniqueConstraint(fields=('video', 'name'), name='unique_transcode_part')],
+            },
+        ),
+    ]
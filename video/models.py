@@ -1,6 +1,35 @@
+import math
+import uuid
+from django.conf import settings
 from django.db import models
 from .utils import get_language_display_name
 
+class TranscodeResult(models.Model):
+    """
+    A published HLS tree, shared by every Video whose source content and encoding
+    profile match the video it was first transcoded for.
+    """
+    content_hash = models.CharField(max_length=64, help_text="SHA-256 of the source file")
+    profile_hash = models.CharField(max_length=64, help_text="SHA-256 of the encoding settings")
+    transcoding_uuid = models.UUIDField(help_text="Folder under transcoded_videos/ holding the HLS tree")
+    master_playlist = models.CharField(max_length=500)
+    transcoded_video = models.CharField(max_length=500)
+    ref_count = models.PositiveIntegerField(default=1, help_text="Number of videos playing from this tree")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_hash', 'profile_hash'], name='unique_transcode_result'),
+        ]
+
+    def __str__(self):
+        return f'{self.transcoding_uuid} ({self.ref_count} refs)'
+
+
+def default_output_format():
+    return settings.HLS_OUTPUT_FORMAT
+
+
 class Video(models.Model):
     title = models.CharField(max_length=255)
     video_file = models.FileField(upload_to='videos/')  # Original uploaded video
@@ -20,11 +49,25 @@ class Video(models.Model):
         blank=True,
         help_text="Path or MinIO key for master.m3u8"
     )
+    poster = models.CharField(
+        max_length=500,
+        null=True,
+        blank=True,
+        help_text="MinIO key (under transcoded_videos/) of the poster frame"
+    )
+    thumbnails = models.CharField(
+        max_length=500,
+        null=True,
+        blank=True,
+        help_text="MinIO key (under transcoded_videos/) of the WebVTT index of the thumbnail sprite sheets"
+    )
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('in_progress', 'In Progress'),
         ('completed', 'Completed'),
-        ('failed', 'Failed')
+        ('failed', 'Failed'),
+        ('live', 'Live'),
+        ('ended', 'Ended'),
     ]
 
     status = models.CharField(
@@ -34,11 +77,150 @@ class Video(models.Model):
         help_text="Status of the video transcoding process"
     )
 
+    OUTPUT_FORMATS = [
+        ('ts', 'MPEG-TS segments'),
+        ('fmp4', 'fMP4 (CMAF) segments'),
+        ('single_file', 'One fMP4 file per rendition, addressed by byte range'),
+    ]
+    output_format = models.CharField(
+        max_length=20,
+        choices=OUTPUT_FORMATS,
+        default=default_output_format,
+        help_text="How the HLS renditions are segmented and stored"
+    )
+
     progress = models.PositiveSmallIntegerField(default=0, help_text="Transcoding progress percentage (0-100)")
+    eta_seconds = models.PositiveIntegerField(null=True, blank=True, help_text="Estimated seconds until the current stage finishes")
+
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True, help_text="SHA-256 of the uploaded source file")
+    encoding_profile_hash = models.CharField(max_length=64, null=True, blank=True, help_text="SHA-256 of the encoding settings used for this video")
+    encode_decisions = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Whether each source stream was remuxed ('copy') or re-encoded ('encode') and why, plus the per-title bitrate analysis"
+    )
+    stage_timings = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Seconds and bytes of each transcode stage, keyed by task"
+    )
+    transcode_result = models.ForeignKey(
+        TranscodeResult,
+        null=True,
+        blank=True,
+        related_name='videos',
+        on_delete=models.SET_NULL,
+        help_text="Shared HLS tree this video plays from"
+    )
+
+    class Meta:
+        indexes = [
+            # Serves the catalogue's newest-first keyset pagination.
+            models.Index(fields=['-uploaded_at', '-id'], name='video_catalogue_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @property
+    def output_uuid(self):
+        """Folder under transcoded_videos/ that holds this video's HLS tree."""
+        if self.transcode_result_id:
+            return str(self.transcode_result.transcoding_uuid)
+        return str(self.transcoding_uuid)
+
+
+class MediaProbe(models.Model):
+    """ffprobe metadata of a video's source, probed once and read by every later stage."""
+    video = models.OneToOneField(Video, related_name='probe', on_delete=models.CASCADE)
+    duration = models.FloatField(help_text="Source duration in seconds")
+    container = models.CharField(max_length=100, help_text="ffprobe format_name, e.g. mov,mp4,m4a,3gp,3g2,mj2")
+    bit_rate = models.PositiveBigIntegerField(null=True, blank=True)
+    size = models.PositiveBigIntegerField(null=True, blank=True, help_text="Source size in bytes")
+    streams = models.JSONField(
+        default=list,
+        help_text="Per-stream index, codec, profile/level, bitrate, resolution, fps, channels and language"
+    )
+    keyframes = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Keyframe times (seconds) of the first video stream; filled the first time chunking needs them"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Probe of {self.video.title}'
+
+    @property
+    def video_stream(self):
+        return next((s for s in self.streams if s['codec_type'] == 'video'), None)
+
+    @property
+    def audio_streams(self):
+        return [s for s in self.streams if s['codec_type'] == 'audio']
+
+
+class Rendition(models.Model):
+    video = models.ForeignKey(Video, related_name='renditions', on_delete=models.CASCADE)
+    name = models.CharField(max_length=50, help_text="Ladder rung name, e.g. 720p")
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    bandwidth = models.PositiveIntegerField(help_text="Measured peak segment bitrate in bits/s")
+    average_bandwidth = models.PositiveIntegerField(help_text="Measured average bitrate in bits/s")
+    codecs = models.CharField(max_length=100, blank=True, help_text="RFC 6381 codec string, e.g. avc1.640028")
+    playlist = models.CharField(
+        max_length=500,
+        help_text="Path or MinIO key for this rendition's HLS playlist (video_XX_playlist.m3u8)"
+    )
+    iframe_only = models.BooleanField(
+        default=False,
+        help_text="A trickplay rendition of I-frames only, listed in the master as EXT-X-I-FRAME-STREAM-INF"
+    )
+
+    class Meta:
+        ordering = ['-height']
+
+    def __str__(self):
+        return f'{self.name} - {self.video.title}'
+
+
+class TranscodePart(models.Model):
+    """
+    Checkpoint of one task of a video's transcode: the whole encode ('video'), one chunk
+    ('chunk-<n>'), the audio of a chunked transcode ('audio') or the stitching that ends
+    it ('finalize'). A completed part keeps its result, e.g. the segments a chunk put in
+    storage, so a redelivered task skips it; a running part whose heartbeat stops is sent
+    again by the reaper with the task, arguments and options it records.
+    """
+    STATUS_CHOICES = [
+        ('waiting', 'Waiting for the other parts'),
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    video = models.ForeignKey(Video, related_name='transcode_parts', on_delete=models.CASCADE)
+    name = models.CharField(max_length=50, help_text="video, chunk-<n>, audio or finalize")
+    task = models.CharField(max_length=200, help_text="Name of the Celery task that runs the part")
+    args = models.JSONField(default=list, help_text="Positional arguments the task is sent with")
+    options = models.JSONField(default=dict, blank=True, help_text="apply_async() options the task is sent with, e.g. its priority")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0, help_text="Times a worker has started the part")
+    heartbeat_at = models.DateTimeField(null=True, blank=True, help_text="Last sign of life from the worker running the part")
+    result = models.JSONField(null=True, blank=True, help_text="What the completed part produced, e.g. a chunk's segments")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['video', 'name'], name='unique_transcode_part'),
+        ]
+        indexes = [
+            # Serves the reaper's scan for running parts with a stale heartbeat.
+            models.Index(fields=['status', 'heartbeat_at'], name='transcode_part_heartbeat_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} of video {self.video_id} ({self.status})'
+
 
 class AudioTrack(models.Model):
     video = models.ForeignKey(Video, related_name='audio_tracks', on_delete=models.CASCADE)
@@ -73,6 +255,12 @@ class AudioTrack(models.Model):
         help_text="Status of the audio transcoding process"
     )
     progress = models.PositiveSmallIntegerField(default=0, help_text="Audio transcoding progress percentage (0-100)")
+    eta_seconds = models.PositiveIntegerField(null=True, blank=True, help_text="Estimated seconds until the current stage finishes")
+    stage_timings = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Seconds and bytes of each transcode stage, keyed by task"
+    )
 
     def __str__(self):
         return f'{self.language} - {self.video.title}'
@@ -80,3 +268,80 @@ class AudioTrack(models.Model):
     @property
     def display_language(self):
         return get_language_display_name(self.language)
+
+
+class UploadSession(models.Model):
+    """
+    A resumable multipart upload of a video or audio track file straight to storage.
+    The parts themselves are tracked by the storage server; the Video or AudioTrack
+    is only created once the upload is completed.
+    """
+    KIND_CHOICES = [
+        ('video', 'Video'),
+        ('audio', 'Audio track'),
+    ]
+    STATUS_CHOICES = [
+        ('active', 'Active'),
+        ('completed', 'Completed'),
+        ('aborted', 'Aborted'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    title = models.CharField(max_length=255, blank=True, help_text="Title of the video to create")
+    output_format = models.CharField(
+        max_length=20, choices=Video.OUTPUT_FORMATS, blank=True, help_text="Output format of the video to create"
+    )
+    video = models.ForeignKey(
+        Video,
+        null=True,
+        blank=True,
+        related_name='upload_sessions',
+        on_delete=models.CASCADE,
+        help_text="Video an audio track is being uploaded for"
+    )
+    language = models.CharField(max_length=100, blank=True, help_text="Language of the audio track to create")
+    object_key = models.CharField(max_length=500, help_text="Key the file is assembled under in the videos bucket")
+    upload_id = models.CharField(max_length=1024, help_text="Multipart upload id issued by the storage server")
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255, blank=True)
+    size = models.BigIntegerField(help_text="Total file size in bytes")
+    part_size = models.BigIntegerField(help_text="Size of every part but the last, in bytes")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.kind} upload {self.filename} ({self.status})'
+
+    @property
+    def part_count(self):
+        return max(1, math.ceil(self.size / self.part_size))
+
+    def expected_part_size(self, part_number):
+        if part_number < self.part_count:
+            return self.part_size
+        return self.size - self.part_size * (self.part_count - 1)
+
+
+class LiveStream(models.Model):
+    """
+    A live event ingested by one long-running ffmpeg process and published as a rolling
+    HLS window under its video's transcoding_uuid. The video is 'live' while segments
+    flow and 'ended' once the encoder disconnects or the stream is stopped.
+    """
+    video = models.OneToOneField(Video, related_name='live_stream', on_delete=models.CASCADE)
+    input_url = models.CharField(
+        max_length=500,
+        help_text="Where ffmpeg listens for the encoder: srt://0.0.0.0:9998?mode=listener, "
+                  "rtmp://0.0.0.0:1935/live/<key> or the path of a named pipe"
+    )
+    source_width = models.PositiveIntegerField(default=1280, help_text="Width the encoder sends; rungs above it are skipped")
+    source_height = models.PositiveIntegerField(default=720, help_text="Height the encoder sends")
+    language = models.CharField(max_length=100, default='en', help_text="Language of the incoming audio")
+    low_latency = models.BooleanField(default=False, help_text="Publish short segments to cut glass-to-glass latency")
+    stop_requested = models.BooleanField(default=False)
+    started_at = models.DateTimeField(null=True, blank=True, help_text="When the first segments were published")
+    ended_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Live stream of {self.video.title}'
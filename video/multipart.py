@@ -0,0 +1,91 @@
+"""
+Direct-to-storage multipart uploads. Browsers PUT each part to a presigned URL, so
+the web process only ever handles small JSON calls; the storage server keeps track
+of the parts it has, which is what makes an interrupted upload resumable.
+"""
+import math
+import os
+import uuid
+
+import boto3
+from botocore.config import Config
+from django.conf import settings
+from django.utils.text import get_valid_filename
+
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+
+_s3 = None
+
+
+def _get_s3():
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.client(
+            's3',
+            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region_name=settings.AWS_S3_REGION_NAME,
+            config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}),
+        )
+    return _s3
+
+
+def part_size_for(size):
+    """DIRECT_UPLOAD_PART_SIZE, grown as needed to keep within S3's 10,000 part limit."""
+    part_size = max(settings.DIRECT_UPLOAD_PART_SIZE, S3_MIN_PART_SIZE)
+    return max(part_size, math.ceil(size / S3_MAX_PARTS))
+
+
+def object_key_for(kind, filename):
+    """A fresh key under the prefix the upload forms use, keeping the (sanitised) file name."""
+    prefix = 'videos' if kind == 'video' else 'audio_tracks'
+    return f'{prefix}/{uuid.uuid4().hex}/{get_valid_filename(os.path.basename(filename)) or "upload"}'
+
+
+def start_upload(object_key, content_type):
+    response = _get_s3().create_multipart_upload(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=object_key,
+        ContentType=content_type or 'application/octet-stream',
+    )
+    return response['UploadId']
+
+
+def presign_part(object_key, upload_id, part_number):
+    return _get_s3().generate_presigned_url(
+        'upload_part',
+        Params={
+            'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
+            'Key': object_key,
+            'UploadId': upload_id,
+            'PartNumber': part_number,
+        },
+        ExpiresIn=settings.DIRECT_UPLOAD_URL_EXPIRY,
+    )
+
+
+def list_uploaded_parts(object_key, upload_id):
+    """Every part the storage server has received, as {'part_number', 'etag', 'size'} dicts."""
+    paginator = _get_s3().get_paginator('list_parts')
+    parts = []
+    for page in paginator.paginate(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=object_key, UploadId=upload_id):
+        parts.extend(
+            {'part_number': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']}
+            for part in page.get('Parts', [])
+        )
+    return parts
+
+
+def complete_upload(object_key, upload_id, parts):
+    _get_s3().complete_multipart_upload(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=object_key,
+        UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': p['part_number'], 'ETag': p['etag']} for p in parts]},
+    )
+
+
+def abort_upload(object_key, upload_id):
+    _get_s3().abort_multipart_upload(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=object_key, UploadId=upload_id)
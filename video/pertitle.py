@@ -0,0 +1,199 @@
+"""
+Per-title encoding. A slideshow needs a fraction of the bits a sports clip needs to look
+the same, so rather than encoding every title at the ladder's fixed bitrates, a few short
+scenes sampled across the title are first encoded at PER_TITLE_CRF for every rung. The
+bitrate constant quality took on the samples measures how complex the title is, and each
+rung is encoded at that bitrate plus PER_TITLE_HEADROOM, within PER_TITLE_MIN_BITRATE_RATIO
+and PER_TITLE_MAX_BITRATE_RATIO of the ladder's own.
+
+quality_report() scores a transcoded title's renditions against its source with ffmpeg's
+psnr and ssim filters, to check that smaller encodes keep their quality.
+"""
+import os
+import posixpath
+import re
+import subprocess
+
+from django.conf import settings
+
+from . import utils
+
+TRANSCODED_PREFIX = 'transcoded_videos'
+
+PSNR_PATTERN = re.compile(r'PSNR .*average:(\S+)')
+SSIM_PATTERN = re.compile(r'SSIM .*All:(\S+)')
+
+
+def sample_windows(duration, count, length, max_fraction=1):
+    """
+    (start, length) of up to count scenes of length seconds, one in the middle of each of
+    as many equal stretches of the title, covering at most max_fraction of it. A title
+    shorter than one sample is sampled whole.
+    """
+    count = max(1, min(count, int(duration * max_fraction / length)))
+    if duration <= count * length:
+        return [(0, duration)]
+    step = duration / count
+    return [(round(step * idx + (step - length) / 2, 3), length) for idx in range(count)]
+
+
+def _probe_encode_command(source, windows, ladder, output_folder):
+    """One ffmpeg run encoding the concatenated samples at PER_TITLE_CRF for every rung, to raw H.264 files."""
+    command = ['ffmpeg', '-y', '-loglevel', 'error']
+    for start, length in windows:
+        command += ['-ss', str(start), '-t', str(length), '-i', source]
+    inputs = ''.join(f'[{idx}:v:0]' for idx in range(len(windows)))
+    splits = ''.join(f'[s{idx}]' for idx in range(len(ladder)))
+    filters = [f'{inputs}concat=n={len(windows)}:v=1:a=0,split={len(ladder)}{splits}']
+    filters += [f"[s{idx}]scale={rung['width']}:{rung['height']}[p{idx}]" for idx, rung in enumerate(ladder)]
+    command += ['-filter_complex', ';'.join(filters)]
+    for idx, rung in enumerate(ladder):
+        command += [
+            '-map', f'[p{idx}]', '-c:v', 'libx264', '-preset', settings.PER_TITLE_PROBE_PRESET,
+            '-crf', str(settings.PER_TITLE_CRF), '-profile:v', rung['profile'], '-pix_fmt', 'yuv420p',
+            # A raw bitstream, so the file size is the video's bits alone.
+            '-f', 'h264', os.path.join(output_folder, f"{rung['name']}.h264"),
+        ]
+    return command
+
+
+def analyze_complexity(source, duration, ladder, output_folder):
+    """
+    Encode scenes sampled from source at PER_TITLE_CRF for every rung of ladder, in
+    output_folder. Returns the samples, the CRF and the bitrate (bits/s) each rung needed.
+    """
+    windows = sample_windows(
+        duration, settings.PER_TITLE_SAMPLE_COUNT, settings.PER_TITLE_SAMPLE_DURATION,
+        settings.PER_TITLE_MAX_SAMPLED_FRACTION
+    )
+    utils.run_ffmpeg(_probe_encode_command(source, windows, ladder, output_folder))
+    sampled = sum(length for _, length in windows)
+    return {
+        'crf': settings.PER_TITLE_CRF,
+        'samples': windows,
+        'bitrates': {
+            rung['name']: int(os.path.getsize(os.path.join(output_folder, f"{rung['name']}.h264")) * 8 / sampled)
+            for rung in ladder
+        },
+    }
+
+
+def per_title_ladder(ladder, analysis):
+    """
+    The ladder with each rung's bitrate set to what the title needed at constant quality
+    plus PER_TITLE_HEADROOM, within PER_TITLE_MIN_BITRATE_RATIO and PER_TITLE_MAX_BITRATE_RATIO
+    of the rung's configured bitrate. maxrate and bufsize keep their ratio to the bitrate.
+    """
+    rungs = []
+    for rung in ladder:
+        needed = analysis['bitrates'][rung['name']] * (1 + settings.PER_TITLE_HEADROOM)
+        low = rung['bitrate'] * settings.PER_TITLE_MIN_BITRATE_RATIO
+        high = rung['bitrate'] * settings.PER_TITLE_MAX_BITRATE_RATIO
+        scale = min(high, max(low, needed)) / rung['bitrate']
+        rungs.append(dict(
+            rung,
+            bitrate=int(rung['bitrate'] * scale),
+            maxrate=int(rung['maxrate'] * scale),
+            bufsize=int(rung['bufsize'] * scale),
+        ))
+    return rungs
+
+
+def per_title_decisions(analysis, ladder):
+    """What to record on the video: the analysis and the rates each rung was given."""
+    return dict(analysis, rungs={
+        rung['name']: {key: rung[key] for key in ('bitrate', 'maxrate', 'bufsize')} for rung in ladder
+    })
+
+
+def measure_quality(reference, distorted, width, height):
+    """
+    PSNR (average, in dB) and SSIM of distorted against reference, both anything ffmpeg
+    can read, after scaling distorted up to the reference's width x height as a player would.
+    """
+    graph = (
+        f'[0:v]scale={width}:{height}:flags=bicubic,setpts=PTS-STARTPTS[distorted];'
+        '[1:v]setpts=PTS-STARTPTS,split[ref0][ref1];'
+        '[distorted][ref0]psnr[scored];[scored][ref1]ssim'
+    )
+    command = ['ffmpeg', '-hide_banner', '-nostats', '-i', distorted, '-i', reference, '-lavfi', graph, '-f', 'null', '-']
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+    psnr, ssim = PSNR_PATTERN.search(result.stderr), SSIM_PATTERN.search(result.stderr)
+    if not psnr or not ssim:
+        raise ValueError(f"No PSNR/SSIM summary in ffmpeg's output for {distorted}")
+    return {'psnr': round(float(psnr.group(1)), 3), 'ssim': round(float(ssim.group(1)), 5)}
+
+
+def _read_range(path, byterange):
+    with open(path, 'rb') as f:
+        if byterange is None:
+            return f.read()
+        length, offset = byterange
+        f.seek(offset)
+        return f.read(length)
+
+
+def download_rendition(playlist_key, folder):
+    """
+    Download a rendition (its playlist is a key under transcoded_videos/) into folder and
+    join its segments into files ffmpeg can read back to back: one per init section, which
+    starts it, or a single one for MPEG-TS. ffmpeg's HLS demuxer stops at the first new
+    init section of a stitched chunked playlist, so it can't read the playlist itself.
+    Returns the path of an ffconcat list of the files.
+    """
+    prefix = posixpath.join(TRANSCODED_PREFIX, posixpath.dirname(playlist_key))
+    objects = os.path.join(folder, 'objects')
+    os.makedirs(objects, exist_ok=True)
+    playlist_path = os.path.join(objects, posixpath.basename(playlist_key))
+    utils.download_file_from_minio('videos', posixpath.join(TRANSCODED_PREFIX, playlist_key), playlist_path)
+    segments = utils.parse_hls_playlist(playlist_path)
+    uris = {segment['uri'] for segment in segments} | {segment['map']['uri'] for segment in segments if segment['map']}
+    for uri in uris:
+        utils.download_file_from_minio('videos', posixpath.join(prefix, uri), os.path.join(objects, uri))
+    parts = []
+    for segment in segments:
+        if not parts or segment['map'] != parts[-1][0]:
+            parts.append((segment['map'], []))
+        parts[-1][1].append(segment)
+    names = []
+    for init_section, part_segments in parts:
+        name = f"part_{len(names)}.{'mp4' if init_section else 'ts'}"
+        with open(os.path.join(folder, name), 'wb') as f:
+            if init_section:
+                f.write(_read_range(os.path.join(objects, init_section['uri']), init_section['byterange']))
+            for segment in part_segments:
+                f.write(_read_range(os.path.join(objects, segment['uri']), segment['byterange']))
+        names.append(name)
+    concat_path = os.path.join(folder, 'rendition.ffconcat')
+    with open(concat_path, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        f.writelines(f"file '{name}'\n" for name in names)
+    return concat_path
+
+
+def quality_report(video, workspace):
+    """
+    Score every rendition of a transcoded video (I-frame renditions aside) against its
+    source, downloaded into workspace (a Scratch). Returns one entry per rendition with
+    its resolution, measured bandwidths, PSNR and SSIM.
+    """
+    video_stream = video.probe.video_stream
+    source_key = video.video_file.name
+    source = workspace.source(
+        'videos', source_key, lambda path: utils.download_file_from_minio('videos', source_key, path)
+    )
+    report = []
+    for rendition in video.renditions.filter(iframe_only=False):
+        folder = workspace.dir('renditions', rendition.name)
+        rendition_path = download_rendition(rendition.playlist, folder)
+        report.append({
+            'name': rendition.name,
+            'width': rendition.width,
+            'height': rendition.height,
+            'bandwidth': rendition.bandwidth,
+            'average_bandwidth': rendition.average_bandwidth,
+            **measure_quality(source, rendition_path, *utils.display_size(video_stream)),
+        })
+    return report
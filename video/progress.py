@@ -0,0 +1,70 @@
+import time
+from django.conf import settings
+from .events import publish_video_event
+
+
+class ProgressReporter:
+    """
+    Coalesces progress writes for a Video or AudioTrack row.
+
+    Each stage of a task owns a [start, end] slice of the 0-100 progress bar and reports
+    its own 0.0-1.0 fraction. A write happens at most once every PROGRESS_MIN_INTERVAL
+    seconds unless progress moved by PROGRESS_MIN_STEP percent, and it only touches the
+    progress/eta_seconds columns, so a concurrent task's writes to other columns survive.
+    Every write is also published on the video's event channel.
+    """
+
+    def __init__(self, model, obj_id, progress=0, video_id=None):
+        self.model = model
+        self.obj_id = obj_id
+        self.video_id = video_id or obj_id
+        self.progress = progress
+        self.eta_seconds = None
+        self.start = progress
+        self.end = progress
+        self._last_write = 0.0
+        self._written_progress = progress
+
+    def stage(self, start, end):
+        """Begin a stage covering [start, end] of the progress bar."""
+        self.start = start
+        self.end = end
+        self.update(0.0, force=True)
+        return self
+
+    def update(self, fraction, eta_seconds=None, force=False):
+        fraction = min(max(fraction, 0.0), 1.0)
+        progress = max(self.progress, self.start + int((self.end - self.start) * fraction))
+        self.progress = progress
+        self.eta_seconds = eta_seconds
+        now = time.monotonic()
+        moved = progress - self._written_progress
+        if not force and (moved <= 0 or (moved < settings.PROGRESS_MIN_STEP and now - self._last_write < settings.PROGRESS_MIN_INTERVAL)):
+            return
+        self._last_write = now
+        self._written_progress = progress
+        self.write(progress, eta_seconds)
+
+    def write(self, progress, eta_seconds):
+        eta_seconds = int(eta_seconds) if eta_seconds is not None else None
+        self.model.objects.filter(id=self.obj_id).update(progress=progress, eta_seconds=eta_seconds)
+        publish_video_event(self.video_id, {
+            'type': self.model._meta.model_name,
+            'id': self.obj_id,
+            'progress': progress,
+            'eta_seconds': eta_seconds,
+        })
+
+    def download_callback(self):
+        """Callback for download_file_from_minio that advances the current stage."""
+        def callback(done, total, bytes_per_second):
+            eta_seconds = (total - done) / bytes_per_second if bytes_per_second else None
+            self.update(done / total if total else 1.0, eta_seconds)
+        return callback
+
+    def ffmpeg_callback(self, duration):
+        """Callback for run_ffmpeg: percent complete from out_time against the probed duration."""
+        def callback(out_time, speed):
+            eta_seconds = (duration - out_time) / speed if speed else None
+            self.update(out_time / duration if duration else 0.0, eta_seconds)
+        return callback
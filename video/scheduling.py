@@ -0,0 +1,40 @@
+"""
+Cost-aware routing of transcode jobs. A video's cost is its probed duration scaled by
+its resolution, in 1080p-seconds; cheap jobs go to the short queue and expensive ones
+to the long queue, and within a queue cheaper jobs get a better Celery priority. With
+the Redis broker priority 0 is served first.
+"""
+import math
+
+from django.conf import settings
+
+REFERENCE_PIXELS = 1920 * 1080
+MAX_PRIORITY = 9
+
+
+def transcode_cost(probe):
+    """Seconds of 1080p-equivalent video the job has to encode."""
+    video_stream = probe.video_stream or {}
+    pixels = (video_stream.get('width') or 0) * (video_stream.get('height') or 0)
+    return (probe.duration or 0) * pixels / REFERENCE_PIXELS
+
+
+def transcode_queue(cost):
+    if cost >= settings.TRANSCODE_LONG_QUEUE_MIN_COST:
+        return settings.TRANSCODE_LONG_QUEUE
+    return settings.TRANSCODE_SHORT_QUEUE
+
+
+def transcode_priority(cost):
+    """0 for jobs under TRANSCODE_PRIORITY_COST_UNIT, one step worse per doubling, capped at 9."""
+    return min(MAX_PRIORITY, int(math.log2(1 + cost / settings.TRANSCODE_PRIORITY_COST_UNIT)))
+
+
+def transcode_route(probe, bulk=False):
+    """
+    apply_async() options placing a transcode of the probed source. A bulk job, e.g. one
+    of a back-catalogue import, keeps its queue but gets the lowest priority whatever it
+    costs, so it never holds up an upload.
+    """
+    cost = transcode_cost(probe)
+    return {'queue': transcode_queue(cost), 'priority': MAX_PRIORITY if bulk else transcode_priority(cost)}
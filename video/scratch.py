@@ -0,0 +1,282 @@
+"""
+Per-task scratch space for the transcode workers.
+
+Every task works in its own directory, removed when the task ends however it ends.
+Jobs whose estimated footprint fits TRANSCODE_SCRATCH_TMPFS_BUDGET run on the tmpfs
+TRANSCODE_SCRATCH_TMPFS_DIR, the rest under TRANSCODE_SCRATCH_DIR. A directory reserves
+its expected size up front, and all the worker processes on a host keep each volume
+within its budget: they evict cached sources first, then wait for other tasks to finish.
+
+Downloaded sources are kept in an LRU cache on the disk volume keyed by object ETag, so
+a retry or a follow-up job on the same file skips the download. Cached files are hard
+linked into the task directories that use them, so evicting one never pulls a file out
+from under a running ffmpeg.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+TASKS_DIR = 'tasks'
+CACHE_DIR = 'sources'
+LOCK_FILE = '.lock'
+META_FILE = '.scratch.json'
+WAIT_INTERVAL = 5  # seconds between attempts to reserve space
+
+
+class ScratchSpaceExhausted(Exception):
+    """A task could not reserve its scratch space within TRANSCODE_SCRATCH_WAIT_TIMEOUT."""
+
+
+@contextmanager
+def _locked(root):
+    """Serialise scratch accounting across the worker processes sharing root."""
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_meta(task_dir):
+    try:
+        with open(os.path.join(task_dir, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(task_dir, meta):
+    with open(os.path.join(task_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _tree_size(path, seen):
+    """Bytes under path, counting each inode once since cached sources are hard linked."""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+    return total
+
+
+def _usage(root):
+    """
+    Bytes used or reserved under root: each task directory counts as the larger of its
+    reservation and its contents. Directories of processes that died are removed.
+    """
+    seen = set()
+    total = 0
+    tasks_root = os.path.join(root, TASKS_DIR)
+    if os.path.isdir(tasks_root):
+        for entry in os.scandir(tasks_root):
+            meta = _read_meta(entry.path)
+            if meta is None or not _process_alive(meta['pid']):
+                logger.warning("Removing scratch directory %s left behind by a dead task", entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            total += max(meta['reserved'], _tree_size(entry.path, seen))
+    return total + _tree_size(os.path.join(root, CACHE_DIR), seen)
+
+
+def _cache_entries(root):
+    """Cached sources, least recently used first, as (path, stat) pairs."""
+    cache_dir = os.path.join(root, CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith('.'):
+            continue
+        try:
+            entries.append((entry.path, entry.stat()))
+        except FileNotFoundError:
+            continue
+    return sorted(entries, key=lambda e: e[1].st_mtime)
+
+
+def _within_budget(root, budget):
+    """Whether root's usage fits budget, evicting cached sources nobody is using to make it fit."""
+    usage = _usage(root)
+    for path, st in _cache_entries(root):
+        if usage <= budget:
+            break
+        # Still linked into a task directory: removing it would free nothing yet.
+        if st.st_nlink > 1:
+            continue
+        logger.info("Evicting cached source %s (%d bytes) to stay within the scratch budget", path, st.st_size)
+        os.remove(path)
+        usage -= st.st_size
+    return usage <= budget
+
+
+def _create_task_dir(root, name, reserved):
+    task_dir = os.path.join(root, TASKS_DIR, f'{name}-{uuid.uuid4().hex[:8]}')
+    os.makedirs(task_dir)
+    _write_meta(task_dir, {'pid': os.getpid(), 'reserved': reserved})
+    return task_dir
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # tmpfs task directories live on another filesystem than the cache.
+        shutil.copyfile(src, dst)
+
+
+def _cache_key(etag):
+    return etag.strip('"').replace('/', '_')
+
+
+class Scratch:
+    """One task's scratch directory; use scratch_space() to get one."""
+
+    def __init__(self, root, budget, path):
+        self.root = root
+        self.budget = budget
+        self.path = path
+        self.downloaded_bytes = 0
+
+    def dir(self, *parts):
+        """A subdirectory of the task's scratch space, created if needed."""
+        path = os.path.join(self.path, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def reserve(self, nbytes):
+        """
+        Grow the task's reservation to nbytes, waiting up to TRANSCODE_SCRATCH_WAIT_TIMEOUT
+        for room in the budget. Raises ScratchSpaceExhausted if none frees up.
+        """
+        deadline = time.monotonic() + settings.TRANSCODE_SCRATCH_WAIT_TIMEOUT
+        while True:
+            with _locked(self.root):
+                meta = _read_meta(self.path)
+                if nbytes <= meta['reserved']:
+                    return
+                previous = meta['reserved']
+                _write_meta(self.path, dict(meta, reserved=nbytes))
+                if _within_budget(self.root, self.budget):
+                    return
+                _write_meta(self.path, dict(meta, reserved=previous))
+            if time.monotonic() >= deadline:
+                raise ScratchSpaceExhausted(
+                    f"No room for {nbytes} bytes in {self.root} (budget {self.budget} bytes) "
+                    f"after {settings.TRANSCODE_SCRATCH_WAIT_TIMEOUT}s"
+                )
+            time.sleep(WAIT_INTERVAL)
+
+    def source(self, bucket_name, file_key, download, filename=None):
+        """
+        A local copy of the object in the task's directory, taken from the source cache
+        when it holds the object's current ETag. Otherwise download(path) fetches it and
+        the result is added to the cache. downloaded_bytes says what was actually fetched.
+        """
+        path = os.path.join(self.path, filename or os.path.basename(file_key))
+        stat = utils.client.stat_object(bucket_name, file_key)
+        cache_dir = os.path.join(settings.TRANSCODE_SCRATCH_DIR, CACHE_DIR)
+        cached = os.path.join(cache_dir, _cache_key(stat.etag)) if stat.etag else None
+        if cached:
+            try:
+                _link_or_copy(cached, path)
+            except FileNotFoundError:
+                pass
+            else:
+                # The cache is LRU by modification time.
+                os.utime(cached)
+                metrics.SOURCE_CACHE_REQUESTS.labels('hit').inc()
+                logger.info("Using cached source for %s", file_key)
+                return path
+        metrics.SOURCE_CACHE_REQUESTS.labels('miss').inc()
+        self.reserve(stat.size * settings.TRANSCODE_SCRATCH_SIZE_FACTOR)
+        download(path)
+        self.downloaded_bytes += os.path.getsize(path)
+        # Only cache what is still the current object; it may have been replaced meanwhile.
+        if cached and utils.client.stat_object(bucket_name, file_key).etag == stat.etag:
+            _add_to_cache(path, cached)
+        return path
+
+
+def _add_to_cache(path, cached):
+    cache_dir = os.path.dirname(cached)
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = os.path.join(cache_dir, f'.{os.path.basename(cached)}.{uuid.uuid4().hex[:8]}')
+    try:
+        _link_or_copy(path, partial)
+        os.replace(partial, cached)
+    except OSError as e:
+        logger.warning("Could not cache source %s: %s", path, e)
+        if os.path.exists(partial):
+            os.remove(partial)
+        return
+    with _locked(settings.TRANSCODE_SCRATCH_DIR):
+        entries = _cache_entries(settings.TRANSCODE_SCRATCH_DIR)
+        size = sum(st.st_size for _, st in entries)
+        for entry_path, st in entries:
+            if size <= settings.TRANSCODE_SOURCE_CACHE_MAX_SIZE:
+                break
+            os.remove(entry_path)
+            size -= st.st_size
+
+
+def _tmpfs_task_dir(name, estimate):
+    """A task directory on the tmpfs volume reserving estimate bytes, or None if it doesn't fit."""
+    root = settings.TRANSCODE_SCRATCH_TMPFS_DIR
+    budget = settings.TRANSCODE_SCRATCH_TMPFS_BUDGET
+    if not root or not 0 < estimate <= budget:
+        return None
+    with _locked(root):
+        if _usage(root) + estimate > budget or estimate > shutil.disk_usage(root).free:
+            return None
+        return _create_task_dir(root, name, estimate)
+
+
+@contextmanager
+def scratch_space(name, estimate=0):
+    """
+    An isolated scratch directory for one task, named after name and removed on exit.
+    estimate is the task's expected footprint in bytes: jobs that fit go on tmpfs, and
+    the space is reserved before the body runs.
+    """
+    task_dir = _tmpfs_task_dir(name, estimate)
+    if task_dir:
+        scratch = Scratch(settings.TRANSCODE_SCRATCH_TMPFS_DIR, settings.TRANSCODE_SCRATCH_TMPFS_BUDGET, task_dir)
+    else:
+        root = settings.TRANSCODE_SCRATCH_DIR
+        with _locked(root):
+            task_dir = _create_task_dir(root, name, 0)
+        scratch = Scratch(root, settings.TRANSCODE_SCRATCH_BUDGET, task_dir)
+    try:
+        scratch.reserve(estimate)
+        yield scratch
+    finally:
+        shutil.rmtree(task_dir, ignore_errors=True)
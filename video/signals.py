@@ -0,0 +1,69 @@
+import os
+from celery.signals import task_failure, task_postrun, task_prerun, worker_process_shutdown
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from prometheus_client import multiprocess
+from . import metrics
+from .catalogue import invalidate_catalogue
+from .dedup import release_transcode_result
+from .events import publish_video_event, video_event, audio_track_event
+from .models import Video, AudioTrack
+
+
+@receiver(post_save, sender=Video)
+def publish_video_saved(sender, instance, **kwargs):
+    publish_video_event(instance.id, video_event(instance))
+
+
+@receiver(post_save, sender=AudioTrack)
+def publish_audio_track_saved(sender, instance, **kwargs):
+    publish_video_event(instance.video_id, audio_track_event(instance))
+
+
+@receiver(post_delete, sender=Video)
+def release_shared_transcode(sender, instance, **kwargs):
+    if instance.transcode_result_id:
+        release_transcode_result(instance.transcode_result_id)
+
+
+def _saves_status(update_fields):
+    return update_fields is None or 'status' in update_fields
+
+
+@receiver(post_save, sender=Video)
+def invalidate_catalogue_on_video_change(sender, instance, created, update_fields=None, **kwargs):
+    # Progress writes don't touch the catalogue; uploads and finished jobs do.
+    if created or (_saves_status(update_fields) and instance.status in ('completed', 'failed', 'live', 'ended')):
+        invalidate_catalogue()
+
+
+@receiver(post_save, sender=AudioTrack)
+def invalidate_catalogue_on_track_completed(sender, instance, created, update_fields=None, **kwargs):
+    if _saves_status(update_fields) and instance.status == 'completed':
+        invalidate_catalogue()
+
+
+@receiver(post_delete, sender=Video)
+def invalidate_catalogue_on_video_delete(sender, instance, **kwargs):
+    invalidate_catalogue()
+
+
+@task_prerun.connect
+def start_task_metrics(sender=None, **kwargs):
+    metrics.start_task(sender.name)
+
+
+@task_postrun.connect
+def finish_task_metrics(sender=None, state=None, **kwargs):
+    metrics.finish_task(sender.name, state)
+
+
+@task_failure.connect
+def count_task_failure(sender=None, exception=None, **kwargs):
+    metrics.record_failure(sender.name, exception)
+
+
+@worker_process_shutdown.connect
+def remove_worker_metrics(pid=None, **kwargs):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -1,83 +1,548 @@
-def _download_audio_file(audio_track, download_folder):
-    """Download the audio file from storage to a local path."""
-    input_audio_path = os.path.join(download_folder, os.path.basename(audio_track.audio_file.name))
-    if not os.path.exists(input_audio_path):
-        download_file_from_minio('videos', audio_track.audio_file.name, input_audio_path)
-    return input_audio_path
-
-def _transcode_audio_to_hls(input_audio_path, output_folder, language):
+def _download_audio_file(audio_track, workspace, progress_callback=None):
+    """Fetch the audio file into the task's scratch space, from the source cache if it is there."""
+    file_key = audio_track.audio_file.name
+    return workspace.source(
+        'videos', file_key, lambda path: download_file_from_minio('videos', file_key, path, progress_callback)
+    )
+
+def _transcode_audio_to_hls(input_audio_path, output_folder, label, output_format='ts', progress_callback=None):
     """Transcode the audio file to HLS segments using ffmpeg."""
-    audio_playlist_name = f"audio_{language}_playlist.m3u8"
-    audio_hls_command = [
-        'ffmpeg', '-i', input_audio_path, '-vn', '-c:a', 'aac', '-b:a', '128k',
-        '-f', 'hls', '-hls_time', '10', '-hls_list_size', '0',
-        '-hls_segment_filename', f"{output_folder}/asegment_{language}_%d.ts",
-        f"{output_folder}/{audio_playlist_name}"
-    ]
-    subprocess.run(audio_hls_command, check=True)
+    audio_playlist_name = f"audio_{label}_playlist.m3u8"
+    audio_hls_command = ['ffmpeg', '-i', input_audio_path] + _audio_hls_output_args(
+        output_folder, '0:a:0', label, output_format=output_format
+    )
+    run_ffmpeg(audio_hls_command, progress_callback)
     return audio_playlist_name
 
-def _update_audio_master_playlist(video, output_folder):
-    """Update the master playlist to include all audio tracks for the video."""
-    all_audio_tracks = AudioTrack.objects.filter(video=video, transcoded_playlist__isnull=False)
-    audio_playlists = [(track.language, os.path.basename(track.transcoded_playlist)) for track in all_audio_tracks]
-    create_master_hls_playlist(output_folder, audio_playlists)
-    return audio_playlists
-
-def _upload_transcoded_audio(output_folder):
-    subprocess.run(['mc', 'cp', '-r', output_folder, f'myminio/videos/transcoded_videos'], check=True)
+def _upload_transcoded_audio(output_folder, video_uuid):
+    transcoded_uploader(video_uuid).upload_folder(output_folder)
 
+import logging
+import math
 import os
+import signal
 import subprocess
-import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from celery import shared_task
-from .models import Video, AudioTrack
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from . import metrics
+from .checkpoints import (
+    AUDIO_PART,
+    FINALIZE_PART,
+    VIDEO_PART,
+    chunk_part,
+    claim_part,
+    complete_part,
+    expect_part,
+    out_of_attempts,
+    part_results,
+    queue_finalize,
+    queue_parts,
+    reap_stale_parts,
+    running
+)
+from .models import Video, AudioTrack, Rendition, MediaProbe, LiveStream
+from .catalogue import invalidate_catalogue
+from .dedup import detach_transcode_result, register_transcode_result, reuse_stored_transcode
+from .events import audio_track_event, publish_video_event, video_event
+from .locks import video_lock
+from .pertitle import analyze_complexity, per_title_decisions, per_title_ladder
+from .progress import ProgressReporter
+from .scratch import scratch_space
+from .scheduling import transcode_route
+from .uploader import LiveUploader, SegmentUploader, upload_file_if_changed
 from .utils import (
     get_language_display_name,
-    create_uuid,
-    make_download_directory,
-    make_transcoded_directory,
     download_file_from_minio,
-    get_audio_streams_from_video
+    run_ffmpeg,
+    probe_media,
+    parse_media_probe,
+    display_size,
+    get_duration_from_video,
+    get_keyframe_times,
+    get_presigned_url,
+    split_at_keyframes,
+    sha256_of_file,
+    sha256_of_object,
+    AVC_PROFILE_IDC,
+    avc1_codec_string,
+    list_playlist_segments,
+    measure_playlist_bandwidth,
+    measure_segments_bandwidth,
+    mark_iframes_only,
+    write_stitched_playlist,
+    write_thumbnails_vtt
 )
 
-def encode_video_to_hls(input_file, output_folder):
-    video_hls_command = [
-        'ffmpeg', '-i', input_file, '-map', '0:v', '-an', '-c:v', 'libx264', '-b:v', '2M',
-        '-maxrate:v', '2M', '-bufsize:v', '4M', '-f', 'hls', '-hls_time', '10', '-hls_list_size', '0',
-        '-hls_segment_filename', f"{output_folder}/vsegment_%d.ts",
-        f"{output_folder}/video_playlist.m3u8"
+logger = logging.getLogger(__name__)
+
+COPYABLE_PIXEL_FORMATS = {'yuv420p', 'yuvj420p'}
+# A finished title keeps every segment in its playlist.
+VOD_PLAYLIST_ARGS = ('-hls_list_size', '0')
+# mjpeg qscale of the sprite sheets and the poster: 2 (best) to 31.
+THUMBNAIL_JPEG_QUALITY = 5
+POSTER_JPEG_QUALITY = 2
+
+def transcoded_uploader(video_uuid):
+    return SegmentUploader('videos', f'transcoded_videos/{video_uuid}')
+
+def get_media_probe(video, source=None):
+    """
+    The video's stored MediaProbe, probing the source once if there is none yet.
+    source defaults to a presigned URL, so probing never requires a download.
+    """
+    try:
+        return MediaProbe.objects.get(video=video)
+    except MediaProbe.DoesNotExist:
+        pass
+    source = source or get_presigned_url('videos', video.video_file.name)
+    probe, _ = MediaProbe.objects.get_or_create(video=video, defaults=parse_media_probe(probe_media(source)))
+    return probe
+
+def get_keyframe_index(probe, source=None):
+    """Keyframe times of the source, scanned once and stored on the probe."""
+    if probe.keyframes is None:
+        source = source or get_presigned_url('videos', probe.video.video_file.name)
+        probe.keyframes = get_keyframe_times(source)
+        probe.save(update_fields=['keyframes'])
+    return probe.keyframes
+
+def build_rendition_ladder(source_width, source_height):
+    """
+    Pick the rungs of HLS_RENDITION_LADDER that fit the source, with even output widths
+    that keep the source aspect ratio. Sources smaller than every rung get the lowest
+    rung at their own resolution.
+    """
+    ladder = [rung for rung in settings.HLS_RENDITION_LADDER if rung['height'] <= source_height]
+    if not ladder:
+        ladder = [dict(settings.HLS_RENDITION_LADDER[-1], height=source_height - source_height % 2)]
+    return [
+        dict(rung, width=int(round(source_width * rung['height'] / source_height / 2)) * 2)
+        for rung in ladder
     ]
-    subprocess.run(video_hls_command, check=True)
 
-def encode_audio_streams_to_hls(input_file, output_folder, audio_streams, video_obj):
-    audio_playlists = []
+def rendition_playlist_name(rung):
+    return f"video_{rung['name']}_playlist.m3u8"
+
+def _even(value):
+    return int(round(value / 2)) * 2
+
+def trickplay_plan(video_stream, duration):
+    """
+    What the video encode writes for trickplay, or None when TRICKPLAY_ENABLED is off:
+    the I-frame rendition as a ladder rung, the [width, height] of thumbnails and poster,
+    the poster's time and the suffix the files are named with (chunks have their own).
+    """
+    if not settings.TRICKPLAY_ENABLED:
+        return None
+    # ffmpeg autorotates, so the encode sees the frames as displayed.
+    width, height = display_size(video_stream)
+    iframe_height = min(settings.TRICKPLAY_IFRAME_HEIGHT, height - height % 2)
+    poster_width = min(settings.TRICKPLAY_POSTER_WIDTH, width - width % 2)
+    return {
+        'iframe': {
+            'name': 'iframe', 'width': _even(width * iframe_height / height), 'height': iframe_height,
+            'profile': 'main', 'level': '3.0', 'iframe_only': True,
+        },
+        'thumbnail': [settings.TRICKPLAY_THUMBNAIL_WIDTH, _even(height * settings.TRICKPLAY_THUMBNAIL_WIDTH / width)],
+        'poster': [poster_width, _even(height * poster_width / width)],
+        'poster_time': min(settings.TRICKPLAY_POSTER_TIME, duration / 2),
+        'suffix': '',
+    }
 
+def _chunk_trickplay(trickplay, chunk_index, start, length):
+    """
+    A chunk's share of the trickplay plan: files of its own, and the poster only from
+    the chunk the poster time falls in, at that time relative to the chunk's start.
+    """
+    if trickplay is None:
+        return None
+    poster_time = trickplay['poster_time'] - start
+    # The last chunk has no length: it runs to the end of the source.
+    if poster_time < 0 or (length is not None and poster_time >= length):
+        poster_time = None
+    return dict(trickplay, suffix=f'_c{chunk_index}', poster_time=poster_time)
+
+def trickplay_rungs(trickplay):
+    return [trickplay['iframe']] if trickplay else []
+
+def trickplay_sheets(output_folder, suffix=''):
+    """Names of the sprite sheets an encode wrote, in order."""
+    sheets = []
+    while os.path.exists(os.path.join(output_folder, f'thumbs{suffix}_{len(sheets)}.jpg')):
+        sheets.append(f'thumbs{suffix}_{len(sheets)}.jpg')
+    return sheets
+
+def write_trickplay_index(output_folder, trickplay, runs):
+    """thumbnails.vtt for the sprite sheets of runs, (start, duration, sheet names) per encode."""
+    write_thumbnails_vtt(
+        os.path.join(output_folder, 'thumbnails.vtt'), runs, settings.TRICKPLAY_THUMBNAIL_INTERVAL,
+        *trickplay['thumbnail'], settings.TRICKPLAY_SPRITE_COLUMNS, settings.TRICKPLAY_SPRITE_ROWS
+    )
+
+def plan_per_title_ladder(video, probe, ladder, analysis=None):
+    """
+    Fit the ladder's bitrates to the title from CRF encodes of scenes sampled from the
+    source in storage, and record the analysis in video.encode_decisions['per_title'].
+    A resumed transcode passes the analysis its first attempt recorded, so the chunks
+    it still has to encode get the same bitrates as those already in storage.
+    """
+    if analysis is None:
+        with scratch_space(f'video-{video.id}-analysis') as workspace:
+            analysis = analyze_complexity(
+                get_presigned_url('videos', video.video_file.name), probe.duration, ladder, workspace.dir('analysis')
+            )
+    ladder = per_title_ladder(ladder, analysis)
+    video.encode_decisions['per_title'] = per_title_decisions(analysis, ladder)
+    return ladder
+
+def _video_copy_blocker(video_stream, bit_rate, top_rung):
+    """Why the source video stream has to be re-encoded, or None when it can be remuxed as is."""
+    if video_stream['codec_name'] != 'h264':
+        return f"codec {video_stream['codec_name']} is not h264"
+    if (video_stream.get('profile') or '').lower() not in AVC_PROFILE_IDC:
+        return f"h264 profile {video_stream.get('profile')} is not supported"
+    if not video_stream.get('level') or video_stream['level'] <= 0:
+        return 'h264 level is unknown'
+    if video_stream.get('pix_fmt') not in COPYABLE_PIXEL_FORMATS:
+        return f"pixel format {video_stream.get('pix_fmt')} is not 4:2:0"
+    # HLS players ignore the display matrix, so only an encode can apply the rotation.
+    if video_stream.get('rotation'):
+        return f"rotation {video_stream['rotation']} requires re-encode"
+    if not bit_rate:
+        return 'bitrate is unknown'
+    if bit_rate > top_rung['maxrate']:
+        return f"bitrate {bit_rate} exceeds {top_rung['name']} maxrate {top_rung['maxrate']}"
+    return None
+
+def _audio_copy_blocker(audio_stream):
+    """Why an audio stream has to be re-encoded, or None when it can be remuxed as is."""
+    if audio_stream['codec_name'] != 'aac':
+        return f"codec {audio_stream['codec_name']} is not aac"
+    # The master playlist advertises mp4a.40.2, so HE-AAC has to be re-encoded.
+    if audio_stream.get('profile') != 'LC':
+        return f"AAC profile {audio_stream.get('profile')} is not LC"
+    if not audio_stream.get('bit_rate'):
+        return 'bitrate is unknown'
+    if audio_stream['bit_rate'] > settings.HLS_AUDIO_BITRATE:
+        return f"bitrate {audio_stream['bit_rate']} exceeds {settings.HLS_AUDIO_BITRATE}"
+    return None
+
+def plan_stream_copy(probe, ladder):
+    """
+    Decide per stream whether the source can be remuxed into HLS with -c copy instead
+    of re-encoded. Returns the ladder to encode, the audio streams marked with 'copy',
+    and the decisions to record on the video. A copyable video stream becomes a 'copy'
+    rung at the source resolution that tops the ladder's lower rungs, which are still
+    encoded from the same decode; with HLS_STREAM_COPY_LADDER off it is the only rung.
+    """
+    video_stream = probe.video_stream
+    if not settings.HLS_STREAM_COPY:
+        video_blocker = 'stream copy is disabled'
+    else:
+        video_blocker = _video_copy_blocker(video_stream, video_stream.get('bit_rate') or probe.bit_rate, ladder[0])
+    decisions = {
+        'video': {'index': video_stream['index'], 'action': 'encode' if video_blocker else 'copy', 'reason': video_blocker},
+        'audio': [],
+    }
+    if not video_blocker:
+        lower_rungs = [rung for rung in ladder if rung['height'] < video_stream['height']]
+        if not settings.HLS_STREAM_COPY_LADDER:
+            lower_rungs = []
+        ladder = [{
+            'name': f"{video_stream['height']}p",
+            'width': video_stream['width'],
+            'height': video_stream['height'],
+            'profile': video_stream['profile'].lower(),
+            'level': f"{video_stream['level'] / 10:g}",
+            'copy': True,
+        }] + lower_rungs
+        decisions['video']['ladder'] = [rung['name'] for rung in ladder]
+    audio_streams = []
+    for audio_stream in probe.audio_streams:
+        audio_blocker = _audio_copy_blocker(audio_stream) if settings.HLS_STREAM_COPY else 'stream copy is disabled'
+        audio_streams.append(dict(audio_stream, copy=audio_blocker is None))
+        decisions['audio'].append({
+            'index': audio_stream['index'], 'action': 'encode' if audio_blocker else 'copy', 'reason': audio_blocker,
+        })
+    return ladder, audio_streams, decisions
+
+def _hls_segment_args(output_folder, name, output_format):
+    """
+    Segment options for one HLS output named name: MPEG-TS segments (name_<n>.ts), fMP4
+    segments (name_<n>.m4s after a name_init.mp4 init section) or, for single_file, one
+    fMP4 file name.mp4 that the playlist addresses by byte range.
+    """
+    if output_format == 'single_file':
+        return ['-hls_segment_type', 'fmp4', '-hls_flags', 'single_file', '-hls_segment_filename', f"{output_folder}/{name}.mp4"]
+    if output_format == 'fmp4':
+        return [
+            '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', f"{name}_init.mp4",
+            '-hls_segment_filename', f"{output_folder}/{name}_%d.m4s",
+        ]
+    return ['-hls_segment_filename', f"{output_folder}/{name}_%d.ts"]
+
+def _video_hls_output_args(output_folder, ladder, segment_prefix='vsegment', ts_offset=None, output_format='ts',
+                           segment_duration=None, playlist_args=VOD_PLAYLIST_ARGS, encoder_args=()):
+    """
+    Output options that encode every rung of the ladder from one split/scale of the decoded
+    video. A 'copy' rung at the top of the ladder remuxes the source video untouched instead,
+    and the rungs below it are encoded alongside. playlist_args are the hls muxer's playlist
+    options and encoder_args extra libx264 options.
+    """
+    segment_duration = segment_duration or settings.HLS_SEGMENT_DURATION
+    copied = 1 if ladder[0].get('copy') else 0
+    encoded = ladder[copied:]
+    args = []
+    if encoded:
+        splits = ''.join(f'[v{idx}]' for idx in range(len(encoded)))
+        filters = [f'[0:v]split={len(encoded)}{splits}']
+        filters += [f"[v{idx}]scale={rung['width']}:{rung['height']}[v{idx}out]" for idx, rung in enumerate(encoded)]
+        args += ['-filter_complex', ';'.join(filters)]
+    if copied:
+        args += ['-map', '0:v:0', '-c:v:0', 'copy']
+    for idx, rung in enumerate(encoded, start=copied):
+        args += [
+            '-map', f'[v{idx - copied}out]', f'-c:v:{idx}', 'libx264', f'-pix_fmt:v:{idx}', 'yuv420p',
+            f'-b:v:{idx}', str(rung['bitrate']), f'-maxrate:v:{idx}', str(rung['maxrate']),
+            f'-bufsize:v:{idx}', str(rung['bufsize']),
+            f'-profile:v:{idx}', rung['profile'], f'-level:v:{idx}', rung['level'],
+            f'-sc_threshold:v:{idx}', '0',
+        ]
+        if copied:
+            # The copied rung is cut on the source's keyframes, so the encoded ones get
+            # exactly those (and no others) to stay switchable at every segment.
+            args += [f'-force_key_frames:v:{idx}', 'source', f'-g:v:{idx}', str(2 ** 31 - 1)]
+        else:
+            # Keyframes on segment boundaries keep the renditions switchable at every segment.
+            args += [f'-force_key_frames:v:{idx}', f'expr:gte(t,n_forced*{segment_duration})']
+    args += ['-an', *encoder_args]
+    args += ['-f', 'hls', '-hls_time', str(segment_duration), *playlist_args]
+    if ts_offset:
+        args += ['-output_ts_offset', str(ts_offset)]
+    # ffmpeg leaves %v unexpanded in the fMP4 init filename when there is only one variant.
+    variant = '%v' if len(ladder) > 1 else ladder[0]['name']
+    args += [
+        '-var_stream_map', ' '.join(f"v:{idx},name:{rung['name']}" for idx, rung in enumerate(ladder)),
+        *_hls_segment_args(output_folder, f'{segment_prefix}_{variant}', output_format),
+        f"{output_folder}/video_%v_playlist.m3u8"
+    ]
+    return args
+
+def _trickplay_output_args(output_folder, trickplay, ts_offset=None, output_format='ts'):
+    """
+    Output options for the trickplay files, fed by a filter graph of their own on the
+    source video. ffmpeg decodes the video once for every graph that reads it, so they
+    only add their scaling and the small I-frame encode: sprite sheets thumbs<suffix>_<n>.jpg,
+    the I-frame rendition and, when the plan has a poster_time, poster.jpg.
+    """
+    suffix = trickplay['suffix']
+    iframe = trickplay['iframe']
+    thumbnail_width, thumbnail_height = trickplay['thumbnail']
+    branches = [
+        f"fps=1/{settings.TRICKPLAY_THUMBNAIL_INTERVAL},scale={thumbnail_width}:{thumbnail_height},"
+        f"tile={settings.TRICKPLAY_SPRITE_COLUMNS}x{settings.TRICKPLAY_SPRITE_ROWS}[thumbs]",
+        f"fps=1/{settings.TRICKPLAY_IFRAME_INTERVAL},scale={iframe['width']}:{iframe['height']}[iframes]",
+    ]
+    if trickplay['poster_time'] is not None:
+        poster_width, poster_height = trickplay['poster']
+        # The second trim ends the branch after its one frame rather than queueing the rest.
+        branches.append(f"trim=start={trickplay['poster_time']},trim=end_frame=1,scale={poster_width}:{poster_height}[poster]")
+    splits = ''.join(f'[tp{idx}]' for idx in range(len(branches)))
+    graph = f'[0:v]split={len(branches)}{splits};' + ';'.join(f'[tp{idx}]{branch}' for idx, branch in enumerate(branches))
+    args = [
+        '-filter_complex', graph,
+        '-map', '[thumbs]', '-fps_mode', 'passthrough', '-q:v', str(THUMBNAIL_JPEG_QUALITY), '-start_number', '0',
+        f"{output_folder}/thumbs{suffix}_%d.jpg",
+        '-map', '[iframes]', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', str(settings.TRICKPLAY_IFRAME_CRF),
+        '-profile:v', iframe['profile'], '-level:v', iframe['level'],
+        # All intra, one frame per segment: each segment is a single I-frame.
+        '-g', '1', '-f', 'hls', '-hls_time', str(settings.TRICKPLAY_IFRAME_INTERVAL), *VOD_PLAYLIST_ARGS,
+    ]
+    if ts_offset:
+        args += ['-output_ts_offset', str(ts_offset)]
+    args += [
+        *_hls_segment_args(output_folder, f'iframe{suffix}', output_format),
+        f"{output_folder}/{rendition_playlist_name(iframe)}",
+    ]
+    if trickplay['poster_time'] is not None:
+        args += ['-map', '[poster]', '-q:v', str(POSTER_JPEG_QUALITY), '-update', '1', f"{output_folder}/poster.jpg"]
+    return args
+
+def _audio_hls_output_args(output_folder, stream_spec, label, copy=False, output_format='ts',
+                           segment_duration=None, playlist_args=VOD_PLAYLIST_ARGS):
+    """Output options that encode (or remux, with copy) one audio stream to audio_<label>_playlist.m3u8."""
+    codec_args = ['-c:a', 'copy'] if copy else ['-c:a', 'aac', '-b:a', str(settings.HLS_AUDIO_BITRATE)]
+    return [
+        '-map', stream_spec, '-vn', *codec_args,
+        '-f', 'hls', '-hls_time', str(segment_duration or settings.HLS_SEGMENT_DURATION), *playlist_args,
+        *_hls_segment_args(output_folder, f'asegment_{label}', output_format),
+        f"{output_folder}/audio_{label}_playlist.m3u8"
+    ]
+
+def _audio_stream_labels(audio_streams):
+    """
+    (stream_index, language, label) for each audio stream. The label names the
+    output files and is the language unless two streams share one.
+    """
+    labels = []
+    used = set()
     for audio_stream in audio_streams:
         stream_index = audio_stream['index']
-        language = audio_stream.get('tags', {}).get('language', f'audio{stream_index}')
-        audio_playlist_name = f"audio_{language}_playlist.m3u8"
-        audio_playlists.append((language, audio_playlist_name))
-
-        audio_hls_command = [
-            'ffmpeg', '-i', input_file, '-map', f"0:{stream_index}", '-vn', '-c:a', 'aac', '-b:a', '128k',
-            '-f', 'hls', '-hls_time', '10', '-hls_list_size', '0',
-            '-hls_segment_filename', f"{output_folder}/asegment_{language}_%d.ts",
-            f"{output_folder}/{audio_playlist_name}"
-        ]
-        subprocess.run(audio_hls_command, check=True)
+        language = audio_stream.get('language') or f'audio{stream_index}'
+        label = language if language not in used else f'{language}_{stream_index}'
+        used.add(language)
+        labels.append((stream_index, language, label))
+    return labels
+
+def encode_to_hls(input_file, output_folder, ladder, audio_streams, start=None, duration=None,
+                  segment_prefix='vsegment', output_format='ts', trickplay=None, progress_callback=None):
+    """
+    Encode the video ladder and every audio stream in one ffmpeg run, so the source is
+    read and demuxed once however many audio streams it has. Audio streams marked 'copy'
+    are remuxed rather than re-encoded. start/duration restrict
+    the encode to one chunk of the source; its timestamps are offset by start so
+    consecutive chunks line up. output_format is a Video.OUTPUT_FORMATS value.
+    trickplay is a trickplay_plan() to write alongside the ladder.
+    Returns the (language, playlist name) of each audio stream.
+    progress_callback is passed to run_ffmpeg.
+    """
+    command = ['ffmpeg']
+    if ladder and trickplay and all(rung.get('copy') for rung in ladder):
+        # Nothing else decodes a remuxed video; its keyframes are enough for trickplay.
+        command += ['-skip_frame:v', 'nokey']
+    if start is not None:
+        command += ['-ss', str(start)]
+    if duration is not None:
+        command += ['-t', str(duration)]
+    command += ['-i', input_file]
+    if ladder:
+        command += _video_hls_output_args(output_folder, ladder, segment_prefix, ts_offset=start, output_format=output_format)
+        if trickplay:
+            command += _trickplay_output_args(output_folder, trickplay, ts_offset=start, output_format=output_format)
+    audio_playlists = []
+    for audio_stream, (stream_index, language, label) in zip(audio_streams, _audio_stream_labels(audio_streams)):
+        command += _audio_hls_output_args(
+            output_folder, f'0:{stream_index}', label, copy=audio_stream.get('copy', False), output_format=output_format
+        )
+        audio_playlists.append((language, f"audio_{label}_playlist.m3u8"))
+    run_ffmpeg(command, progress_callback)
+    return audio_playlists
+
+def encode_video_to_hls(input_file, output_folder, ladder, start=None, duration=None, segment_prefix='vsegment',
+                        output_format='ts', trickplay=None):
+    encode_to_hls(
+        input_file, output_folder, ladder, [], start=start, duration=duration, segment_prefix=segment_prefix,
+        output_format=output_format, trickplay=trickplay
+    )
+
+def live_segment_duration(live_stream):
+    if live_stream.low_latency:
+        return settings.LIVE_HLS_LOW_LATENCY_SEGMENT_DURATION
+    return settings.LIVE_HLS_SEGMENT_DURATION
 
-        AudioTrack.objects.create(
+def live_input_args(input_url):
+    """Input options that wait for the encoder to connect to input_url."""
+    args = []
+    if input_url.startswith(('rtmp://', 'rtmps://')):
+        # ffmpeg only accepts an RTMP publisher when told to listen.
+        args += ['-listen', '1']
+    return args + ['-i', input_url]
+
+def live_audio_playlist_name(live_stream):
+    return f"audio_{live_stream.language}_playlist.m3u8"
+
+def live_ingest_command(live_stream, output_folder, ladder):
+    """
+    ffmpeg command that ingests the stream and encodes the ladder and its first audio
+    stream to a sliding HLS window of LIVE_HLS_WINDOW seconds, in the video's output format.
+    """
+    segment_duration = live_segment_duration(live_stream)
+    playlist_args = [
+        '-hls_list_size', str(math.ceil(settings.LIVE_HLS_WINDOW / segment_duration)),
+        # temp_file: a segment only appears under its own name once it is complete.
+        '-hls_flags', 'delete_segments+independent_segments+program_date_time+temp_file',
+        # Numbering from the clock means a restarted ingest never reuses a segment name.
+        '-hls_start_number_source', 'epoch',
+    ]
+    encoder_args = ['-preset', settings.LIVE_X264_PRESET]
+    if live_stream.low_latency:
+        encoder_args += ['-tune', 'zerolatency']
+    output_format = live_stream.video.output_format
+    return [
+        'ffmpeg', '-nostdin', *live_input_args(live_stream.input_url),
+        *_video_hls_output_args(
+            output_folder, ladder, output_format=output_format, segment_duration=segment_duration,
+            playlist_args=playlist_args, encoder_args=encoder_args
+        ),
+        *_audio_hls_output_args(
+            output_folder, '0:a:0', live_stream.language, output_format=output_format,
+            segment_duration=segment_duration, playlist_args=playlist_args
+        ),
+    ]
+
+def measure_rendition_bandwidths(output_folder, ladder):
+    return {
+        rung['name']: measure_playlist_bandwidth(os.path.join(output_folder, rendition_playlist_name(rung)))
+        for rung in ladder
+    }
+
+def create_renditions(video_obj, ladder, bandwidths):
+    """
+    Replace the video's Rendition rows with the encoded rungs and their measured (peak,
+    average) bandwidth. The ladder may end with the trickplay I-frame rung.
+    """
+    renditions = []
+    for rung in ladder:
+        playlist_name = rendition_playlist_name(rung)
+        bandwidth, average_bandwidth = bandwidths[rung['name']]
+        renditions.append(Rendition(
+            video=video_obj,
+            name=rung['name'],
+            width=rung['width'],
+            height=rung['height'],
+            bandwidth=bandwidth,
+            average_bandwidth=average_bandwidth,
+            codecs=avc1_codec_string(rung['profile'], rung['level']),
+            playlist=f"{video_obj.transcoding_uuid}/{playlist_name}",
+            iframe_only=rung.get('iframe_only', False)
+        ))
+    Rendition.objects.filter(video=video_obj).delete()
+    return Rendition.objects.bulk_create(renditions)
+
+def create_audio_tracks(video_obj, audio_playlists):
+    """
+    Record the audio streams extracted from the source with a single INSERT, replacing
+    any an earlier attempt of the job recorded. User-uploaded tracks are kept.
+    """
+    AudioTrack.objects.filter(video=video_obj, is_user_uploaded=False).delete()
+    return AudioTrack.objects.bulk_create([
+        AudioTrack(
             video=video_obj,
             language=language,
             status='completed',
+            progress=100,
             transcoded_playlist=f"{video_obj.transcoding_uuid}/{audio_playlist_name}"
         )
+        for language, audio_playlist_name in audio_playlists
+    ])
 
+def encode_audio_streams_to_hls(input_file, output_folder, audio_streams, video_obj):
+    if not audio_streams:
+        return []
+    audio_playlists = encode_to_hls(input_file, output_folder, [], audio_streams, output_format=video_obj.output_format)
+    create_audio_tracks(video_obj, audio_playlists)
     return audio_playlists
 
-def create_master_hls_playlist(output_folder, audio_playlists):
+def create_master_hls_playlist(output_folder, audio_playlists, renditions):
     master_playlist_path = os.path.join(output_folder, 'master.m3u8')
+    # BANDWIDTH has to cover the audio rendition that plays alongside the video.
+    audio_bandwidth = settings.HLS_AUDIO_BITRATE if audio_playlists else 0
 
     with open(master_playlist_path, 'w') as f:
         f.write('#EXTM3U\n')
@@ -86,92 +551,596 @@ def create_master_hls_playlist(output_folder, audio_playlists):
             full_language_name = get_language_display_name(language)
             default_value = 'YES' if idx == 0 else 'NO'
             f.write(f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="{full_language_name}",LANGUAGE="{language}",DEFAULT={default_value},AUTOSELECT=YES,URI="{playlist}"\n')
-        f.write('#EXT-X-STREAM-INF:BANDWIDTH=2000000,AUDIO="audio"\n')
-        f.write('video_playlist.m3u8\n')
+        for rendition in renditions:
+            # An I-frame rendition is played without audio, for fast seeking and scrubbing.
+            with_audio = bool(audio_playlists) and not rendition.iframe_only
+            attributes = [
+                f'BANDWIDTH={rendition.bandwidth + (audio_bandwidth if with_audio else 0)}',
+                f'AVERAGE-BANDWIDTH={rendition.average_bandwidth + (audio_bandwidth if with_audio else 0)}',
+            ]
+            # Renditions carried over from single-bitrate encodes have no measured resolution/codecs.
+            if rendition.width and rendition.height:
+                attributes.append(f'RESOLUTION={rendition.width}x{rendition.height}')
+            if rendition.codecs:
+                codecs = f'{rendition.codecs},mp4a.40.2' if with_audio else rendition.codecs
+                attributes.append(f'CODECS="{codecs}"')
+            if with_audio:
+                attributes.append('AUDIO="audio"')
+            if rendition.iframe_only:
+                attributes.append(f'URI="{os.path.basename(rendition.playlist)}"')
+                f.write(f'#EXT-X-I-FRAME-STREAM-INF:{",".join(attributes)}\n')
+                continue
+            f.write(f'#EXT-X-STREAM-INF:{",".join(attributes)}\n')
+            f.write(f'{os.path.basename(rendition.playlist)}\n')
 
+def write_master_playlist(video):
+    """
+    Render master.m3u8 from the video's Rendition rows and completed AudioTracks and
+    upload it over the published one; a single PUT replaces the object atomically.
+    Callers must hold the video's 'master-playlist' lock. Returns the playlist path.
+    """
+    audio_tracks = AudioTrack.objects.filter(
+        video=video, status='completed', transcoded_playlist__isnull=False
+    ).order_by('-is_default', 'id')
+    audio_playlists = [(track.language, os.path.basename(track.transcoded_playlist)) for track in audio_tracks]
+    with tempfile.TemporaryDirectory() as folder:
+        create_master_hls_playlist(folder, audio_playlists, Rendition.objects.filter(video=video))
+        upload_file_if_changed(
+            'videos', f'transcoded_videos/{video.output_uuid}/master.m3u8', os.path.join(folder, 'master.m3u8')
+        )
+    return f"{video.output_uuid}/master.m3u8"
 
+def publish_master_playlist(video):
+    """write_master_playlist under the video's lock, so concurrent writers never drop each other's tracks."""
+    with video_lock(video.id, 'master-playlist'):
+        return write_master_playlist(video)
 
-@shared_task
-def transcode_video(video_id):
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def schedule_transcode(video_id, bulk=False):
+    """
+    Probe the source, then queue its transcode by cost: short or long queue, and a
+    priority that lets cheaper jobs in the same queue go first, or the lowest priority
+    for a bulk job. A transcode that has completed or is running is not queued again.
+    """
     video = Video.objects.get(id=video_id)
-    video.status = 'in_progress'
-    video.progress = 5
-    video.save()
-    video_uuid = str(video.transcoding_uuid)
-    download_folder = make_download_directory(video_uuid)
-    input_path = os.path.join(download_folder, f'{video_uuid}.mp4')
-    video_file_key = video.video_file.name
-    download_file_from_minio('videos', video_file_key, input_path)
-    video.progress = 15
-    video.save()
-    output_folder = make_transcoded_directory('transcoded_video', video_uuid)
+    metrics.bind_job(Video, video.id)
     try:
-        audio_streams = get_audio_streams_from_video(input_path)
-        video.progress = 25
-        video.save()
-        encode_video_to_hls(input_path, output_folder)
-        video.progress = 60
-        video.save()
-        audio_playlists = encode_audio_streams_to_hls(input_path, output_folder, audio_streams, video)
-        video.progress = 80
-        video.save()
-        create_master_hls_playlist(output_folder, audio_playlists)
-        subprocess.run(['mc', 'cp', '-r', output_folder, f'myminio/videos/transcoded_videos'], check=True)
-        video.transcoded_video = f"{video_uuid}/video_playlist.m3u8"
-        video.master_playlist = f"{video_uuid}/master.m3u8"
-        video.status = 'completed'
-        video.progress = 100
-        video.save()
-        
+        with metrics.stage('probe'):
+            route = transcode_route(get_media_probe(video), bulk=bulk)
     except Exception as e:
         video.status = 'failed'
-        video.save()
+        video.save(update_fields=['status'])
         raise e
-    
-    shutil.rmtree(download_folder)
-    shutil.rmtree(output_folder)
+    queue_parts(video.id, [(VIDEO_PART, transcode_video, [video.id])], route)
 
 
-@shared_task
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def transcode_video(self, video_id):
+    """
+    Transcode the video, checkpointed as its 'video' part: a redelivery after the job
+    completed, or while another worker runs it, does nothing.
+    """
+    part = claim_part(self, video_id, VIDEO_PART)
+    if part is None:
+        return
+    if Video.objects.filter(id=video_id, status='completed').exists():
+        complete_part(part)
+        return
+    try:
+        with running(part):
+            _transcode_video(Video.objects.get(id=video_id), part.options.get('priority'))
+    except Exception:
+        _part_failed(part)
+        raise
+    complete_part(part)
+
+
+def _transcode_video(video, priority=None):
+    video.status = 'in_progress'
+    video.progress = 5
+    video.save(update_fields=['status', 'progress'])
+    progress = ProgressReporter(Video, video.id, video.progress)
+    metrics.bind_job(Video, video.id)
+    video_uuid = str(video.transcoding_uuid)
+    video_file_key = video.video_file.name
+    with metrics.stage('probe'):
+        probe = get_media_probe(video)
+        video_stream = probe.video_stream
+        ladder = build_rendition_ladder(*display_size(video_stream))
+        recorded_analysis = (video.encode_decisions or {}).get('per_title')
+        ladder, audio_streams, video.encode_decisions = plan_stream_copy(probe, ladder)
+        trickplay = trickplay_plan(video_stream, probe.duration)
+    # Only full re-encodes are split up: a ladder topped by a remuxed rung is a cheaper
+    # pass whose lower rungs take their keyframes from the one source decode.
+    chunked = not ladder[0].get('copy') and probe.duration >= settings.TRANSCODE_CHUNKED_MIN_DURATION
+    if chunked:
+        # Chunk workers read the source from storage themselves, so hashing it takes a read of its own.
+        with metrics.stage('hash'):
+            if reuse_stored_transcode(video, lambda: sha256_of_object('videos', video_file_key)):
+                return
+    if settings.PER_TITLE_ENCODING and not ladder[0].get('copy'):
+        with metrics.stage('analysis'):
+            ladder = plan_per_title_ladder(video, probe, ladder, recorded_analysis)
+    video.save(update_fields=['encode_decisions'])
+    if chunked:
+        dispatch_chunked_transcode(video, probe, ladder, audio_streams, trickplay, priority)
+        return
+    estimate = (probe.size or 0) * settings.TRANSCODE_SCRATCH_SIZE_FACTOR
+    with scratch_space(f'video-{video.id}', estimate) as workspace:
+        output_folder = workspace.dir('hls')
+        progress.stage(5, 15)
+        with metrics.stage('download') as download:
+            input_path = workspace.source(
+                'videos', video_file_key,
+                lambda path: download_file_from_minio('videos', video_file_key, path, progress.download_callback()),
+                filename=f'{video_uuid}.mp4'
+            )
+            download['bytes'] = workspace.downloaded_bytes
+        with metrics.stage('hash'):
+            if reuse_stored_transcode(video, lambda: sha256_of_file(input_path)):
+                return
+        # Segments are uploaded as ffmpeg closes them; playlists follow once encoding is done.
+        with transcoded_uploader(video_uuid).watch(output_folder):
+            progress.stage(15, 90)
+            with metrics.stage('encode'):
+                audio_playlists = encode_to_hls(
+                    input_path, output_folder, ladder, audio_streams, output_format=video.output_format,
+                    trickplay=trickplay, progress_callback=progress.ffmpeg_callback(probe.duration)
+                )
+            create_audio_tracks(video, audio_playlists)
+            progress.stage(90, 100)
+            with metrics.stage('playlist'):
+                rungs = ladder + trickplay_rungs(trickplay)
+                if trickplay:
+                    mark_iframes_only(os.path.join(output_folder, rendition_playlist_name(trickplay['iframe'])))
+                    write_trickplay_index(output_folder, trickplay, [(0, probe.duration, trickplay_sheets(output_folder))])
+                    video.thumbnails = f'{video_uuid}/thumbnails.vtt'
+                    if os.path.exists(os.path.join(output_folder, 'poster.jpg')):
+                        video.poster = f'{video_uuid}/poster.jpg'
+                renditions = create_renditions(video, rungs, measure_rendition_bandwidths(output_folder, rungs))
+    # The master goes up only once every playlist it lists is in storage.
+    with metrics.stage('playlist'):
+        video.master_playlist = publish_master_playlist(video)
+    video.transcoded_video = renditions[0].playlist
+    video.status = 'completed'
+    video.progress = 100
+    video.eta_seconds = None
+    video.save(update_fields=[
+        'transcoded_video', 'master_playlist', 'poster', 'thumbnails', 'status', 'progress', 'eta_seconds'
+    ])
+    register_transcode_result(video)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
 def transcode_audio_for_video(audio_track_id):
     """
-    Transcode a user-uploaded audio file to HLS, update AudioTrack and master playlist.
+    Transcode a user-uploaded audio file to HLS, upload just its segments and playlist,
+    and republish the master playlist with the new track.
     """
     audio_track = AudioTrack.objects.get(id=audio_track_id)
-    video = audio_track.video
-    video_uuid = str(video.transcoding_uuid)
+    if audio_track.status == 'completed':
+        # Redelivered after it finished.
+        return
+    # Never add a language to an HLS tree that other videos share.
+    video = detach_transcode_result(audio_track.video)
+    video_uuid = video.output_uuid
     audio_track.status = 'in_progress'
     audio_track.progress = 5
-    audio_track.save()
-    download_folder = make_download_directory(video_uuid)
-    output_folder = make_transcoded_directory('transcoded_video', video_uuid)
+    audio_track.save(update_fields=['status', 'progress'])
+    progress = ProgressReporter(AudioTrack, audio_track.id, audio_track.progress, video_id=video.id)
+    metrics.bind_job(AudioTrack, audio_track.id)
     try:
-        # Step 1: Download audio file
-        input_audio_path = _download_audio_file(audio_track, download_folder)
-        audio_track.progress = 20
-        audio_track.save()
-        # Step 2: Transcode audio to HLS
-        language = audio_track.language
-        audio_playlist_name = _transcode_audio_to_hls(input_audio_path, output_folder, language)
-        audio_track.progress = 70
-        audio_track.save()
-        # Step 3: Update AudioTrack with playlist path
-        audio_track.transcoded_playlist = f"{video_uuid}/{audio_playlist_name}"
-        audio_track.save()
-        # Step 4: Update master playlist
-        _update_audio_master_playlist(video, output_folder)
-        audio_track.progress = 90
-        audio_track.save()
-        # Step 5: Upload new segments and playlist
-        _upload_transcoded_audio(output_folder)
-        video.master_playlist = f"{video_uuid}/master.m3u8"
-        video.save()
-        audio_track.progress = 100
-        audio_track.status = 'completed'
-        audio_track.save()
+        # The task's own scratch space, so concurrent uploads for one video never see each other's files.
+        with scratch_space(f'audio-{audio_track.id}') as workspace:
+            output_folder = workspace.dir('hls')
+            # Step 1: Download audio file
+            progress.stage(5, 20)
+            with metrics.stage('download') as download:
+                input_audio_path = _download_audio_file(audio_track, workspace, progress.download_callback())
+                download['bytes'] = workspace.downloaded_bytes
+            # Step 2: Transcode audio to HLS, named after the track so it can't overwrite another one
+            progress.stage(20, 80)
+            with metrics.stage('audio_encode'):
+                # Same segment format as the video's, so the tree stays uniform.
+                audio_playlist_name = _transcode_audio_to_hls(
+                    input_audio_path, output_folder, f'{audio_track.language}_{audio_track.id}', video.output_format,
+                    progress_callback=progress.ffmpeg_callback(get_duration_from_video(input_audio_path))
+                )
+            # Step 3: Upload the new segments and playlist
+            progress.stage(80, 95)
+            _upload_transcoded_audio(output_folder, video_uuid)
+            # Step 4: Complete the track and republish the master playlist from the database.
+            # Both happen under the lock so the next writer renders a master that includes this track.
+            with metrics.stage('playlist'), video_lock(video.id, 'master-playlist'):
+                audio_track.transcoded_playlist = f"{video_uuid}/{audio_playlist_name}"
+                audio_track.progress = 100
+                audio_track.eta_seconds = None
+                audio_track.status = 'completed'
+                audio_track.save(update_fields=['transcoded_playlist', 'progress', 'eta_seconds', 'status'])
+                video.master_playlist = write_master_playlist(video)
+            video.save(update_fields=['master_playlist'])
     except Exception as e:
         audio_track.status = 'failed'
-        audio_track.save()
+        audio_track.save(update_fields=['status'])
         raise e
+
+
+def _transcode_uploaded_audio(audio_track, video_uuid, output_format):
+    """
+    Download, transcode and upload one user-uploaded audio track in a scratch space of
+    its own, reporting its progress, for transcode_audio_tracks_for_video's pool.
+    Returns the key of the track's playlist.
+    """
+    progress = ProgressReporter(AudioTrack, audio_track.id, audio_track.progress, video_id=audio_track.video_id)
+    try:
+        with scratch_space(f'audio-{audio_track.id}') as workspace:
+            output_folder = workspace.dir('hls')
+            progress.stage(5, 20)
+            input_audio_path = _download_audio_file(audio_track, workspace, progress.download_callback())
+            progress.stage(20, 80)
+            audio_playlist_name = _transcode_audio_to_hls(
+                input_audio_path, output_folder, f'{audio_track.language}_{audio_track.id}', output_format,
+                progress_callback=progress.ffmpeg_callback(get_duration_from_video(input_audio_path))
+            )
+            progress.stage(80, 95)
+            _upload_transcoded_audio(output_folder, video_uuid)
+        return f"{video_uuid}/{audio_playlist_name}"
     finally:
-        shutil.rmtree(download_folder)  
\ No newline at end of file
+        # The pool's threads each opened a connection of their own for the progress writes.
+        connection.close()
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def transcode_audio_tracks_for_video(video_id, audio_track_ids):
+    """
+    Transcode a batch of user-uploaded audio tracks of one video, e.g. a dubbing delivery,
+    running AUDIO_BATCH_CONCURRENCY ffmpeg processes at a time, the task's share of the
+    audio worker's cores. The tracks are then completed with one bulk UPDATE and
+    the master playlist is republished once, with all of them.
+    """
+    # Never add a language to an HLS tree that other videos share.
+    video = detach_transcode_result(Video.objects.get(id=video_id))
+    video_uuid = video.output_uuid
+    metrics.bind_job(Video, video.id)
+    # A redelivered batch only redoes the tracks that didn't complete.
+    audio_tracks = list(AudioTrack.objects.filter(id__in=audio_track_ids, video=video).exclude(status='completed'))
+    if not audio_tracks:
+        return
+    AudioTrack.objects.filter(id__in=[track.id for track in audio_tracks]).update(status='in_progress', progress=5)
+    for track in audio_tracks:
+        track.status = 'in_progress'
+        track.progress = 5
+        publish_video_event(video.id, audio_track_event(track))
+
+    with metrics.stage('audio_encode'):
+        with ThreadPoolExecutor(max_workers=settings.AUDIO_BATCH_CONCURRENCY) as executor:
+            futures = [
+                (track, executor.submit(_transcode_uploaded_audio, track, video_uuid, video.output_format))
+                for track in audio_tracks
+            ]
+    errors = []
+    for track, future in futures:
+        try:
+            track.transcoded_playlist = future.result()
+        except Exception as e:
+            logger.exception("Could not transcode audio track %s of video %s", track.id, video.id)
+            track.status = 'failed'
+            errors.append(e)
+            continue
+        track.status = 'completed'
+        track.progress = 100
+        track.eta_seconds = None
+
+    # Completed under the lock so the next writer renders a master that includes them.
+    with metrics.stage('playlist'), video_lock(video.id, 'master-playlist'):
+        AudioTrack.objects.bulk_update(audio_tracks, ['transcoded_playlist', 'status', 'progress', 'eta_seconds'])
+        if len(errors) < len(audio_tracks):
+            video.master_playlist = write_master_playlist(video)
+    video.save(update_fields=['master_playlist'])
+    # bulk_update sends no post_save, which is what normally publishes the tracks and refreshes the catalogue.
+    for track in audio_tracks:
+        publish_video_event(video.id, audio_track_event(track))
+    invalidate_catalogue()
+    if errors:
+        # Failed like transcode_audio_for_video, once the tracks that made it are published.
+        raise errors[0]
+
+
+def dispatch_chunked_transcode(video, probe, ladder, audio_streams, trickplay=None, priority=None):
+    """
+    Split the source at keyframes and fan the chunks out across workers, each one a part
+    of the transcode. Audio is encoded whole by one more part, and the finalize part,
+    finalize_chunked_transcode, stitches everything once every other part has completed.
+    Each chunk writes the trickplay files for its own stretch of the video. Dispatching
+    again, as a resumed transcode does, only sends the parts that have not completed.
+    priority is the one the transcode was queued at, if it was.
+    """
+    keyframes = get_keyframe_index(probe)
+    chunks = split_at_keyframes(keyframes, probe.duration, settings.TRANSCODE_CHUNK_DURATION)
+    parts = [
+        (chunk_part(chunk_index), transcode_video_chunk, [
+            video.id, chunk_index, start, length, ladder, 70 // len(chunks), _chunk_trickplay(trickplay, chunk_index, start, length)
+        ])
+        for chunk_index, (start, length) in enumerate(chunks)
+    ]
+    parts.append((AUDIO_PART, transcode_audio_streams_for_video, [video.id, audio_streams]))
+    # Every part of the job keeps the priority it was queued at, which its whole cost earned
+    # (or a bulk import gave it); the queue comes from CELERY_TASK_ROUTES.
+    if priority is None:
+        priority = transcode_route(probe)['priority']
+    options = {'priority': priority}
+    # Recorded before any part is sent, so the finalize part exists when the last of them completes.
+    expect_part(video.id, FINALIZE_PART, finalize_chunked_transcode, [video.id, ladder, trickplay], options)
+    video.progress = 25
+    video.save(update_fields=['progress'])
+    queue_parts(video.id, parts, options)
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def transcode_video_chunk(self, video_id, chunk_index, start, duration, ladder, progress_step, trickplay=None):
+    """
+    Encode one keyframe-aligned chunk of the source, read straight from storage, and
+    upload its segments. The completed part records them for finalize_chunked_transcode.
+    """
+    part = claim_part(self, video_id, chunk_part(chunk_index))
+    if part is not None:
+        try:
+            with running(part):
+                result = _transcode_video_chunk(video_id, chunk_index, start, duration, ladder, progress_step, trickplay)
+        except Exception:
+            _part_failed(part)
+            raise
+        complete_part(part, result)
+    queue_finalize(video_id)
+
+
+def _transcode_video_chunk(video_id, chunk_index, start, duration, ladder, progress_step, trickplay):
+    video = Video.objects.get(id=video_id)
+    video_uuid = str(video.transcoding_uuid)
+    source_url = get_presigned_url('videos', video.video_file.name)
+    probe = get_media_probe(video)
+    # The last chunk has no duration: it runs to the end of the source.
+    length = duration if duration is not None else probe.duration - start
+    estimate = (probe.size or 0) * length / probe.duration * settings.TRANSCODE_SCRATCH_SIZE_FACTOR
+    with scratch_space(f'video-{video_id}-chunk-{chunk_index}', int(estimate)) as workspace:
+        output_folder = workspace.dir('hls')
+        with transcoded_uploader(video_uuid).watch(output_folder):
+            with metrics.stage('encode'):
+                encode_video_to_hls(
+                    source_url, output_folder, ladder, start=start, duration=duration,
+                    segment_prefix=f'vsegment_c{chunk_index}', output_format=video.output_format, trickplay=trickplay
+                )
+            segments = {}
+            thumbnails = trickplay and {
+                'start': start,
+                'duration': length,
+                'sheets': trickplay_sheets(output_folder, trickplay['suffix']),
+                'poster': os.path.exists(os.path.join(output_folder, 'poster.jpg')),
+            }
+            for rung in ladder + trickplay_rungs(trickplay):
+                playlist_path = os.path.join(output_folder, rendition_playlist_name(rung))
+                segments[rung['name']] = list_playlist_segments(playlist_path)
+                # Only the segments are published; the stitched playlist replaces the per-chunk ones.
+                os.remove(playlist_path)
+    Video.objects.filter(id=video_id).update(progress=F('progress') + progress_step)
+    video.refresh_from_db(fields=['status', 'progress', 'eta_seconds'])
+    publish_video_event(video_id, video_event(video))
+    return {
+        'chunk_index': chunk_index, 'segments': segments, 'thumbnails': thumbnails, 'stages': metrics.stage_timings(),
+    }
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def transcode_audio_streams_for_video(self, video_id, audio_streams):
+    """Encode every audio stream of the source, read straight from storage, for a chunked transcode."""
+    part = claim_part(self, video_id, AUDIO_PART)
+    if part is not None:
+        try:
+            with running(part):
+                video = Video.objects.get(id=video_id)
+                source_url = get_presigned_url('videos', video.video_file.name)
+                with scratch_space(f'video-{video_id}-audio') as workspace:
+                    output_folder = workspace.dir('hls')
+                    with transcoded_uploader(str(video.transcoding_uuid)).watch(output_folder):
+                        with metrics.stage('audio_encode'):
+                            audio_playlists = encode_audio_streams_to_hls(source_url, output_folder, audio_streams, video)
+        except Exception:
+            _part_failed(part)
+            raise
+        complete_part(part, {'audio_playlists': audio_playlists, 'stages': metrics.stage_timings()})
+    queue_finalize(video_id)
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def finalize_chunked_transcode(self, video_id, ladder, trickplay=None):
+    """
+    Stitch the per-chunk segments the completed parts recorded into one playlist per
+    rendition, index the chunks' thumbnail sprite sheets, and publish the master playlist.
+    """
+    part = claim_part(self, video_id, FINALIZE_PART)
+    if part is None:
+        return
+    video = Video.objects.get(id=video_id)
+    if video.status != 'completed':
+        try:
+            with running(part):
+                _finalize_chunked_transcode(video, ladder, trickplay)
+        except Exception:
+            _part_failed(part)
+            raise
+    complete_part(part)
+
+
+def _finalize_chunked_transcode(video, ladder, trickplay):
+    video_id = video.id
+    metrics.bind_job(Video, video.id)
+    video_uuid = str(video.transcoding_uuid)
+    results = part_results(video_id)
+    chunk_results = sorted((r for r in results if 'chunk_index' in r), key=lambda r: r['chunk_index'])
+    audio_results = [r for r in results if 'audio_playlists' in r]
+    # The parts ran on other workers; keep their stages (summed over chunks) with the job.
+    metrics.save_stage_timings(Video, video.id, 'transcode_video_chunk',
+                               metrics.merge_stage_timings(r['stages'] for r in chunk_results))
+    metrics.save_stage_timings(Video, video.id, 'transcode_audio_streams_for_video',
+                               metrics.merge_stage_timings(r['stages'] for r in audio_results))
+    bandwidths = {}
+    with scratch_space(f'video-{video_id}-stitched') as workspace:
+        output_folder = workspace.dir('hls')
+        with metrics.stage('playlist'):
+            rungs = ladder + trickplay_rungs(trickplay)
+            for rung in rungs:
+                chunks = [r['segments'][rung['name']] for r in chunk_results]
+                write_stitched_playlist(
+                    os.path.join(output_folder, rendition_playlist_name(rung)), chunks,
+                    iframes_only=rung.get('iframe_only', False)
+                )
+                bandwidths[rung['name']] = measure_segments_bandwidth(
+                    (segment['duration'], segment['size']) for segments in chunks for segment in segments
+                )
+            if trickplay:
+                write_trickplay_index(output_folder, trickplay, [
+                    (r['thumbnails']['start'], r['thumbnails']['duration'], r['thumbnails']['sheets'])
+                    for r in chunk_results
+                ])
+                video.thumbnails = f'{video_uuid}/thumbnails.vtt'
+                if any(r['thumbnails']['poster'] for r in chunk_results):
+                    video.poster = f'{video_uuid}/poster.jpg'
+            renditions = create_renditions(video, rungs, bandwidths)
+        transcoded_uploader(video_uuid).upload_folder(output_folder)
+    with metrics.stage('playlist'):
+        video.master_playlist = publish_master_playlist(video)
+    video.transcoded_video = renditions[0].playlist
+    video.status = 'completed'
+    video.progress = 100
+    video.save(update_fields=['transcoded_video', 'master_playlist', 'poster', 'thumbnails', 'status', 'progress'])
+    register_transcode_result(video)
+
+
+@shared_task
+def mark_transcode_failed(video_id):
+    Video.objects.filter(id=video_id).update(status='failed')
+    publish_video_event(video_id, video_event(Video.objects.get(id=video_id)))
+    invalidate_catalogue()
+
+
+def _part_failed(part):
+    """
+    After the claimed part's task raised: fail the video once the part is out of
+    attempts, and otherwise leave the part for reap_stale_parts() to retry.
+    """
+    if out_of_attempts(part):
+        mark_transcode_failed(part.video_id)
+    else:
+        logger.warning("%s failed on attempt %d; it will be retried", part, part.attempts)
+
+
+@shared_task
+def reap_stale_transcodes():
+    """
+    Run by celery beat every TRANSCODE_REAPER_INTERVAL: send the transcode parts whose
+    worker stopped beating to another worker, and fail the videos whose parts have run
+    out of attempts.
+    """
+    requeued, failed = reap_stale_parts()
+    for video_id in {part.video_id for part in failed}:
+        mark_transcode_failed(video_id)
+    return {'requeued': len(requeued), 'failed': len(failed)}
+
+
+def _go_live(video, live_stream, ladder):
+    """Record the live renditions and audio track and publish the master playlist."""
+    # Nothing has been measured yet, so the master advertises each rung's rate caps.
+    bandwidths = {rung['name']: (rung['maxrate'], rung['bitrate']) for rung in ladder}
+    renditions = create_renditions(video, ladder, bandwidths)
+    create_audio_tracks(video, [(live_stream.language, live_audio_playlist_name(live_stream))])
+    video.master_playlist = publish_master_playlist(video)
+    video.transcoded_video = renditions[0].playlist
+    video.status = 'live'
+    video.save(update_fields=['master_playlist', 'transcoded_video', 'status'])
+    live_stream.started_at = timezone.now()
+    live_stream.save(update_fields=['started_at'])
+
+
+def _follow_live_ingest(live_stream, process, uploader, ladder):
+    """
+    Publish the ingest's output until ffmpeg exits, stopping it when a stop is requested
+    or no encoder has connected within LIVE_INGEST_CONNECT_TIMEOUT. Returns whether the
+    stream ended as it should, i.e. it was stopped or the encoder disconnected.
+    """
+    video = live_stream.video
+    playlists = {rendition_playlist_name(rung) for rung in ladder} | {live_audio_playlist_name(live_stream)}
+    connect_deadline = time.monotonic() + settings.LIVE_INGEST_CONNECT_TIMEOUT
+    stopping_since = None
+    interrupted_twice = False
+    stopped = False
+    while process.poll() is None:
+        published = uploader.sync()
+        if live_stream.started_at is None and playlists <= published:
+            _go_live(video, live_stream, ladder)
+        if stopping_since is None:
+            stopped = LiveStream.objects.filter(id=live_stream.id, stop_requested=True).exists()
+            timed_out = live_stream.started_at is None and time.monotonic() > connect_deadline
+            if stopped or timed_out:
+                if timed_out:
+                    logger.warning("No encoder connected to live stream %s within %ss", live_stream.id,
+                                   settings.LIVE_INGEST_CONNECT_TIMEOUT)
+                # On SIGINT ffmpeg finishes its segments and ends the playlists.
+                process.send_signal(signal.SIGINT)
+                stopping_since = time.monotonic()
+        else:
+            stopping_for = time.monotonic() - stopping_since
+            if stopping_for > settings.LIVE_INGEST_STOP_TIMEOUT:
+                process.kill()
+            elif stopping_for > settings.LIVE_INGEST_STOP_TIMEOUT / 2 and not interrupted_twice:
+                # A second SIGINT interrupts a read blocked on the network (SRT), but also
+                # ffmpeg's last playlist writes; LiveUploader.finish() ends the playlists.
+                process.send_signal(signal.SIGINT)
+                interrupted_twice = True
+        time.sleep(settings.LIVE_INGEST_POLL_INTERVAL)
+    uploader.finish()
+    return live_stream.started_at is not None and (stopped or process.returncode == 0)
+
+
+@shared_task
+def ingest_live_stream(live_stream_id):
+    """
+    Run the ffmpeg ingest of a live stream and publish its rolling HLS window as segments
+    appear. The video goes live once every rendition has segments in storage, and ends
+    when the encoder disconnects or a stop is requested; the last window stays playable.
+    """
+    live_stream = LiveStream.objects.select_related('video').get(id=live_stream_id)
+    video = live_stream.video
+    video.status = 'in_progress'
+    video.save(update_fields=['status'])
+    metrics.bind_job(Video, video.id)
+    ladder = build_rendition_ladder(live_stream.source_width, live_stream.source_height)
+    # ffmpeg keeps about a window of segments besides the one in the playlist.
+    bits_per_second = sum(rung['maxrate'] for rung in ladder) + settings.HLS_AUDIO_BITRATE
+    estimate = int(2 * settings.LIVE_HLS_WINDOW * bits_per_second / 8)
+    try:
+        with scratch_space(f'live-{live_stream.id}', estimate) as workspace:
+            output_folder = workspace.dir('hls')
+            uploader = LiveUploader(
+                'videos', f'transcoded_videos/{video.transcoding_uuid}', output_folder,
+                workspace.dir('playlists'), settings.LIVE_HLS_WINDOW
+            )
+            process = subprocess.Popen(live_ingest_command(live_stream, output_folder, ladder))
+            try:
+                with metrics.stage('live') as live:
+                    ended = _follow_live_ingest(live_stream, process, uploader, ladder)
+                    live['bytes'] = uploader.uploaded_bytes
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                uploader.close()
+    except Exception as e:
+        video.status = 'failed'
+        video.save(update_fields=['status'])
+        raise e
+    live_stream.ended_at = timezone.now()
+    live_stream.save(update_fields=['ended_at'])
+    video.status = 'ended' if ended else 'failed'
+    video.save(update_fields=['status'])
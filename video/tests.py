@@ -1,3 +1,702 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from celery import current_app
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import checkpoints, tasks
+from .benchmark import _LocalRedis
+from .dedup import (
+    detach_transcode_result, find_transcode_result, register_transcode_result, reuse_stored_transcode,
+    reuse_transcode_result,
+)
+from .edge import DiskCache, RangeNotSatisfiable, byte_range
+from .forms import LiveStreamForm
+from .imports import enqueue_transcodes
+from .models import MediaProbe, TranscodePart, TranscodeResult, Video
+from .scheduling import MAX_PRIORITY
+from .tasks import _video_copy_blocker, _video_hls_output_args, build_rendition_ladder, plan_stream_copy, trickplay_plan
+from .utils import display_size, parse_hls_playlist, parse_media_probe, split_at_keyframes, write_stitched_playlist
+
+LADDER = [
+    {'name': '1080p', 'height': 1080},
+    {'name': '720p', 'height': 720},
+    {'name': '360p', 'height': 360},
+]
+
+
+def _probe_output(**video_stream):
+    return {
+        'format': {'duration': '10.0', 'format_name': 'mov,mp4,m4a,3gp,3g2,mj2'},
+        'streams': [dict({'index': 0, 'codec_type': 'video', 'width': 1920, 'height': 1080}, **video_stream)],
+    }
+
+
+class RotationTests(SimpleTestCase):
+    def test_display_matrix_rotation(self):
+        probe = parse_media_probe(_probe_output(side_data_list=[{'side_data_type': 'Display Matrix', 'rotation': -90}]))
+        self.assertEqual(probe['streams'][0]['rotation'], -90)
+
+    def test_rotate_tag_counts_the_other_way(self):
+        probe = parse_media_probe(_probe_output(tags={'rotate': '90'}))
+        self.assertEqual(probe['streams'][0]['rotation'], -90)
+
+    def test_unrotated(self):
+        probe = parse_media_probe(_probe_output())
+        self.assertEqual(probe['streams'][0]['rotation'], 0)
+
+    def test_display_size_swaps_quarter_turns(self):
+        for rotation in (90, -90, 270, -270):
+            self.assertEqual(display_size({'width': 1920, 'height': 1080, 'rotation': rotation}), (1080, 1920))
+        for rotation in (0, 180, -180, None):
+            self.assertEqual(display_size({'width': 1920, 'height': 1080, 'rotation': rotation}), (1920, 1080))
+
+    def test_display_size_of_probes_stored_before_rotation(self):
+        self.assertEqual(display_size({'width': 1920, 'height': 1080}), (1920, 1080))
+
+    @override_settings(HLS_RENDITION_LADDER=LADDER)
+    def test_portrait_ladder_keeps_aspect_ratio(self):
+        ladder = build_rendition_ladder(*display_size({'width': 1920, 'height': 1080, 'rotation': 90}))
+        self.assertEqual([(rung['width'], rung['height']) for rung in ladder], [(608, 1080), (404, 720), (202, 360)])
+
+    @override_settings(TRICKPLAY_ENABLED=True)
+    def test_portrait_trickplay(self):
+        plan = trickplay_plan({'width': 1920, 'height': 1080, 'rotation': -90}, 60)
+        thumbnail_width, thumbnail_height = plan['thumbnail']
+        self.assertGreater(thumbnail_height, thumbnail_width)
+        self.assertLess(plan['iframe']['width'], plan['iframe']['height'])
+
+
+class VideoCopyBlockerTests(SimpleTestCase):
+    top_rung = {'name': '1080p', 'maxrate': 8_000_000}
+
+    def _stream(self, **overrides):
+        return dict({
+            'codec_name': 'h264', 'profile': 'High', 'level': 40, 'pix_fmt': 'yuv420p',
+            'width': 1920, 'height': 1080, 'rotation': 0,
+        }, **overrides)
+
+    def test_compliant_stream_is_copied(self):
+        self.assertIsNone(_video_copy_blocker(self._stream(), 5_000_000, self.top_rung))
+
+    def test_rotated_stream_is_encoded(self):
+        self.assertEqual(
+            _video_copy_blocker(self._stream(rotation=-90), 5_000_000, self.top_rung), 'rotation -90 requires re-encode'
+        )
+
+
+class StreamCopyLadderTests(SimpleTestCase):
+    def _plan(self):
+        probe = SimpleNamespace(
+            video_stream={
+                'index': 0, 'codec_name': 'h264', 'profile': 'High', 'level': 40, 'pix_fmt': 'yuv420p',
+                'width': 1920, 'height': 1080, 'rotation': 0, 'bit_rate': 5_000_000,
+            },
+            audio_streams=[], bit_rate=5_000_000,
+        )
+        return plan_stream_copy(probe, build_rendition_ladder(1920, 1080))
+
+    def test_copy_tops_the_encoded_lower_rungs(self):
+        ladder, _, decisions = self._plan()
+        self.assertTrue(ladder[0]['copy'])
+        self.assertEqual([rung['name'] for rung in ladder], ['1080p', '720p', '480p', '360p'])
+        self.assertEqual(decisions['video']['ladder'], ['1080p', '720p', '480p', '360p'])
+        args = _video_hls_output_args('/out', ladder)
+        self.assertEqual(args[args.index('-c:v:0') + 1], 'copy')
+        self.assertEqual([args[args.index(f'-c:v:{idx}') + 1] for idx in (1, 2, 3)], ['libx264'] * 3)
+        # The encoded rungs take the copied rung's (the source's) keyframes.
+        self.assertEqual(args[args.index('-force_key_frames:v:1') + 1], 'source')
+
+    @override_settings(HLS_STREAM_COPY_LADDER=False)
+    def test_copy_alone_when_the_ladder_is_off(self):
+        ladder, _, decisions = self._plan()
+        self.assertEqual(decisions['video']['ladder'], ['1080p'])
+        self.assertNotIn('-filter_complex', _video_hls_output_args('/out', ladder))
+
+
+class LiveStreamFormTests(SimpleTestCase):
+    def setUp(self):
+        self.pipe_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pipe_dir)
+        settings_override = override_settings(LIVE_INGEST_PIPE_DIR=self.pipe_dir, LIVE_INGEST_BIND_HOSTS=['0.0.0.0'])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _clean(self, input_url):
+        form = LiveStreamForm()
+        form.cleaned_data = {'input_url': input_url}
+        return form.clean_input_url()
+
+    def test_accepts_listeners(self):
+        for input_url in ('srt://0.0.0.0:9998?mode=listener', 'rtmp://0.0.0.0:1935/live/key'):
+            self.assertEqual(self._clean(input_url), input_url)
+
+    def test_srt_must_listen(self):
+        for input_url in ('srt://0.0.0.0:9998', 'srt://0.0.0.0:9998?mode=caller'):
+            with self.assertRaises(ValidationError):
+                self._clean(input_url)
+
+    def test_must_bind_a_configured_host(self):
+        for input_url in ('rtmp://evil.example.com/live/key', 'srt://10.0.0.5:9998?mode=listener', 'http://0.0.0.0/'):
+            with self.assertRaises(ValidationError):
+                self._clean(input_url)
+
+    def test_accepts_a_fifo_in_the_pipe_dir(self):
+        path = os.path.join(self.pipe_dir, 'camera')
+        os.mkfifo(path)
+        self.assertEqual(self._clean(path), path)
+
+    def test_rejects_regular_files_and_paths_outside_the_pipe_dir(self):
+        path = os.path.join(self.pipe_dir, 'secrets')
+        open(path, 'w').close()
+        for input_url in (path, '/etc/passwd', os.path.join(self.pipe_dir, '..', 'camera')):
+            with self.assertRaises(ValidationError):
+                self._clean(input_url)
+
+
+class TranscodeResultTests(TestCase):
+    def setUp(self):
+        local_redis = mock.patch('video.locks._redis', _LocalRedis())
+        local_redis.start()
+        self.addCleanup(local_redis.stop)
+        self.owner = Video.objects.create(
+            title='Owner', video_file='videos/owner.mp4', transcoding_uuid=uuid.uuid4(), status='completed',
+            content_hash='c' * 64, encoding_profile_hash='p' * 64,
+            master_playlist='owner/master.m3u8', transcoded_video='owner/master.m3u8',
+        )
+        self.result = register_transcode_result(self.owner)
+
+    def _duplicate(self):
+        return Video(
+            title='Duplicate', video_file='videos/duplicate.mp4', transcoding_uuid=uuid.uuid4(),
+            content_hash='c' * 64, encoding_profile_hash='p' * 64,
+        )
+
+    def test_duplicate_reuses_the_tree(self):
+        video = reuse_transcode_result(self._duplicate(), self.result)
+        self.assertEqual(video.master_playlist, self.owner.master_playlist)
+        self.assertEqual(video.video_file.name, self.owner.video_file.name)
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.ref_count, 2)
+
+    def test_last_user_changing_the_tree_unregisters_it(self):
+        detach_transcode_result(self.owner)
+        self.assertIsNone(self.owner.transcode_result)
+        self.assertIsNone(find_transcode_result('c' * 64, 'p' * 64))
+        self.owner.refresh_from_db()
+        self.assertIsNone(self.owner.transcode_result_id)
+
+    def test_result_no_video_plays_from_is_stale(self):
+        Video.objects.filter(id=self.owner.id).update(transcode_result=None)
+        duplicate = self._duplicate()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertIsNone(reuse_transcode_result(duplicate, self.result))
+        self.assertIsNone(duplicate.pk)
+        self.assertFalse(TranscodeResult.objects.exists())
+        # The owner still holds the tree in its own folder, so it is kept.
+        self.assertEqual(callbacks, [])
+
+    def _share(self):
+        duplicate = reuse_transcode_result(self._duplicate(), self.result)
+        client = mock.patch('video.utils.client')
+        self.client = client.start()
+        self.addCleanup(client.stop)
+        self.client.list_objects.return_value = [
+            SimpleNamespace(object_name=f'transcoded_videos/{self.result.transcoding_uuid}/master.m3u8'),
+        ]
+        return duplicate
+
+    def test_sharer_changing_the_tree_copies_it(self):
+        duplicate = self._share()
+        detach_transcode_result(duplicate)
+        self.client.copy_object.assert_called_once()
+        duplicate.refresh_from_db()
+        self.assertIsNone(duplicate.transcode_result_id)
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.ref_count, 1)
+
+    def test_second_detach_drops_no_reference(self):
+        duplicate = self._share()
+        # Both tasks of a batch hold the same stale instance.
+        stale = Video.objects.get(id=duplicate.id)
+        detach_transcode_result(duplicate)
+        detach_transcode_result(stale)
+        self.client.copy_object.assert_called_once()
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.ref_count, 1)
+
+    def test_detach_only_decrements_a_reference_the_video_still_holds(self):
+        duplicate = self._share()
+        # The video lets go of the result while its copy runs.
+        self.client.copy_object.side_effect = (
+            lambda *args: Video.objects.filter(id=duplicate.id).update(transcode_result=None)
+        )
+        with self.captureOnCommitCallbacks() as callbacks:
+            detach_transcode_result(duplicate)
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.ref_count, 2)
+        # The copy went to the video's own folder, which whoever detached it may play from.
+        self.assertEqual(callbacks, [])
+
+    def test_direct_upload_is_hashed_and_reuses_the_tree(self):
+        video = self._duplicate()
+        video.content_hash = None
+        video.status = 'in_progress'
+        video.save()
+        with mock.patch('video.utils.client') as client:
+            self.assertTrue(reuse_stored_transcode(video, lambda: 'c' * 64))
+        client.remove_object.assert_called_once_with('videos', 'videos/duplicate.mp4')
+        video.refresh_from_db()
+        self.assertEqual(video.content_hash, 'c' * 64)
+        self.assertEqual(video.status, 'completed')
+        self.assertEqual(video.video_file.name, self.owner.video_file.name)
+        self.assertEqual(video.master_playlist, self.owner.master_playlist)
+
+    def test_direct_upload_of_new_content_is_transcoded(self):
+        video = self._duplicate()
+        video.content_hash = None
+        video.save()
+        self.assertFalse(reuse_stored_transcode(video, lambda: 'd' * 64))
+        video.refresh_from_db()
+        self.assertEqual(video.content_hash, 'd' * 64)
+
+    def test_hashed_upload_is_not_hashed_again(self):
+        video = self._duplicate()
+        video.content_hash = 'd' * 64
+        video.save()
+        content_hash = mock.Mock()
+        self.assertFalse(reuse_stored_transcode(video, content_hash))
+        content_hash.assert_not_called()
+
+    def test_stale_result_tree_is_deleted_once_no_video_is_in_it(self):
+        Video.objects.filter(id=self.owner.id).update(transcode_result=None, transcoding_uuid=uuid.uuid4())
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertIsNone(reuse_transcode_result(self._duplicate(), self.result))
+        self.assertEqual(len(callbacks), 1)
+
+
+class _Task:
+    """Stands in for a bound task: the name and arguments the checkpoints read, and a record of sends."""
+    def __init__(self, name, args=()):
+        self.name = name
+        self.request = SimpleNamespace(args=list(args))
+        self.sent = []
+
+    def apply_async(self, args, **options):
+        self.sent.append(args)
+
+
+@override_settings(TRANSCODE_HEARTBEAT_TIMEOUT=120, TRANSCODE_MAX_ATTEMPTS=3, TRANSCODE_RETRY_BACKOFF=60)
+class CheckpointTests(TestCase):
+    def setUp(self):
+        self.video = Video.objects.create(title='Chunked', video_file='videos/chunked.mp4', transcoding_uuid=uuid.uuid4())
+        self.chunk_task = _Task('video.tasks.transcode_video_chunk')
+        self.finalize_task = _Task('video.tasks.finalize_chunked_transcode')
+        send = mock.patch('video.checkpoints._send')
+        self.send = send.start()
+        self.addCleanup(send.stop)
+
+    def _queue_chunks(self, count=2):
+        checkpoints.expect_part(self.video.id, checkpoints.FINALIZE_PART, self.finalize_task, [self.video.id])
+        checkpoints.queue_parts(self.video.id, [
+            (checkpoints.chunk_part(idx), self.chunk_task, [self.video.id, idx]) for idx in range(count)
+        ])
+
+    def _part(self, name):
+        return TranscodePart.objects.get(video=self.video, name=name)
+
+    def _go_stale(self, name, attempts=None):
+        update = {'heartbeat_at': timezone.now() - timedelta(seconds=121)}
+        if attempts is not None:
+            update['attempts'] = attempts
+        TranscodePart.objects.filter(video=self.video, name=name).update(**update)
+
+    def test_duplicate_claim_returns_none(self):
+        self._queue_chunks()
+        self.assertIsNotNone(checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0'))
+        self.assertIsNone(checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0'))
+
+    def test_stale_part_is_claimable_again(self):
+        self._queue_chunks()
+        checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0')
+        self._go_stale('chunk-0')
+        part = checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0')
+        self.assertIsNotNone(part)
+        self.assertEqual(part.attempts, 2)
+
+    def test_completed_part_is_not_claimed(self):
+        self._queue_chunks()
+        checkpoints.complete_part(checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0'), {'chunk_index': 0})
+        self._go_stale('chunk-0')
+        self.assertIsNone(checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0'))
+
+    def test_reaper_requeues_then_fails_after_max_attempts(self):
+        self._queue_chunks()
+        checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0')
+        self._go_stale('chunk-0')
+        requeued, failed = checkpoints.reap_stale_parts()
+        self.assertEqual([part.name for part in requeued], ['chunk-0'])
+        self.assertEqual(failed, [])
+        self.assertEqual(self._part('chunk-0').status, 'queued')
+        self.send.assert_called_once()
+
+        checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0')
+        self._go_stale('chunk-0', attempts=3)
+        requeued, failed = checkpoints.reap_stale_parts()
+        self.assertEqual(requeued, [])
+        self.assertEqual([part.name for part in failed], ['chunk-0'])
+        self.assertEqual(self._part('chunk-0').status, 'failed')
+        self.send.assert_called_once()
+
+    def test_reaper_leaves_live_parts_alone(self):
+        self._queue_chunks()
+        checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0')
+        self.assertEqual(checkpoints.reap_stale_parts(), ([], []))
+
+    def _fail(self, name):
+        part = checkpoints.claim_part(self.chunk_task, self.video.id, name)
+        with self.assertRaises(RuntimeError), checkpoints.running(part):
+            raise RuntimeError('encode failed')
+        return part
+
+    def test_reaper_retries_a_failed_part_after_its_backoff(self):
+        self._queue_chunks()
+        self._fail('chunk-0')
+        self.assertEqual(self._part('chunk-0').status, 'failed')
+        self.assertEqual(checkpoints.reap_stale_parts(), ([], []))
+        TranscodePart.objects.filter(video=self.video, name='chunk-0').update(
+            heartbeat_at=timezone.now() - timedelta(seconds=61)
+        )
+        requeued, failed = checkpoints.reap_stale_parts()
+        self.assertEqual([part.name for part in requeued], ['chunk-0'])
+        self.assertEqual(self._part('chunk-0').status, 'queued')
+        self.send.assert_called_once()
+        # The second attempt backs off twice as long.
+        self._fail('chunk-0')
+        TranscodePart.objects.filter(video=self.video, name='chunk-0').update(
+            heartbeat_at=timezone.now() - timedelta(seconds=61)
+        )
+        self.assertEqual(checkpoints.reap_stale_parts(), ([], []))
+
+    def test_reaper_leaves_a_part_out_of_attempts_failed(self):
+        self._queue_chunks()
+        TranscodePart.objects.filter(video=self.video, name='chunk-0').update(attempts=2)
+        self.assertTrue(checkpoints.out_of_attempts(self._fail('chunk-0')))
+        TranscodePart.objects.filter(video=self.video, name='chunk-0').update(
+            heartbeat_at=timezone.now() - timedelta(days=1)
+        )
+        self.assertEqual(checkpoints.reap_stale_parts(), ([], []))
+        self.assertEqual(self._part('chunk-0').status, 'failed')
+
+    def test_video_fails_only_with_the_last_attempt(self):
+        self._queue_chunks()
+        args = [self.video.id, 0, 0, 60, [], 1]
+        with mock.patch('video.tasks._transcode_video_chunk', side_effect=RuntimeError('encode failed')), \
+                mock.patch('video.tasks.mark_transcode_failed') as mark_transcode_failed:
+            self.assertTrue(tasks.transcode_video_chunk.apply(args).failed())
+            mark_transcode_failed.assert_not_called()
+            TranscodePart.objects.filter(video=self.video, name='chunk-0').update(attempts=2)
+            self.assertTrue(tasks.transcode_video_chunk.apply(args).failed())
+            mark_transcode_failed.assert_called_once_with(self.video.id)
+
+    def test_finalize_is_sent_once_when_the_last_chunk_completes(self):
+        self._queue_chunks()
+        for idx in range(2):
+            part = checkpoints.claim_part(self.chunk_task, self.video.id, checkpoints.chunk_part(idx))
+            checkpoints.complete_part(part, {'chunk_index': idx})
+            checkpoints.queue_finalize(self.video.id)
+            self.assertEqual(self.send.call_count, idx)
+        self.send.assert_called_once_with(self._part(checkpoints.FINALIZE_PART))
+        self.assertEqual(
+            sorted(result['chunk_index'] for result in checkpoints.part_results(self.video.id)), [0, 1]
+        )
+
+    def test_resent_finalize_runs_once(self):
+        self._queue_chunks(1)
+        checkpoints.complete_part(checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0'))
+        checkpoints.queue_finalize(self.video.id)
+        # A redelivered chunk sends finalize again in case the first send was lost.
+        checkpoints.queue_finalize(self.video.id)
+        self.assertEqual(self.send.call_count, 2)
+        self.assertIsNotNone(checkpoints.claim_part(self.finalize_task, self.video.id, checkpoints.FINALIZE_PART))
+        self.assertIsNone(checkpoints.claim_part(self.finalize_task, self.video.id, checkpoints.FINALIZE_PART))
+
+    def test_finalize_waits_for_every_part(self):
+        self._queue_chunks(1)
+        self.assertIsNone(checkpoints.claim_part(self.finalize_task, self.video.id, checkpoints.FINALIZE_PART))
+
+    def test_dispatching_again_skips_completed_chunks(self):
+        self._queue_chunks(3)
+        self.assertEqual(len(self.chunk_task.sent), 3)
+        checkpoints.complete_part(checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-0'))
+        checkpoints.claim_part(self.chunk_task, self.video.id, 'chunk-1')
+        self.chunk_task.sent.clear()
+        self._queue_chunks(3)
+        # chunk-0 is done and chunk-1 is running on a live worker.
+        self.assertEqual(self.chunk_task.sent, [[self.video.id, 2]])
+
+
+class SplitAtKeyframesTests(SimpleTestCase):
+    def test_chunks_start_on_keyframes(self):
+        keyframes = [float(t) for t in range(0, 22, 2)]
+        self.assertEqual(split_at_keyframes(keyframes, 21, 6), [(0.0, 6.0), (6.0, 6.0), (12.0, 6.0), (18.0, None)])
+
+    def test_last_chunk_has_no_duration(self):
+        chunks = split_at_keyframes([0.0, 5.0, 10.0], 12.5, 5)
+        self.assertIsNone(chunks[-1][1])
+        self.assertTrue(all(length is not None for _, length in chunks[:-1]))
+
+    def test_sparse_keyframes_merge_chunks(self):
+        # Targets 10 and 15 both land on the keyframe at 15.
+        self.assertEqual(split_at_keyframes([0.0, 7.0, 15.0], 20, 5), [(0.0, 7.0), (7.0, 8.0), (15.0, None)])
+
+    def test_no_keyframe_before_the_end_is_one_chunk(self):
+        self.assertEqual(split_at_keyframes([0.0, 1.0], 10, 3), [(0.0, None)])
+        self.assertEqual(split_at_keyframes([0.0, 10.0], 10, 5), [(0.0, None)])
+
+    def test_source_shorter_than_a_chunk(self):
+        self.assertEqual(split_at_keyframes([0.0], 4, 60), [(0.0, None)])
+
+
+def _segment(uri, duration=4.0, byterange=None, init_section=None):
+    return {'uri': uri, 'duration': duration, 'byterange': byterange, 'map': init_section}
+
+
+class PlaylistTestCase(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def _write(self, chunks, **kwargs):
+        path = os.path.join(self.folder, 'stitched.m3u8')
+        write_stitched_playlist(path, chunks, **kwargs)
+        with open(path) as f:
+            return path, f.read().splitlines()
+
+
+class WriteStitchedPlaylistTests(PlaylistTestCase):
+    def test_discontinuity_between_chunks_only(self):
+        _, lines = self._write([[_segment('c0_0.ts'), _segment('c0_1.ts')], [_segment('c1_0.ts', 3.2)]])
+        self.assertEqual(lines[:5], [
+            '#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD',
+        ])
+        self.assertEqual(lines[5:], [
+            '#EXTINF:4.000000,', 'c0_0.ts', '#EXTINF:4.000000,', 'c0_1.ts',
+            '#EXT-X-DISCONTINUITY', '#EXTINF:3.200000,', 'c1_0.ts', '#EXT-X-ENDLIST',
+        ])
+
+    def test_empty_chunk_adds_no_discontinuity(self):
+        _, lines = self._write([[_segment('c0_0.ts')], [], [_segment('c2_0.ts')]])
+        self.assertEqual(lines.count('#EXT-X-DISCONTINUITY'), 1)
+
+    def test_target_duration_rounds_up(self):
+        _, lines = self._write([[_segment('c0_0.ts', 4.004)], [_segment('c1_0.ts', 2.0)]])
+        self.assertIn('#EXT-X-TARGETDURATION:5', lines)
+
+    def test_round_trips_through_the_parser(self):
+        chunks = [[_segment('c0_0.ts'), _segment('c0_1.ts', 1.5)], [_segment('c1_0.ts', 2.5)]]
+        path, _ = self._write(chunks)
+        self.assertEqual(parse_hls_playlist(path), [segment for chunk in chunks for segment in chunk])
+
+
+class ParseHlsPlaylistTests(PlaylistTestCase):
+    def _parse(self, text):
+        path = os.path.join(self.folder, 'media.m3u8')
+        with open(path, 'w') as f:
+            f.write(text)
+        return parse_hls_playlist(path)
+
+    def test_single_file_byteranges(self):
+        segments = self._parse(
+            '#EXTM3U\n#EXT-X-VERSION:6\n#EXT-X-TARGETDURATION:4\n'
+            '#EXT-X-MAP:URI="video_720p.mp4",BYTERANGE="800@0"\n'
+            '#EXTINF:4.000000,\n#EXT-X-BYTERANGE:1000@800\nvideo_720p.mp4\n'
+            # No offset: the range continues where the last one on this file ended.
+            '#EXTINF:3.500000,\n#EXT-X-BYTERANGE:500\nvideo_720p.mp4\n'
+            '#EXT-X-ENDLIST\n'
+        )
+        init_section = {'uri': 'video_720p.mp4', 'byterange': [800, 0]}
+        self.assertEqual(segments, [
+            _segment('video_720p.mp4', 4.0, [1000, 800], init_section),
+            _segment('video_720p.mp4', 3.5, [500, 1800], init_section),
+        ])
+
+    def test_fmp4_segments_share_the_init_section(self):
+        segments = self._parse(
+            '#EXTM3U\n#EXT-X-MAP:URI="init_720p.mp4"\n'
+            '#EXTINF:4,\nseg_0.m4s\n#EXTINF:4,\nseg_1.m4s\n#EXT-X-ENDLIST\n'
+        )
+        self.assertEqual([segment['map'] for segment in segments], [{'uri': 'init_720p.mp4', 'byterange': None}] * 2)
+
+    def test_mpegts_segments_have_no_init_section(self):
+        segments = self._parse('#EXTM3U\n#EXTINF:4.0,title\nseg_0.ts\n#EXT-X-ENDLIST\n')
+        self.assertEqual(segments, [_segment('seg_0.ts')])
+
+
+class StitchFmp4PlaylistTests(PlaylistTestCase):
+    def test_map_is_written_again_for_each_chunk(self):
+        first = {'uri': 'init_c0.mp4', 'byterange': None}
+        second = {'uri': 'init_c1.mp4', 'byterange': None}
+        _, lines = self._write([
+            [_segment('c0_0.m4s', init_section=first), _segment('c0_1.m4s', init_section=first)],
+            [_segment('c1_0.m4s', init_section=second)],
+        ])
+        self.assertIn('#EXT-X-VERSION:6', lines)
+        maps = [idx for idx, line in enumerate(lines) if line.startswith('#EXT-X-MAP:')]
+        self.assertEqual([lines[idx] for idx in maps], ['#EXT-X-MAP:URI="init_c0.mp4"', '#EXT-X-MAP:URI="init_c1.mp4"'])
+        # The new init section follows the discontinuity it belongs to.
+        self.assertEqual(lines[maps[1] - 1], '#EXT-X-DISCONTINUITY')
+
+    def test_byteranges_are_written_with_offsets(self):
+        first = {'uri': 'c0.mp4', 'byterange': [800, 0]}
+        second = {'uri': 'c1.mp4', 'byterange': [790, 0]}
+        chunks = [
+            [_segment('c0.mp4', 4.0, [1000, 800], first), _segment('c0.mp4', 2.0, [500, 1800], first)],
+            [_segment('c1.mp4', 4.0, [900, 790], second)],
+        ]
+        path, lines = self._write(chunks)
+        self.assertIn('#EXT-X-MAP:URI="c0.mp4",BYTERANGE="800@0"', lines)
+        self.assertIn('#EXT-X-MAP:URI="c1.mp4",BYTERANGE="790@0"', lines)
+        self.assertEqual([line for line in lines if line.startswith('#EXT-X-BYTERANGE:')], [
+            '#EXT-X-BYTERANGE:1000@800', '#EXT-X-BYTERANGE:500@1800', '#EXT-X-BYTERANGE:900@790',
+        ])
+        self.assertEqual(parse_hls_playlist(path), [segment for chunk in chunks for segment in chunk])
+
+    def test_iframe_playlist(self):
+        _, lines = self._write([[_segment('c0.ts', 2.0, [188, 0])]], iframes_only=True)
+        self.assertIn('#EXT-X-VERSION:4', lines)
+        self.assertIn('#EXT-X-I-FRAMES-ONLY', lines)
+
+
+class ByteRangeTests(SimpleTestCase):
+    def test_no_header_is_the_whole_object(self):
+        self.assertIsNone(byte_range(None, 1000))
+        self.assertIsNone(byte_range('', 1000))
+
+    def test_closed_and_open_ranges(self):
+        self.assertEqual(byte_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(byte_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(byte_range('bytes=900-5000', 1000), (900, 999))
+
+    def test_suffix_ranges(self):
+        self.assertEqual(byte_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(byte_range('bytes=-5000', 1000), (0, 999))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=1000-', 'bytes=2000-3000', 'bytes=-0'):
+            with self.assertRaises(RangeNotSatisfiable):
+                byte_range(header, 1000)
+
+    def test_multiple_ranges_fall_back_to_the_whole_object(self):
+        self.assertIsNone(byte_range('bytes=0-99,200-299', 1000))
+
+    def test_malformed_ranges_fall_back_to_the_whole_object(self):
+        for header in ('bytes=abc-', 'bytes=5', 'items=0-99', 'bytes=500-100'):
+            self.assertIsNone(byte_range(header, 1000), header)
+
+
+class _StoredObject:
+    """A storage response streaming data, held back until released is set."""
+    def __init__(self, data, released):
+        self.data = data
+        self.released = released
+
+    def stream(self, amount):
+        self.released.wait(5)
+        for offset in range(0, len(self.data), amount):
+            yield self.data[offset:offset + amount]
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class DiskCacheFillTests(SimpleTestCase):
+    object_name = 'transcoded_videos/title/video_720p.mp4'
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(EDGE_CACHE_DIR=root, EDGE_DISK_FILL_SIZE=1024)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.data = os.urandom(4096)
+        self.released = threading.Event()
+        self.client = mock.Mock()
+        self.client.stat_object.return_value = SimpleNamespace(etag='etag', size=len(self.data))
+        self.client.get_object.side_effect = lambda *args, **kwargs: _StoredObject(self.data, self.released)
+        client = mock.patch('video.utils.client', self.client)
+        client.start()
+        self.addCleanup(client.stop)
+        self.disk = DiskCache(root)
+
+    def test_large_miss_passes_through_while_the_cache_fills(self):
+        cached, result = self.disk.load(self.object_name)
+        self.assertEqual(result, 'passthrough')
+        self.assertIsNone(cached.path)
+        # Still filling: the next request passes through too, without a second fetch.
+        self.assertEqual(self.disk.load(self.object_name)[1], 'passthrough')
+        self.released.set()
+        for _ in range(100):
+            if not self.disk._filling:
+                break
+            time.sleep(0.05)
+        cached, result = self.disk.load(self.object_name)
+        self.assertEqual(result, 'disk')
+        with open(cached.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.client.get_object.assert_called_once()
+
+    @override_settings(EDGE_DISK_FILL_SIZE=8192)
+    def test_small_miss_is_fetched_before_serving(self):
+        self.released.set()
+        cached, result = self.disk.load(self.object_name)
+        self.assertEqual(result, 'origin')
+        self.assertEqual(os.path.getsize(cached.path), len(self.data))
+
+
+@override_settings(TRANSCODE_CHUNK_DURATION=60)
+class BulkImportPriorityTests(TestCase):
+    def setUp(self):
+        self.video = Video.objects.create(title='Imported', video_file='videos/imports/a.mp4', transcoding_uuid=uuid.uuid4())
+        self.probe = MediaProbe.objects.create(
+            video=self.video, duration=7200, container='mov,mp4,m4a,3gp,3g2,mj2', size=1,
+            streams=[{'index': 0, 'codec_type': 'video', 'width': 1280, 'height': 720}],
+        )
+        # Celery runs the import's schedule_transcode in place; the transcode parts are only recorded.
+        self.addCleanup(setattr, current_app.conf, 'task_always_eager', current_app.conf.task_always_eager)
+        current_app.conf.task_always_eager = True
+
+    def test_import_queues_the_transcode_at_the_lowest_priority(self):
+        with mock.patch.object(tasks.transcode_video, 'apply_async') as send:
+            enqueue_transcodes([self.video.id], rate=1000)
+        part = TranscodePart.objects.get(video=self.video, name=checkpoints.VIDEO_PART)
+        self.assertEqual(part.options['priority'], MAX_PRIORITY)
+        send.assert_called_once_with([self.video.id], **part.options)
+
+    def test_upload_of_the_same_cost_is_queued_ahead(self):
+        with mock.patch.object(tasks.transcode_video, 'apply_async'):
+            tasks.schedule_transcode(self.video.id)
+        part = TranscodePart.objects.get(video=self.video, name=checkpoints.VIDEO_PART)
+        self.assertLess(part.options['priority'], MAX_PRIORITY)
+
+    def test_chunks_keep_the_priority_the_transcode_was_queued_at(self):
+        keyframes = [float(t) for t in range(0, 7200, 2)]
+        with mock.patch.object(tasks, 'get_keyframe_index', return_value=keyframes), \
+                mock.patch.object(tasks.transcode_video_chunk, 'apply_async'), \
+                mock.patch.object(tasks.transcode_audio_streams_for_video, 'apply_async'):
+            tasks.dispatch_chunked_transcode(self.video, self.probe, [{'name': '720p'}], [], None, MAX_PRIORITY)
+        parts = TranscodePart.objects.filter(video=self.video)
+        self.assertEqual(parts.count(), 7200 // 60 + 2)
+        self.assertEqual({part.options['priority'] for part in parts}, {MAX_PRIORITY})
@@ -0,0 +1,319 @@
+import os
+import hashlib
+import logging
+import mimetypes
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from minio.error import S3Error
+from . import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.aac': 'audio/aac',
+    '.vtt': 'text/vtt',
+}
+
+PLAYLIST_EXTENSION = '.m3u8'
+WATCH_INTERVAL = 0.5  # seconds
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def content_type_for(path):
+    extension = os.path.splitext(path)[1].lower()
+    return CONTENT_TYPES.get(extension) or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def upload_file_if_changed(bucket_name, object_name, local_path):
+    """
+    Upload a file unless an object with the same size and MD5 already exists.
+    The MD5 is stored as object metadata because multipart ETags are not content hashes.
+    Returns True if the file was uploaded.
+    """
+    size = os.path.getsize(local_path)
+    md5 = file_md5(local_path)
+    try:
+        stat = utils.client.stat_object(bucket_name, object_name)
+    except S3Error as e:
+        if e.code not in ('NoSuchKey', 'NoSuchObject', 'ResourceNotFound'):
+            raise
+        stat = None
+    if stat and stat.size == size and md5 in (stat.metadata.get('x-amz-meta-md5'), stat.etag):
+        return False
+    utils.client.fput_object(
+        bucket_name, object_name, local_path,
+        content_type=content_type_for(local_path),
+        metadata={'md5': md5},
+        part_size=settings.MINIO_UPLOAD_PART_SIZE,
+    )
+    return True
+
+
+class SegmentUploader:
+    """
+    Uploads transcoded HLS output under bucket_name/prefix from a bounded thread pool,
+    sharing the MinIO client's connection pool.
+
+    Media files always go up before playlists, so a published playlist never
+    references a segment that is not in storage yet.
+    """
+
+    def __init__(self, bucket_name, prefix, max_workers=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.rstrip('/')
+        self.max_workers = max_workers or settings.MINIO_UPLOAD_CONCURRENCY
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.uploaded_bytes = 0
+
+    def object_name(self, folder, local_path):
+        return f'{self.prefix}/{os.path.relpath(local_path, folder)}'
+
+    def _submit(self, executor, folder, local_path):
+        with self._lock:
+            if local_path in self._futures:
+                return
+            self._futures[local_path] = executor.submit(self._upload, self.object_name(folder, local_path), local_path)
+
+    def _upload(self, object_name, local_path):
+        if upload_file_if_changed(self.bucket_name, object_name, local_path):
+            with self._lock:
+                self.uploaded_bytes += os.path.getsize(local_path)
+
+    def _wait(self):
+        with self._lock:
+            futures = list(self._futures.items())
+        for _, future in futures:
+            future.result()
+
+    def _upload_remaining(self, executor, folder):
+        # Under watch() this times only the tail left once encoding is done; the bytes
+        # include the segments uploaded while ffmpeg was running.
+        with metrics.stage('upload') as upload:
+            self._upload_files(executor, folder)
+            upload['bytes'] = self.uploaded_bytes
+
+    def _upload_files(self, executor, folder):
+        files = []
+        for root, _, names in os.walk(folder):
+            files.extend(os.path.join(root, name) for name in names)
+        media = [f for f in files if not f.endswith(PLAYLIST_EXTENSION)]
+        playlists = [f for f in files if f.endswith(PLAYLIST_EXTENSION)]
+        for local_path in media:
+            self._submit(executor, folder, local_path)
+        self._wait()
+        for local_path in playlists:
+            # Playlists may have changed since an earlier pass, so always re-check them.
+            self._futures.pop(local_path, None)
+            self._submit(executor, folder, local_path)
+        self._wait()
+
+    def upload_folder(self, folder):
+        """Upload everything in folder, skipping objects that are already up to date."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self._upload_remaining(executor, folder)
+
+    def _playlist_segments(self, folder, playlist_path):
+        # ffmpeg only adds a segment to its playlist once the segment file is closed.
+        # A byte-range segment lives in a file ffmpeg keeps appending to (single_file
+        # output), so that file waits for the final upload; an fMP4 init section is
+        # complete once a segment refers to it.
+        segments = set()
+        try:
+            entries = utils.parse_hls_playlist(playlist_path)
+        except (FileNotFoundError, KeyError, ValueError):
+            return segments
+        for segment in entries:
+            if segment['byterange']:
+                continue
+            uris = [segment['uri']]
+            if segment['map']:
+                uris.append(segment['map']['uri'])
+            for uri in uris:
+                local_path = os.path.join(folder, uri)
+                if os.path.isfile(local_path):
+                    segments.add(local_path)
+        return segments
+
+    def _completed_segments(self, folder):
+        segments = set()
+        for name in os.listdir(folder):
+            if name.endswith(PLAYLIST_EXTENSION):
+                segments |= self._playlist_segments(folder, os.path.join(folder, name))
+        return segments
+
+    @contextmanager
+    def watch(self, folder):
+        """
+        Upload each segment as soon as ffmpeg closes it while the body of the
+        with-block runs, then upload whatever is left (playlists last) on exit.
+        Nothing more is uploaded if the body raises.
+        """
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        def poll():
+            while not stop.is_set():
+                for local_path in self._completed_segments(folder):
+                    self._submit(executor, folder, local_path)
+                stop.wait(WATCH_INTERVAL)
+
+        watcher = threading.Thread(target=poll, daemon=True)
+        watcher.start()
+        try:
+            yield self
+        except BaseException:
+            stop.set()
+            watcher.join()
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        stop.set()
+        watcher.join()
+        try:
+            self._upload_remaining(executor, folder)
+        finally:
+            executor.shutdown(wait=True)
+
+
+class LiveUploader(SegmentUploader):
+    """
+    Keeps storage in step with the rolling HLS window ffmpeg writes to folder during a
+    live stream. Each sync() uploads the segments ffmpeg has closed, then the playlists
+    that list them, and deletes the segments that have been out of every playlist for
+    retain_seconds, so storage holds a bounded window however long the stream runs.
+
+    Playlists are copied to snapshot_dir before they are read, so the version uploaded
+    is exactly the one whose segments were uploaded first.
+    """
+
+    def __init__(self, bucket_name, prefix, folder, snapshot_dir, retain_seconds, max_workers=None):
+        super().__init__(bucket_name, prefix, max_workers)
+        self.folder = folder
+        self.snapshot_dir = snapshot_dir
+        self.retain_seconds = retain_seconds
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._playlists = {}
+        self._left_playlists_at = {}
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    @property
+    def published(self):
+        """Names of the playlists in storage."""
+        return set(self._playlists)
+
+    def _snapshot_playlists(self):
+        snapshots = {}
+        for name in os.listdir(self.folder):
+            if not name.endswith(PLAYLIST_EXTENSION):
+                continue
+            snapshot = os.path.join(self.snapshot_dir, name)
+            try:
+                shutil.copyfile(os.path.join(self.folder, name), snapshot)
+            except FileNotFoundError:
+                continue
+            snapshots[name] = snapshot
+        return snapshots
+
+    def _settle(self, local_paths):
+        """Wait for the uploads of local_paths; failed ones are logged and retried on the next sync."""
+        ok = True
+        for local_path in local_paths:
+            with self._lock:
+                future = self._futures.get(local_path)
+            if future is None:
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning("Could not upload %s, will retry: %s", local_path, e)
+                with self._lock:
+                    self._futures.pop(local_path, None)
+                ok = False
+        return ok
+
+    def _upload_playlist(self, name, snapshot):
+        with open(snapshot, 'rb') as f:
+            content = f.read()
+        if self._playlists.get(name) == content:
+            return
+        # A live playlist changes with every segment; players and caches must not hold on to it.
+        utils.client.fput_object(
+            self.bucket_name, f'{self.prefix}/{name}', snapshot,
+            content_type=content_type_for(snapshot),
+            metadata={'Cache-Control': 'no-cache'},
+        )
+        self._playlists[name] = content
+
+    def _expire(self, segments):
+        now = time.monotonic()
+        for local_path in list(self._futures):
+            if local_path in segments:
+                self._left_playlists_at.pop(local_path, None)
+                continue
+            if now - self._left_playlists_at.setdefault(local_path, now) < self.retain_seconds:
+                continue
+            try:
+                utils.client.remove_object(self.bucket_name, self.object_name(self.folder, local_path))
+            except Exception as e:
+                logger.warning("Could not delete expired segment %s, will retry: %s", local_path, e)
+                continue
+            with self._lock:
+                del self._futures[local_path]
+            del self._left_playlists_at[local_path]
+
+    def sync(self):
+        """Publish what ffmpeg has written since the last sync. Returns the names of the playlists in storage."""
+        playlists = {}
+        for name, snapshot in self._snapshot_playlists().items():
+            segments = self._playlist_segments(self.folder, snapshot)
+            # An ffmpeg killed while rewriting a playlist leaves it empty; keep the last good one.
+            if segments:
+                playlists[name] = (snapshot, segments)
+        segments = set().union(*(segments for _, segments in playlists.values()))
+        for local_path in segments:
+            self._submit(self._executor, self.folder, local_path)
+        if not self._settle(segments):
+            return self.published
+        uploaded = True
+        for name, (snapshot, _) in playlists.items():
+            try:
+                self._upload_playlist(name, snapshot)
+            except Exception as e:
+                logger.warning("Could not upload playlist %s, will retry: %s", name, e)
+                uploaded = False
+        # Segments of a playlist that wasn't republished may still be listed in storage.
+        if uploaded and set(playlists) == self.published:
+            self._expire(segments)
+        return self.published
+
+    def finish(self):
+        """
+        Publish the last of ffmpeg's output once it has exited, and end every playlist
+        with EXT-X-ENDLIST, which ffmpeg never writes if it is killed.
+        """
+        self.sync()
+        for name, content in list(self._playlists.items()):
+            if b'#EXT-X-ENDLIST' in content:
+                continue
+            snapshot = os.path.join(self.snapshot_dir, name)
+            with open(snapshot, 'wb') as f:
+                f.write(content.rstrip(b'\n') + b'\n#EXT-X-ENDLIST\n')
+            self._upload_playlist(name, snapshot)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -7,4 +7,13 @@ urlpatterns = [
     path('upload/', views.upload_video, name='upload'),
     path('list/', views.video_list, name='list'),
     path('<int:pk>/', views.video_detail, name='detail'),
+    path('<int:pk>/events/', views.video_events, name='events'),
+    path('<int:pk>/audio/', views.upload_audio_tracks, name='audio_tracks'),
+    path('play/<path:key>', views.playback, name='playback'),
+    path('live/', views.start_live_stream, name='live_start'),
+    path('<int:pk>/live/stop/', views.stop_live_stream, name='live_stop'),
+    path('uploads/', views.start_upload_session, name='upload_session_start'),
+    path('uploads/<uuid:pk>/', views.upload_session, name='upload_session'),
+    path('uploads/<uuid:pk>/parts/', views.presign_upload_parts, name='upload_session_parts'),
+    path('uploads/<uuid:pk>/complete/', views.complete_upload_session, name='upload_session_complete'),
 ]
@@ -1,18 +1,38 @@
 import os
+import functools
 import uuid
+import math
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from datetime import timedelta
 import subprocess
 import json
+import re
 import langcodes
+import urllib3
+from django.conf import settings
 from langcodes import standardize_tag
 from minio import Minio
 
+logger = logging.getLogger(__name__)
+
+# One connection pool shared by every download/upload thread in the process.
 client = Minio(
     'localhost:9000',
     access_key='admin',
     secret_key='admin123',
-    secure=False
+    secure=False,
+    http_client=urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=300, read=300),
+        maxsize=settings.MINIO_MAX_POOL_CONNECTIONS,
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
 )
 
+@functools.lru_cache(maxsize=1024)
 def get_language_display_name(language_code):
     language_code = standardize_tag(language_code)
     language = langcodes.Language.make(language_code)
@@ -21,29 +41,469 @@ def get_language_display_name(language_code):
 def create_uuid():
     return str(uuid.uuid4())
 
-def make_download_directory(video_uuid):
-    folder_path = os.path.join('downloads', video_uuid)
-    os.makedirs(folder_path, exist_ok=True)
-    return folder_path
+def encoding_profile_hash(output_format):
+    """Hash of every setting that changes the transcoded output, for matching reusable results."""
+    profile = {
+        'segment_duration': settings.HLS_SEGMENT_DURATION,
+        'audio_bitrate': settings.HLS_AUDIO_BITRATE,
+        'ladder': settings.HLS_RENDITION_LADDER,
+        'stream_copy': settings.HLS_STREAM_COPY,
+        'stream_copy_ladder': settings.HLS_STREAM_COPY_LADDER,
+        'per_title': settings.PER_TITLE_ENCODING and [
+            settings.PER_TITLE_CRF, settings.PER_TITLE_PROBE_PRESET, settings.PER_TITLE_SAMPLE_COUNT,
+            settings.PER_TITLE_SAMPLE_DURATION, settings.PER_TITLE_MAX_SAMPLED_FRACTION, settings.PER_TITLE_HEADROOM,
+            settings.PER_TITLE_MIN_BITRATE_RATIO, settings.PER_TITLE_MAX_BITRATE_RATIO,
+        ],
+        'output_format': output_format,
+        'trickplay': settings.TRICKPLAY_ENABLED and {
+            'poster': [settings.TRICKPLAY_POSTER_TIME, settings.TRICKPLAY_POSTER_WIDTH],
+            'thumbnails': [
+                settings.TRICKPLAY_THUMBNAIL_INTERVAL, settings.TRICKPLAY_THUMBNAIL_WIDTH,
+                settings.TRICKPLAY_SPRITE_COLUMNS, settings.TRICKPLAY_SPRITE_ROWS,
+            ],
+            'iframes': [settings.TRICKPLAY_IFRAME_INTERVAL, settings.TRICKPLAY_IFRAME_HEIGHT, settings.TRICKPLAY_IFRAME_CRF],
+        },
+    }
+    return hashlib.sha256(json.dumps(profile, sort_keys=True).encode()).hexdigest()
+
+class DownloadProgress:
+    """Thread-safe byte counter for a download, reporting (done, total, bytes/sec) to a callback."""
+
+    def __init__(self, total, callback=None):
+        self.total = total
+        self.done = 0
+        self.callback = callback
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        if self.callback:
+            self.callback(self.done, self.total, self.rate)
+
+def _is_plain_md5_etag(etag):
+    # Multipart uploads get "<md5-of-part-md5s>-<parts>" ETags that can't be checked against the content.
+    return bool(etag) and '-' not in etag
+
+def _download_stream(bucket_name, file_key, download_path, etag, progress):
+    chunk_size = settings.MINIO_DOWNLOAD_CHUNK_SIZE
+    md5 = hashlib.md5() if _is_plain_md5_etag(etag) else None
+    response = client.get_object(bucket_name, file_key, request_headers={'If-Match': f'"{etag}"'})
+    try:
+        with open(download_path, 'wb') as f:
+            for data in response.stream(chunk_size):
+                f.write(data)
+                if md5:
+                    md5.update(data)
+                progress.add(len(data))
+                progress.report()
+    finally:
+        response.close()
+        response.release_conn()
+    if md5 and md5.hexdigest() != etag:
+        raise IOError(f"Checksum mismatch downloading {file_key}: expected {etag}, got {md5.hexdigest()}")
+
+def _download_range(bucket_name, file_key, fd, offset, length, etag, progress):
+    chunk_size = settings.MINIO_DOWNLOAD_CHUNK_SIZE
+    # If-Match makes every range fail if the object is replaced halfway through the download.
+    response = client.get_object(
+        bucket_name, file_key, offset=offset, length=length, request_headers={'If-Match': f'"{etag}"'}
+    )
+    try:
+        position = offset
+        for data in response.stream(chunk_size):
+            os.pwrite(fd, data, position)
+            position += len(data)
+            progress.add(len(data))
+    finally:
+        response.close()
+        response.release_conn()
+    if position != offset + length:
+        raise IOError(f"Short read downloading {file_key} at {offset}: got {position - offset} of {length} bytes")
 
-def make_transcoded_directory(base_path, video_uuid):
-    folder_path = os.path.join(base_path, video_uuid)
-    os.makedirs(folder_path, exist_ok=True)
-    return folder_path
+def _download_ranges(bucket_name, file_key, download_path, size, etag, progress):
+    part_size = settings.MINIO_DOWNLOAD_PART_SIZE
+    fd = os.open(download_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Reserve the whole file up front so each range can be written in place.
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=settings.MINIO_DOWNLOAD_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(_download_range, bucket_name, file_key, fd, offset, min(part_size, size - offset), etag, progress)
+                for offset in range(0, size, part_size)
+            ]
+            pending = futures
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+                progress.report()
+                for future in done:
+                    if future.exception():
+                        for other in pending:
+                            other.cancel()
+                        raise future.exception()
+    finally:
+        os.close(fd)
 
-def download_file_from_minio(bucket_name, file_key, download_path):
+def download_file_from_minio(bucket_name, file_key, download_path, progress_callback=None):
+    """
+    Stream an object to disk in MINIO_DOWNLOAD_CHUNK_SIZE pieces. Objects of at least
+    MINIO_PARALLEL_DOWNLOAD_THRESHOLD bytes are fetched as parallel range requests
+    written in place with os.pwrite, so memory stays bounded by chunk size x concurrency.
+    progress_callback(done_bytes, total_bytes, bytes_per_second) is called as data arrives.
+    """
+    stat = client.stat_object(bucket_name, file_key)
+    progress = DownloadProgress(stat.size, progress_callback)
+    if stat.size >= settings.MINIO_PARALLEL_DOWNLOAD_THRESHOLD and settings.MINIO_DOWNLOAD_CONCURRENCY > 1:
+        _download_ranges(bucket_name, file_key, download_path, stat.size, stat.etag, progress)
+    else:
+        _download_stream(bucket_name, file_key, download_path, stat.etag, progress)
+    downloaded = os.path.getsize(download_path)
+    if downloaded != stat.size:
+        raise IOError(f"Size mismatch downloading {file_key}: expected {stat.size} bytes, got {downloaded}")
+    progress.report()
+    logger.info("Downloaded %s (%d bytes) at %.1f MB/s", file_key, stat.size, progress.rate / 1e6)
+
+def _sha256_of(chunks):
+    sha256 = hashlib.sha256()
+    for data in chunks:
+        sha256.update(data)
+    return sha256.hexdigest()
+
+def sha256_of_file(path):
+    """SHA-256 of a file on disk, read in MINIO_DOWNLOAD_CHUNK_SIZE pieces."""
+    with open(path, 'rb') as f:
+        return _sha256_of(iter(lambda: f.read(settings.MINIO_DOWNLOAD_CHUNK_SIZE), b''))
+
+def sha256_of_object(bucket_name, file_key):
+    """SHA-256 of an object in storage, streamed in MINIO_DOWNLOAD_CHUNK_SIZE pieces."""
     response = client.get_object(bucket_name, file_key)
-    with open(download_path, 'wb') as f:
-        f.write(response.read())
+    try:
+        return _sha256_of(response.stream(settings.MINIO_DOWNLOAD_CHUNK_SIZE))
+    finally:
+        response.close()
+        response.release_conn()
+
+def run_ffmpeg(command, progress_callback=None):
+    """
+    Run an ffmpeg command, reporting progress_callback(out_time_seconds, speed) from
+    ffmpeg's -progress output. Raises CalledProcessError on failure like subprocess.run(check=True).
+    """
+    if progress_callback is None:
+        return subprocess.run(command, check=True)
+    command = [command[0], '-progress', 'pipe:1', '-nostats'] + command[1:]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    out_time = 0.0
+    speed = None
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        if key == 'out_time_us' and value.isdigit():
+            out_time = int(value) / 1_000_000
+        elif key == 'speed' and value.endswith('x'):
+            try:
+                speed = float(value[:-1])
+            except ValueError:
+                speed = None
+        elif key == 'progress':
+            progress_callback(out_time, speed)
+    returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+    return process
 
-def get_audio_streams_from_video(input_file):
+def get_presigned_url(bucket_name, file_key, expires=timedelta(hours=12)):
+    """Presigned GET URL that lets ffmpeg read (and range-seek) an object without downloading it."""
+    return client.presigned_get_object(bucket_name, file_key, expires=expires)
+
+def probe_media(input_file):
     ffprobe_command = [
-        'ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', input_file
+        'ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', input_file
     ]
     result = subprocess.run(ffprobe_command, capture_output=True, text=True)
-    ffprobe_output = json.loads(result.stdout)
-    audio_streams = [s for s in ffprobe_output['streams'] if s['codec_type'] == 'audio']
-    return audio_streams
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, ffprobe_command, result.stdout, result.stderr)
+    return json.loads(result.stdout)
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _frame_rate(value):
+    """ffprobe rates are fractions such as 30000/1001."""
+    numerator, _, denominator = (value or '').partition('/')
+    try:
+        return round(int(numerator) / int(denominator or 1), 3) if int(numerator) else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def _rotation(stream):
+    """
+    Degrees the player (and ffmpeg, which autorotates) turns the stream's frames by:
+    the display matrix side data, else the rotate tag older muxers write, which
+    counts the other way round.
+    """
+    for side_data in stream.get('side_data_list', []):
+        if side_data.get('side_data_type') == 'Display Matrix' and side_data.get('rotation') is not None:
+            return int(round(float(side_data['rotation'])))
+    rotate = _int_or_none(stream.get('tags', {}).get('rotate'))
+    return -rotate if rotate else 0
+
+def display_size(video_stream):
+    """The stream's [width, height] as displayed, i.e. swapped for a quarter turn."""
+    width, height = video_stream['width'], video_stream['height']
+    if (video_stream.get('rotation') or 0) % 180 == 90:
+        return height, width
+    return width, height
+
+def parse_media_probe(ffprobe_output):
+    """Reduce ffprobe's -show_format -show_streams JSON to the fields the pipeline uses."""
+    media_format = ffprobe_output.get('format', {})
+    streams = []
+    for stream in ffprobe_output.get('streams', []):
+        streams.append({
+            'index': stream['index'],
+            'codec_type': stream.get('codec_type'),
+            'codec_name': stream.get('codec_name'),
+            'profile': stream.get('profile'),
+            'level': stream.get('level'),
+            'pix_fmt': stream.get('pix_fmt'),
+            'bit_rate': _int_or_none(stream.get('bit_rate')),
+            'width': stream.get('width'),
+            'height': stream.get('height'),
+            'rotation': _rotation(stream),
+            'fps': _frame_rate(stream.get('avg_frame_rate')),
+            'channels': stream.get('channels'),
+            'sample_rate': _int_or_none(stream.get('sample_rate')),
+            'language': stream.get('tags', {}).get('language'),
+        })
+    return {
+        'duration': float(media_format.get('duration') or 0),
+        'container': media_format.get('format_name', ''),
+        'bit_rate': _int_or_none(media_format.get('bit_rate')),
+        'size': _int_or_none(media_format.get('size')),
+        'streams': streams,
+    }
+
+def get_duration_from_video(input_file):
+    ffprobe_output = probe_media(input_file)
+    return float(ffprobe_output['format']['duration'])
+
+def get_keyframe_times(input_file):
+    """Presentation times of the keyframes of the first video stream, read from packet flags."""
+    ffprobe_command = [
+        'ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0', input_file
+    ]
+    result = subprocess.run(ffprobe_command, capture_output=True, text=True, check=True)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+def split_at_keyframes(keyframes, duration, chunk_duration):
+    """
+    Split [0, duration) into (start, length) chunks of roughly chunk_duration seconds,
+    each starting on a source keyframe. The last chunk has length None (until the end).
+    """
+    chunk_count = max(1, math.ceil(duration / chunk_duration))
+    starts = [0.0]
+    for idx in range(1, chunk_count):
+        target = idx * chunk_duration
+        start = next((k for k in keyframes if k >= target), None)
+        if start is None or start >= duration:
+            break
+        if start > starts[-1]:
+            starts.append(start)
+    chunks = []
+    for idx, start in enumerate(starts):
+        length = starts[idx + 1] - start if idx + 1 < len(starts) else None
+        chunks.append((start, length))
+    return chunks
+
+AVC_PROFILE_IDC = {
+    'baseline': 0x42,
+    'constrained baseline': 0x42,
+    'main': 0x4D,
+    'high': 0x64,
+}
+
+def avc1_codec_string(profile, level):
+    """Build the RFC 6381 codec string (avc1.PPCCLL) for an H.264 profile and level."""
+    profile_idc = AVC_PROFILE_IDC[profile.lower()]
+    constraint_flags = 0xE0 if profile.lower() == 'constrained baseline' else 0x00
+    level_idc = round(float(level) * 10)
+    return f'avc1.{profile_idc:02X}{constraint_flags:02X}{level_idc:02X}'
+
+def _parse_byterange(value, next_offset):
+    """[length, offset] of an EXT-X-BYTERANGE value "length[@offset]"; a missing offset continues the last range."""
+    length, _, offset = value.partition('@')
+    return [int(length), int(offset) if offset else next_offset]
+
+def _parse_attributes(value):
+    return dict(
+        (key, val.strip('"')) for key, val in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', value)
+    )
+
+def parse_hls_playlist(playlist_path):
+    """
+    Return every segment listed in a media playlist as a dict with its 'uri', 'duration',
+    'byterange' ([length, offset] within uri, or None for a whole file) and 'map', the
+    EXT-X-MAP init section it needs ({'uri', 'byterange'}, or None for MPEG-TS).
+    """
+    segments = []
+    duration = None
+    byterange = None
+    init_section = None
+    next_offsets = {}
+    with open(playlist_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[len('#EXTINF:'):].split(',')[0])
+            elif line.startswith('#EXT-X-BYTERANGE:'):
+                byterange = line[len('#EXT-X-BYTERANGE:'):]
+            elif line.startswith('#EXT-X-MAP:'):
+                attributes = _parse_attributes(line[len('#EXT-X-MAP:'):])
+                map_range = attributes.get('BYTERANGE')
+                init_section = {
+                    'uri': attributes['URI'],
+                    'byterange': _parse_byterange(map_range, 0) if map_range else None,
+                }
+            elif line and not line.startswith('#') and duration is not None:
+                if byterange:
+                    byterange = _parse_byterange(byterange, next_offsets.get(line, 0))
+                    next_offsets[line] = byterange[0] + byterange[1]
+                segments.append({'uri': line, 'duration': duration, 'byterange': byterange, 'map': init_section})
+                duration = None
+                byterange = None
+    return segments
+
+def measure_segments_bandwidth(segments):
+    """Measure (peak, average) bits/s of (duration, size_in_bytes) segments."""
+    peak = 0
+    total_bits = 0
+    total_duration = 0.0
+    for duration, size in segments:
+        bits = size * 8
+        if duration > 0:
+            peak = max(peak, int(bits / duration))
+        total_bits += bits
+        total_duration += duration
+    average = int(total_bits / total_duration) if total_duration else 0
+    return peak, average
+
+def list_playlist_segments(playlist_path):
+    """parse_hls_playlist() of a media playlist on disk, with each segment's 'size' in bytes."""
+    folder = os.path.dirname(playlist_path)
+    segments = parse_hls_playlist(playlist_path)
+    for segment in segments:
+        if segment['byterange']:
+            segment['size'] = segment['byterange'][0]
+        else:
+            segment['size'] = os.path.getsize(os.path.join(folder, segment['uri']))
+    return segments
+
+def measure_playlist_bandwidth(playlist_path):
+    """Measure (peak, average) bits/s of a media playlist from its segment sizes on disk."""
+    return measure_segments_bandwidth(
+        (segment['duration'], segment['size']) for segment in list_playlist_segments(playlist_path)
+    )
+
+def write_stitched_playlist(playlist_path, chunks, iframes_only=False):
+    """
+    Write one VOD media playlist from per-chunk segment lists, given as lists of
+    parse_hls_playlist() segments in chunk order. Chunks were encoded independently,
+    so each chunk boundary is marked with EXT-X-DISCONTINUITY, and fMP4 chunks carry
+    their own init section. iframes_only marks a playlist whose segments are single I-frames.
+    """
+    segments = [segment for chunk in chunks for segment in chunk]
+    target_duration = max((math.ceil(segment['duration']) for segment in segments), default=0)
+    if any(segment['map'] for segment in segments):
+        version = 6
+    elif iframes_only or any(segment['byterange'] for segment in segments):
+        version = 4
+    else:
+        version = 3
+    with open(playlist_path, 'w') as f:
+        f.write('#EXTM3U\n')
+        f.write(f'#EXT-X-VERSION:{version}\n')
+        f.write(f'#EXT-X-TARGETDURATION:{target_duration}\n')
+        f.write('#EXT-X-MEDIA-SEQUENCE:0\n')
+        f.write('#EXT-X-PLAYLIST-TYPE:VOD\n')
+        if iframes_only:
+            f.write('#EXT-X-I-FRAMES-ONLY\n')
+        init_section = None
+        for idx, segments in enumerate(chunks):
+            if idx > 0 and segments:
+                f.write('#EXT-X-DISCONTINUITY\n')
+            for segment in segments:
+                if segment['map'] and segment['map'] != init_section:
+                    init_section = segment['map']
+                    f.write(f'#EXT-X-MAP:{_map_attributes(init_section)}\n')
+                f.write(f"#EXTINF:{segment['duration']:.6f},\n")
+                if segment['byterange']:
+                    length, offset = segment['byterange']
+                    f.write(f'#EXT-X-BYTERANGE:{length}@{offset}\n')
+                f.write(f"{segment['uri']}\n")
+        f.write('#EXT-X-ENDLIST\n')
+
+def _map_attributes(init_section):
+    attributes = f'URI="{init_section["uri"]}"'
+    if init_section['byterange']:
+        length, offset = init_section['byterange']
+        attributes += f',BYTERANGE="{length}@{offset}"'
+    return attributes
 
+def mark_iframes_only(playlist_path):
+    """Tag a media playlist ffmpeg wrote from single-I-frame segments as an I-frame playlist (version 4 or later)."""
+    with open(playlist_path) as f:
+        lines = f.read().splitlines()
+    tagged = []
+    for line in lines:
+        if line.startswith('#EXT-X-VERSION:'):
+            tagged += [f"#EXT-X-VERSION:{max(4, int(line[len('#EXT-X-VERSION:'):]))}", '#EXT-X-I-FRAMES-ONLY']
+        else:
+            tagged.append(line)
+    with open(playlist_path, 'w') as f:
+        f.write('\n'.join(tagged) + '\n')
 
+def _vtt_timestamp(seconds):
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    return f'{hours:02d}:{minutes:02d}:{milliseconds / 1000:06.3f}'
 
+def write_thumbnails_vtt(vtt_path, runs, interval, width, height, columns, rows):
+    """
+    Write the WebVTT index of thumbnail sprite sheets: one cue per thumbnail, pointing at
+    its tile with a #xywh media fragment. runs lists, in playback order, the (start,
+    duration, sheet names) of each encode that wrote sheets: the whole video or one chunk.
+    Each encode took a thumbnail every interval seconds from its start and tiled them
+    columns x rows to a sheet.
+    """
+    per_sheet = columns * rows
+    with open(vtt_path, 'w') as f:
+        f.write('WEBVTT\n')
+        for start, duration, sheets in runs:
+            count = min(math.ceil(duration / interval), len(sheets) * per_sheet)
+            for idx in range(count):
+                cue_start = start + idx * interval
+                cue_end = min(cue_start + interval, start + duration)
+                sheet, tile = divmod(idx, per_sheet)
+                x, y = tile % columns * width, tile // columns * height
+                f.write(f'\n{_vtt_timestamp(cue_start)} --> {_vtt_timestamp(cue_end)}\n')
+                f.write(f'{sheets[sheet]}#xywh={x},{y},{width},{height}\n')
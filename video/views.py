@@ -1,32 +1,95 @@
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from django.shortcuts import render, redirect, get_object_or_404
-from .forms import VideoUploadForm
-from .models import Video
-from .tasks import transcode_video
+from django.urls import reverse
+from django.views.decorators.http import require_http_methods, require_POST, require_safe
+from .catalogue import catalogue_cache_key, catalogue_page
+from .dedup import find_transcode_result, reuse_transcode_result
+from .edge import ObjectNotFound, edge_cache, edge_response, object_name_for
+from .events import stream_video_events, video_event, audio_track_event
+from .forms import LiveStreamForm, UploadSessionForm, VideoUploadForm
+from .metrics import metrics_registry
+from .models import LiveStream, UploadSession, Video, default_output_format
+from .multipart import (
+    abort_upload,
+    complete_upload,
+    list_uploaded_parts,
+    object_key_for,
+    part_size_for,
+    presign_part,
+    start_upload,
+)
+from .tasks import ingest_live_stream, schedule_transcode
+from .utils import create_uuid, encoding_profile_hash
 
 def upload_video(request):
     if request.method == 'POST':
         form = VideoUploadForm(request.POST, request.FILES)
         if form.is_valid():
-            video = form.save()
-            # Trigger video transcoding via Celery
-            transcode_video.delay(video.id)
+            video = form.save(commit=False)
+            video.content_hash = getattr(request, 'upload_digests', {}).get('video_file')
+            video.encoding_profile_hash = encoding_profile_hash(video.output_format)
+            result = find_transcode_result(video.content_hash, video.encoding_profile_hash)
+            # Same content, same encoding settings: play from the existing HLS tree.
+            if result is None or reuse_transcode_result(video, result) is None:
+                video.save()
+                # Probe, then queue the transcode by cost
+                schedule_transcode.delay(video.id)
             return redirect('video:list')
     else:
         form = VideoUploadForm()
     
     return render(request, 'video/upload_video.html', {'form': form})
 
+def start_live_stream(request):
+    if request.method == 'POST':
+        form = LiveStreamForm(request.POST)
+        if form.is_valid():
+            with transaction.atomic():
+                live_stream = form.save()
+                transaction.on_commit(lambda: ingest_live_stream.delay(live_stream.id))
+            return redirect('video:detail', live_stream.video_id)
+    else:
+        form = LiveStreamForm()
+
+    return render(request, 'video/live_stream.html', {'form': form})
+
+@require_POST
+def stop_live_stream(request, pk):
+    """Ask the ingest to stop; it ends the playlists and marks the video ended."""
+    LiveStream.objects.filter(video_id=pk, ended_at__isnull=True).update(stop_requested=True)
+    return redirect('video:detail', pk)
+
 def video_list(request):
-    videos = Video.objects.all()
-    return render(request, 'video/video_list.html', {'videos': videos})
+    cursor = request.GET.get('after')
+    cache_key = catalogue_cache_key(cursor)
+    html = cache.get(cache_key)
+    if html is None:
+        try:
+            videos, next_cursor = catalogue_page(cursor)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid page cursor")
+        html = render_to_string('video/video_list.html', {
+            'videos': videos,
+            'next_cursor': next_cursor,
+            'is_first_page': not cursor,
+        }, request)
+        cache.set(cache_key, html, settings.VIDEO_CATALOGUE_CACHE_TIMEOUT)
+    return HttpResponse(html)
 
 
 from .forms import AudioUploadForm
 from .models import AudioTrack
-from .tasks import transcode_audio_for_video
+from .tasks import transcode_audio_for_video, transcode_audio_tracks_for_video
 
 def video_detail(request, pk):
-    video = get_object_or_404(Video, pk=pk)
+    # The template walks the tracks several times; fetch them once.
+    video = get_object_or_404(Video.objects.select_related('transcode_result', 'live_stream').prefetch_related('audio_tracks'), pk=pk)
     audio_form = AudioUploadForm()
     audio_upload_success = False
 
@@ -46,3 +109,203 @@ def video_detail(request, pk):
         'audio_form': audio_form,
         'audio_upload_success': audio_upload_success,
     })
+
+
+MAX_AUDIO_TRACKS_PER_REQUEST = 50
+
+
+@require_POST
+def upload_audio_tracks(request, pk):
+    """
+    Add a set of audio tracks to a transcoded video in one multipart POST, e.g. a dubbing
+    delivery: one file per language, each in a field named after its language code
+    (fr=@fr.m4a). The tracks are created with a single INSERT and transcoded together by
+    one task, which publishes the master playlist once.
+    """
+    video = get_object_or_404(Video, pk=pk, status='completed')
+    if not 0 < len(request.FILES) <= MAX_AUDIO_TRACKS_PER_REQUEST:
+        return JsonResponse(
+            {'error': f"Send 1 to {MAX_AUDIO_TRACKS_PER_REQUEST} audio files, one field per language"}, status=400
+        )
+    audio_tracks = []
+    errors = {}
+    for language, files in request.FILES.lists():
+        if len(files) > 1:
+            errors[language] = ["One file per language."]
+            continue
+        form = AudioUploadForm({'language': language}, {'audio_file': files[0]})
+        if not form.is_valid():
+            errors[language] = [error for field_errors in form.errors.values() for error in field_errors]
+            continue
+        audio_track = form.save(commit=False)
+        audio_track.video = video
+        audio_track.is_user_uploaded = True
+        audio_tracks.append(audio_track)
+    if errors:
+        return JsonResponse({'errors': errors}, status=400)
+
+    with transaction.atomic():
+        # The INSERT saves each file to storage first, as save() would.
+        audio_tracks = AudioTrack.objects.bulk_create(audio_tracks)
+        audio_track_ids = [audio_track.id for audio_track in audio_tracks]
+        transaction.on_commit(lambda: transcode_audio_tracks_for_video.delay(video.id, audio_track_ids))
+    return JsonResponse({
+        'audio_track_ids': audio_track_ids,
+        'redirect': reverse('video:detail', args=[video.id]),
+    }, status=202)
+
+
+async def video_events(request, pk):
+    """Server-sent event stream of status/progress for a video and its audio tracks."""
+    try:
+        video = await Video.objects.aget(pk=pk)
+    except Video.DoesNotExist:
+        raise Http404
+    snapshot = [video_event(video)] + [audio_track_event(track) async for track in video.audio_tracks.all()]
+    response = StreamingHttpResponse(stream_video_events(video.id, snapshot), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_safe
+async def playback(request, key):
+    """A playlist or segment of the transcoded tree, served through the edge cache."""
+    object_name = object_name_for(key)
+    if object_name is None:
+        raise Http404
+    try:
+        cached = await edge_cache.get(object_name)
+    except ObjectNotFound:
+        raise Http404
+    return edge_response(request, cached)
+
+
+def metrics(request):
+    """Prometheus scrape endpoint for the transcode and request metrics."""
+    return HttpResponse(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+# Direct-to-storage uploads: the browser PUTs file parts to presigned MinIO URLs and
+# these views only exchange small JSON documents.
+
+MAX_PRESIGNED_PARTS_PER_REQUEST = 100
+
+
+def _json_body(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _upload_session_state(session, parts=()):
+    return {
+        'id': str(session.id),
+        'status': session.status,
+        'size': session.size,
+        'part_size': session.part_size,
+        'part_count': session.part_count,
+        'parts': list(parts),
+    }
+
+
+@require_POST
+def start_upload_session(request):
+    """Start a multipart upload for a new video or audio track."""
+    data = _json_body(request)
+    if data is None:
+        return JsonResponse({'error': "Expected a JSON object"}, status=400)
+    form = UploadSessionForm(data)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    fields = form.cleaned_data
+    object_key = object_key_for(fields['kind'], fields['filename'])
+    session = UploadSession.objects.create(
+        kind=fields['kind'],
+        title=fields['title'],
+        output_format=fields['output_format'],
+        video=fields['video'],
+        language=fields['language'],
+        object_key=object_key,
+        upload_id=start_upload(object_key, fields['content_type']),
+        filename=fields['filename'],
+        content_type=fields['content_type'],
+        size=fields['size'],
+        part_size=part_size_for(fields['size']),
+    )
+    return JsonResponse(_upload_session_state(session), status=201)
+
+
+@require_http_methods(['GET', 'DELETE'])
+def upload_session(request, pk):
+    """GET: the session and the parts storage already has, to resume from. DELETE: abort it."""
+    session = get_object_or_404(UploadSession, pk=pk)
+    if request.method == 'DELETE':
+        if session.status == 'active':
+            abort_upload(session.object_key, session.upload_id)
+            session.status = 'aborted'
+            session.save(update_fields=['status', 'updated_at'])
+        return JsonResponse(_upload_session_state(session))
+    parts = list_uploaded_parts(session.object_key, session.upload_id) if session.status == 'active' else []
+    return JsonResponse(_upload_session_state(session, parts))
+
+
+@require_POST
+def presign_upload_parts(request, pk):
+    """Presigned PUT URLs for the requested part numbers."""
+    session = get_object_or_404(UploadSession, pk=pk, status='active')
+    data = _json_body(request)
+    part_numbers = data.get('part_numbers') if data else None
+    if (not isinstance(part_numbers, list) or not 0 < len(part_numbers) <= MAX_PRESIGNED_PARTS_PER_REQUEST
+            or not all(isinstance(n, int) and 1 <= n <= session.part_count for n in part_numbers)):
+        return JsonResponse(
+            {'error': f"part_numbers must list 1 to {MAX_PRESIGNED_PARTS_PER_REQUEST} parts between 1 and {session.part_count}"},
+            status=400
+        )
+    return JsonResponse({
+        'urls': {n: presign_part(session.object_key, session.upload_id, n) for n in part_numbers},
+    })
+
+
+@require_POST
+def complete_upload_session(request, pk):
+    """
+    Assemble the uploaded parts, then create the Video or AudioTrack and queue its
+    transcode. The part list comes from storage, not the client, and every part must
+    be there at its expected size.
+    """
+    with transaction.atomic():
+        session = get_object_or_404(UploadSession.objects.select_for_update(), pk=pk, status='active')
+        parts = {part['part_number']: part for part in list_uploaded_parts(session.object_key, session.upload_id)}
+        missing = [
+            n for n in range(1, session.part_count + 1)
+            if n not in parts or parts[n]['size'] != session.expected_part_size(n)
+        ]
+        if missing:
+            return JsonResponse({'error': "Upload is incomplete", 'missing_parts': missing}, status=409)
+        complete_upload(session.object_key, session.upload_id, [parts[n] for n in sorted(parts)])
+        session.status = 'completed'
+        session.save(update_fields=['status', 'updated_at'])
+
+        if session.kind == 'video':
+            video = Video(
+                title=session.title,
+                transcoding_uuid=create_uuid(),
+                output_format=session.output_format or default_output_format(),
+            )
+            video.encoding_profile_hash = encoding_profile_hash(video.output_format)
+            video.video_file.name = session.object_key
+            video.save()
+            transaction.on_commit(lambda: schedule_transcode.delay(video.id))
+            return JsonResponse({'video_id': video.id, 'redirect': reverse('video:list')})
+
+        audio_track = AudioTrack(video=session.video, language=session.language, is_user_uploaded=True)
+        audio_track.audio_file.name = session.object_key
+        audio_track.save()
+        transaction.on_commit(lambda: transcode_audio_for_video.delay(audio_track.id))
+        return JsonResponse({
+            'audio_track_id': audio_track.id,
+            'redirect': reverse('video:detail', args=[session.video_id]),
+        })
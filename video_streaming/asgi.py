@@ -3,6 +3,10 @@ ASGI config for video_streaming project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The progress event stream (``video:events``) is an async view that holds one idle
+coroutine per connected browser, so serve the site through this module, e.g.
+``uvicorn video_streaming.asgi:application``, rather than a WSGI server.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -1,9 +1,22 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'video_streaming.settings')
 
 app = Celery('video_streaming')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
+
+
+@worker_init.connect
+def apply_queue_concurrency(sender=None, **kwargs):
+    """A worker consuming a single queue (-Q long) runs that queue's configured number of processes."""
+    from django.conf import settings
+
+    queues = sender.app.amqp.queues.consume_from
+    if queues and len(queues) == 1:
+        concurrency = settings.TRANSCODE_QUEUE_CONCURRENCY.get(next(iter(queues)))
+        if concurrency:
+            sender.concurrency = concurrency
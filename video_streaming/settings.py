@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 
+from kombu import Exchange, Queue
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -44,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'video.middleware.request_metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +87,15 @@ DATABASES = {
 }
 
 
+# Uploaded files are hashed while they stream in so duplicate sources can reuse an
+# existing transcode instead of being encoded again.
+FILE_UPLOAD_HANDLERS = [
+    'video.uploadhandlers.ContentHashUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -130,6 +142,238 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
+# Transcode work is split by cost so a feature film never holds up short clips or added
+# audio tracks. Run one worker per queue (celery -A video_streaming worker -Q long); a
+# worker consuming a single queue starts that queue's TRANSCODE_QUEUE_CONCURRENCY processes.
+TRANSCODE_AUDIO_QUEUE = 'audio'
+TRANSCODE_SHORT_QUEUE = 'short'
+TRANSCODE_LONG_QUEUE = 'long'
+# Each live stream holds one process of the live queue for as long as it runs.
+LIVE_INGEST_QUEUE = 'live'
+TRANSCODE_QUEUE_CONCURRENCY = {
+    TRANSCODE_AUDIO_QUEUE: 4,
+    TRANSCODE_SHORT_QUEUE: 4,
+    TRANSCODE_LONG_QUEUE: 2,
+    LIVE_INGEST_QUEUE: 4,
+}
+# A video job costs its duration scaled by its resolution, in 1080p-seconds. Jobs costing
+# at least this go to the long queue.
+TRANSCODE_LONG_QUEUE_MIN_COST = 600
+# Within a queue cheaper jobs go first: priority 0 below this cost, one step worse per doubling.
+TRANSCODE_PRIORITY_COST_UNIT = 60
+# A batch of uploaded audio tracks (e.g. a dubbing delivery) is one task of the audio queue
+# that runs this many ffmpeg processes at a time; an AAC encode keeps about one core busy.
+# The audio worker runs several batches at once, so each gets its share of the cores.
+AUDIO_BATCH_CONCURRENCY = max(1, (os.cpu_count() or 4) // TRANSCODE_QUEUE_CONCURRENCY[TRANSCODE_AUDIO_QUEUE])
+CELERY_TASK_QUEUES = [Queue(name, Exchange(name), routing_key=name) for name in TRANSCODE_QUEUE_CONCURRENCY]
+CELERY_TASK_DEFAULT_QUEUE = TRANSCODE_SHORT_QUEUE
+CELERY_TASK_ROUTES = {
+    'video.tasks.transcode_audio_for_video': {'queue': TRANSCODE_AUDIO_QUEUE},
+    'video.tasks.transcode_audio_tracks_for_video': {'queue': TRANSCODE_AUDIO_QUEUE},
+    # The parts of a chunked transcode belong to a long job.
+    'video.tasks.transcode_video_chunk': {'queue': TRANSCODE_LONG_QUEUE},
+    'video.tasks.transcode_audio_streams_for_video': {'queue': TRANSCODE_LONG_QUEUE},
+    'video.tasks.finalize_chunked_transcode': {'queue': TRANSCODE_LONG_QUEUE},
+    'video.tasks.ingest_live_stream': {'queue': LIVE_INGEST_QUEUE},
+}
+# Redis emulates priorities with one list per step; 0 is served first.
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+    # Transcode tasks are acknowledged when they finish (acks_late); Redis delivers a
+    # message again if it stays unacknowledged this long, e.g. when its worker vanished.
+    # Longer than most parts take: a redelivery of a running part is skipped anyway.
+    'visibility_timeout': 2 * 3600,  # seconds
+}
+# Take one message at a time so a busy worker doesn't hold cheaper jobs behind long ones.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Every task of a transcode is checkpointed as a TranscodePart, so a redelivered task
+# skips what already completed and a chunked transcode resumes from the chunks it still
+# lacks. A worker beats its part's heartbeat every TRANSCODE_HEARTBEAT_INTERVAL; the
+# reap_stale_transcodes task, run by celery beat, sends parts whose heartbeat is
+# TRANSCODE_HEARTBEAT_TIMEOUT old to another worker, and fails them after
+# TRANSCODE_MAX_ATTEMPTS starts. A part whose task raised is sent again after
+# TRANSCODE_RETRY_BACKOFF, doubled for every attempt it has had.
+TRANSCODE_HEARTBEAT_INTERVAL = 30  # seconds
+TRANSCODE_HEARTBEAT_TIMEOUT = 120  # seconds
+TRANSCODE_MAX_ATTEMPTS = 3
+TRANSCODE_RETRY_BACKOFF = 60  # seconds
+TRANSCODE_REAPER_INTERVAL = 60  # seconds
+CELERY_BEAT_SCHEDULE = {
+    'reap-stale-transcodes': {
+        'task': 'video.tasks.reap_stale_transcodes',
+        'schedule': TRANSCODE_REAPER_INTERVAL,
+    },
+}
+
+# Shared by the web processes and the workers, which invalidate cached catalogue pages.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+    }
+}
+VIDEO_CATALOGUE_PAGE_SIZE = 20
+VIDEO_CATALOGUE_CACHE_TIMEOUT = 300  # seconds
+
+# Celery queues whose depth is reported at /metrics.
+METRICS_CELERY_QUEUES = list(TRANSCODE_QUEUE_CONCURRENCY)
+
+# Transcode status/progress events are published over Redis pub/sub and streamed to
+# browsers as server-sent events by the ASGI app.
+VIDEO_EVENTS_REDIS_URL = CELERY_BROKER_URL
+VIDEO_EVENTS_KEEPALIVE = 15  # seconds
+
+# Per-video locks (e.g. around master playlist writes) are held in Redis so they
+# cover every worker process.
+VIDEO_LOCK_REDIS_URL = CELERY_BROKER_URL
+VIDEO_LOCK_TIMEOUT = 60  # seconds before a lock whose holder died expires
+VIDEO_LOCK_BLOCKING_TIMEOUT = 120  # seconds to wait for a lock before failing
+
+# Connections kept open to MinIO per process; should cover the download/upload concurrency.
+MINIO_MAX_POOL_CONNECTIONS = 16
+
+# Every transcode task works in its own scratch directory, removed when it finishes or
+# fails. Tasks whose estimated footprint (source size x TRANSCODE_SCRATCH_SIZE_FACTOR)
+# fits the tmpfs budget run in memory; the rest use TRANSCODE_SCRATCH_DIR, whose budget
+# also covers the LRU cache of downloaded sources. All the worker processes on a host
+# share both budgets and wait up to TRANSCODE_SCRATCH_WAIT_TIMEOUT for room.
+TRANSCODE_SCRATCH_DIR = str(BASE_DIR / 'scratch')
+TRANSCODE_SCRATCH_BUDGET = 50 * 1024 * 1024 * 1024  # bytes
+TRANSCODE_SCRATCH_TMPFS_DIR = '/dev/shm/video-scratch' if os.path.isdir('/dev/shm') else None
+TRANSCODE_SCRATCH_TMPFS_BUDGET = 2 * 1024 * 1024 * 1024  # bytes
+TRANSCODE_SCRATCH_SIZE_FACTOR = 3
+TRANSCODE_SCRATCH_WAIT_TIMEOUT = 1800  # seconds
+TRANSCODE_SOURCE_CACHE_MAX_SIZE = 20 * 1024 * 1024 * 1024  # bytes, within TRANSCODE_SCRATCH_BUDGET
+
+# Browsers upload source files straight to MinIO as presigned multipart uploads.
+DIRECT_UPLOAD_PART_SIZE = 16 * 1024 * 1024  # bytes; grown for files over 10,000 parts
+DIRECT_UPLOAD_MAX_SIZE = 100 * 1024 * 1024 * 1024  # bytes
+DIRECT_UPLOAD_URL_EXPIRY = 3600  # seconds a presigned part URL stays valid
+
+# Bulk imports (manage.py import_videos) create videos IMPORT_BATCH_SIZE at a time and
+# queue at most IMPORT_ENQUEUE_RATE transcodes a second, at the lowest priority. They
+# pause while the short and long queues hold more than IMPORT_MAX_QUEUED messages, so
+# a large import never floods the broker or holds up uploads.
+IMPORT_BATCH_SIZE = 500
+IMPORT_ENQUEUE_RATE = 50  # transcodes queued per second
+IMPORT_MAX_QUEUED = 1000
+IMPORT_QUEUE_POLL_INTERVAL = 10  # seconds between queue depth checks while paused
+
+# Transcoded output is uploaded from a bounded thread pool; files larger than the part
+# size go up as multipart uploads. Unchanged objects (same size and MD5) are skipped.
+MINIO_UPLOAD_CONCURRENCY = 8
+MINIO_UPLOAD_PART_SIZE = 16 * 1024 * 1024
+
+# Source downloads are streamed in chunks; objects above the threshold are fetched as
+# parallel range requests, so worker memory stays around chunk size x concurrency.
+MINIO_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MINIO_DOWNLOAD_PART_SIZE = 64 * 1024 * 1024
+MINIO_DOWNLOAD_CONCURRENCY = 8
+MINIO_PARALLEL_DOWNLOAD_THRESHOLD = 256 * 1024 * 1024
+
+# Sources at least this long (seconds) are split at keyframes into chunks of about
+# TRANSCODE_CHUNK_DURATION seconds that are encoded in parallel across workers.
+TRANSCODE_CHUNKED_MIN_DURATION = 600
+TRANSCODE_CHUNK_DURATION = 120
+
+# Progress writes are coalesced to one per PROGRESS_MIN_INTERVAL seconds unless
+# progress moved by at least PROGRESS_MIN_STEP percent.
+PROGRESS_MIN_INTERVAL = 5
+PROGRESS_MIN_STEP = 5
+
+# HLS encoding
+HLS_SEGMENT_DURATION = 10  # seconds
+HLS_AUDIO_BITRATE = 128000  # bits/s
+# Adaptive bitrate ladder, highest first. Rungs taller than the source are skipped.
+HLS_RENDITION_LADDER = [
+    {'name': '1080p', 'height': 1080, 'bitrate': 5000000, 'maxrate': 5350000, 'bufsize': 7500000, 'profile': 'high', 'level': '4.1'},
+    {'name': '720p', 'height': 720, 'bitrate': 2800000, 'maxrate': 2996000, 'bufsize': 4200000, 'profile': 'high', 'level': '3.1'},
+    {'name': '480p', 'height': 480, 'bitrate': 1400000, 'maxrate': 1498000, 'bufsize': 2100000, 'profile': 'main', 'level': '3.0'},
+    {'name': '360p', 'height': 360, 'bitrate': 800000, 'maxrate': 856000, 'bufsize': 1200000, 'profile': 'main', 'level': '3.0'},
+]
+# Per-title encoding: before a re-encode, PER_TITLE_SAMPLE_COUNT scenes of
+# PER_TITLE_SAMPLE_DURATION seconds spread over the title are encoded at PER_TITLE_CRF for
+# every rung. Each rung then gets the bitrate the samples needed at that quality, plus
+# PER_TITLE_HEADROOM, kept between PER_TITLE_MIN_BITRATE_RATIO and
+# PER_TITLE_MAX_BITRATE_RATIO of the ladder's bitrate. maxrate and bufsize scale with it.
+PER_TITLE_ENCODING = True
+PER_TITLE_CRF = 23
+PER_TITLE_PROBE_PRESET = 'veryfast'  # faster than the ladder's encode and a little less efficient, so it errs high
+PER_TITLE_SAMPLE_COUNT = 5
+PER_TITLE_SAMPLE_DURATION = 4  # seconds
+PER_TITLE_MAX_SAMPLED_FRACTION = 0.2  # fewer samples on short titles, so they stay cheap to analyse
+PER_TITLE_HEADROOM = 0.1
+PER_TITLE_MIN_BITRATE_RATIO = 0.25
+PER_TITLE_MAX_BITRATE_RATIO = 1.5
+# Remux (-c copy) streams that are already H.264 yuv420p / AAC-LC within the top rung's
+# maxrate / HLS_AUDIO_BITRATE instead of re-encoding them. A copied video stream is
+# published as the top rendition at the source resolution.
+HLS_STREAM_COPY = True
+# Below a copied video stream, still encode the ladder's lower rungs (from the same
+# decode) so players can step down. Off publishes the copy as the only rendition.
+HLS_STREAM_COPY_LADDER = True
+# Default segmenting of new uploads, chosen per video on the upload form: 'ts' (MPEG-TS
+# segments), 'fmp4' (fMP4/CMAF segments with an init section) or 'single_file' (one fMP4
+# file per rendition, addressed by byte range: a handful of objects per title).
+HLS_OUTPUT_FORMAT = 'ts'
+# Trickplay: the video encode also writes a poster frame, thumbnail sprite sheets indexed
+# by thumbnails.vtt for scrubbing previews, and an I-frame-only rendition listed in the
+# master as EXT-X-I-FRAME-STREAM-INF. They are cut from the frames already decoded for the
+# ladder; a remuxed source only has its keyframes decoded for them.
+TRICKPLAY_ENABLED = True
+TRICKPLAY_POSTER_TIME = 10  # seconds in; the middle of shorter videos
+TRICKPLAY_POSTER_WIDTH = 1280  # pixels, at most the source width
+TRICKPLAY_THUMBNAIL_INTERVAL = 5  # seconds between thumbnails
+TRICKPLAY_THUMBNAIL_WIDTH = 160  # pixels
+TRICKPLAY_SPRITE_COLUMNS = 10  # thumbnails per row of a sprite sheet
+TRICKPLAY_SPRITE_ROWS = 10
+TRICKPLAY_IFRAME_INTERVAL = 2  # seconds between I-frames
+TRICKPLAY_IFRAME_HEIGHT = 360  # pixels, at most the source height
+TRICKPLAY_IFRAME_CRF = 28
+# Live streams publish a sliding window of LIVE_HLS_WINDOW seconds; older segments are
+# deleted locally by ffmpeg and from storage once they have been out of the playlist
+# for another window, so players holding a stale playlist can still fetch them.
+# Low-latency streams use shorter segments. The ladder is encoded with a faster x264
+# preset to keep up with real time.
+LIVE_HLS_SEGMENT_DURATION = 4  # seconds
+LIVE_HLS_LOW_LATENCY_SEGMENT_DURATION = 1  # seconds
+LIVE_HLS_WINDOW = 60  # seconds
+LIVE_X264_PRESET = 'veryfast'
+# How often the ingest task pushes new segments and playlists and checks for a stop request.
+LIVE_INGEST_POLL_INTERVAL = 0.5  # seconds
+# An ingest whose encoder hasn't produced a segment by then is given up as failed.
+LIVE_INGEST_CONNECT_TIMEOUT = 600  # seconds
+# Seconds ffmpeg gets to finish its playlists after being asked to stop, before it is killed.
+LIVE_INGEST_STOP_TIMEOUT = 10
+# The ingest task reads whatever its input URL names, so the URL is held to a listener:
+# SRT in mode=listener or RTMP, bound to one of LIVE_INGEST_BIND_HOSTS, or a named pipe
+# under LIVE_INGEST_PIPE_DIR. Add the address of a dedicated ingest interface to bind there.
+LIVE_INGEST_BIND_HOSTS = ['0.0.0.0']
+LIVE_INGEST_PIPE_DIR = str(BASE_DIR / 'live-ingest')
+
+# Players fetch playlists and segments through the playback edge (video:playback), which
+# caches them in each web process's memory and on local disk so storage sees about one
+# fetch per object. Cached playlists are revalidated against storage after
+# EDGE_PLAYLIST_MAX_AGE seconds and segments after EDGE_SEGMENT_MAX_AGE; both are also
+# the max-age sent to players. A miss on an object larger than EDGE_DISK_FILL_SIZE is
+# streamed from storage while the disk cache fills in the background, instead of making
+# the viewer wait for the whole object. Objects larger than EDGE_DISK_MAX_OBJECT_SIZE are
+# streamed from storage uncached.
+EDGE_CACHE_DIR = str(BASE_DIR / 'edge-cache')
+EDGE_DISK_CACHE_SIZE = 20 * 1024 * 1024 * 1024  # bytes
+EDGE_DISK_FILL_SIZE = 16 * 1024 * 1024  # bytes
+EDGE_DISK_MAX_OBJECT_SIZE = 1024 * 1024 * 1024  # bytes
+EDGE_MEMORY_CACHE_SIZE = 256 * 1024 * 1024  # bytes per web process
+EDGE_MEMORY_MAX_OBJECT_SIZE = 8 * 1024 * 1024  # bytes; larger segments are served from disk
+EDGE_PLAYLIST_MAX_AGE = 1  # seconds
+EDGE_SEGMENT_MAX_AGE = 3600  # seconds
+# URL prefix of an nginx `internal` location aliased to EDGE_CACHE_DIR. When set, segments
+# on disk are sent by nginx (X-Accel-Redirect) instead of being streamed by Django.
+EDGE_ACCEL_REDIRECT_PREFIX = None
+
 
 
 STORAGES = {
@@ -17,10 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
-from video.views import video_list
+from video.views import metrics, video_list
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', video_list, name='home'),
     path('video/', include('video.urls')),
+    path('metrics', metrics, name='metrics'),
 ]